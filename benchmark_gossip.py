@@ -0,0 +1,189 @@
+# Convergence benchmark for the gossip engine. Every node is a process running
+# the real send_gossip() loop, GossipPacer and all, over its own LocalKVS,
+# and serving the gossip endpoints to the others from a small aiohttp server
+# that answers the way gossip_endpoints.py does (no Flask app, manager or view
+# tracker processes). A single write lands on one node with replication to the
+# others lost, and we time how long gossip takes to get it everywhere.
+#
+# The cluster starts up when the write lands, so every node is gossiping at
+# GOSSIP_MIN_INTERVAL rather than backed off, and has yet to sync with any of
+# its peers (the first exchange with each is a hash tree check). All the nodes
+# share this machine's CPUs, so with many more nodes than cores the times
+# include waiting for one.
+#
+# Usage: python3 benchmark_gossip.py [trials]
+# Prints seconds to converge against the number of nodes, for a few fanouts.
+
+import asyncio
+import logging
+import os
+import sys
+from contextlib import redirect_stdout
+from multiprocessing import Event, Pipe, Process, Queue
+from time import monotonic
+
+from aiohttp import web
+
+import gossip
+from hybrid_clock import versionOrder
+from local_database import LocalKVS
+
+NODE_COUNTS = [2, 4, 8, 16, 32]
+FANOUTS = [1, 2, 3]
+WRITE_KEY = "benchmark"
+# How often each node checks whether the write has reached it
+POLL_INTERVAL = 0.002
+
+
+class Served:
+    def __init__(self, served):
+        """
+        Stands in for a manager connection, handing out served directly.
+        """
+        self.served = served
+
+    def connect(self):
+        pass
+
+    def get(self):
+        return self.served
+
+
+class StaticView:
+    def __init__(self, view: list[str]):
+        """
+        A view tracker for a node that has been in view all along.
+        """
+        self.view = view
+
+    def isInitialized(self) -> bool:
+        return True
+
+    def isReady(self) -> bool:
+        return True
+
+    def setReady(self, ready: bool) -> None:
+        pass
+
+    def getView(self) -> list[str]:
+        return self.view
+
+
+def gossipRoutes(kvs: LocalKVS) -> dict[str, callable]:
+    """
+    The delta and hash tree endpoints, as gossip_endpoints.py serves them to a
+    node storing every key.
+    """
+    async def delta(request):
+        body = await request.json()
+        kvs.mergeEntries(body["kvs"])
+        origin_frontier = kvs.getOriginFrontier()
+        epoch, seq, changes, complete = kvs.getChangePage(body["since"], body["peer_epoch"], body["limit"])
+        changes = {key: val_tuple for key, val_tuple in changes.items()
+                   if key not in body["kvs"] or versionOrder(body["kvs"][key]) < versionOrder(val_tuple)}
+        return web.json_response({"kvs": changes, "epoch": epoch, "seq": seq, "complete": complete,
+                                  "frontiers": kvs.updateFrontiers(body["frontiers"]),
+                                  "origin_frontier": origin_frontier})
+
+    async def merkle(request):
+        body = await request.json()
+        origin_frontier = kvs.getOriginFrontier()
+        epoch, seq = kvs.getChangePosition()
+        return web.json_response({"differing": kvs.compareMerkleHashes(body["hashes"]), "epoch": epoch, "seq": seq,
+                                  "frontiers": kvs.updateFrontiers(body.get("frontiers", {})),
+                                  "origin_frontier": origin_frontier})
+
+    async def buckets(request):
+        body = await request.json()
+        entries, covered = kvs.getBucketPage(body["buckets"], body["limit"])
+        kvs.mergeEntries(body["kvs"])
+        entries = {key: val_tuple for key, val_tuple in entries.items()
+                   if key not in body["kvs"] or versionOrder(body["kvs"][key]) < versionOrder(val_tuple)}
+        return web.json_response({"kvs": entries, "covered": covered})
+
+    return {gossip.GOSSIP_ENDPOINT: delta, gossip.MERKLE_ENDPOINT: merkle, gossip.MERKLE_BUCKETS_ENDPOINT: buckets}
+
+
+async def runNode(index: int, fanout: int, addresses: Queue, view_conn, start, stop, arrivals: Queue,
+                  stopped: Queue, teardown):
+    kvs = LocalKVS()
+    app = web.Application()
+    for path, handler in gossipRoutes(kvs).items():
+        app.router.add_put(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    address = f"127.0.0.1:{runner.addresses[0][1]}"
+    addresses.put(address)
+    view = await asyncio.to_thread(view_conn.recv)
+
+    gossip.MY_ADDRESS = address
+    gossip.GOSSIP_FANOUT = fanout
+    gossip.GOSSIP_CONCURRENCY = max(4, 2 * fanout)
+    gossip.getViewManager = lambda: Served(StaticView(view))
+    gossip.getKVSManager = lambda: Served(kvs)
+
+    await asyncio.to_thread(start.wait)
+    if index == 0:
+        kvs.setOwnValue(WRITE_KEY, "v", 0, {})
+    engine = asyncio.create_task(gossip.send_gossip())
+    while kvs.getDictValue(WRITE_KEY) is None:
+        await asyncio.sleep(POLL_INTERVAL)
+    arrivals.put(monotonic())
+    # Keep serving the others until they have it too, and until every
+    # engine has stopped, so none of them sees a peer go away
+    await asyncio.to_thread(stop.wait)
+    engine.cancel()
+    await asyncio.gather(engine, return_exceptions=True)
+    stopped.put(index)
+    await asyncio.to_thread(teardown.wait)
+    await runner.cleanup()
+
+
+def node(*args):
+    # Exchanges still running when an engine stops report the closed session;
+    # only the timings matter here
+    gossip.logger.setLevel(logging.CRITICAL)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        asyncio.run(runNode(*args))
+
+
+def secondsToConverge(node_count: int, fanout: int) -> float:
+    addresses, arrivals, stopped = Queue(), Queue(), Queue()
+    start, stop, teardown = Event(), Event(), Event()
+    pipes = [Pipe() for _ in range(node_count)]
+    processes = [Process(target=node, args=(index, fanout, addresses, pipes[index][1], start, stop, arrivals,
+                                            stopped, teardown))
+                 for index in range(node_count)]
+    for process in processes:
+        process.start()
+    view = [addresses.get() for _ in range(node_count)]
+    for parent_conn, _ in pipes:
+        parent_conn.send(view)
+    written = monotonic()
+    start.set()
+    converged = max(arrivals.get() for _ in range(node_count))
+    stop.set()
+    for _ in range(node_count):
+        stopped.get()
+    teardown.set()
+    for process in processes:
+        process.join()
+    return converged - written
+
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"Mean seconds to converge over {trials} trials (GOSSIP_MIN_INTERVAL {gossip.GOSSIP_MIN_INTERVAL}s, "
+          f"{os.cpu_count()} CPUs)")
+    print("nodes".rjust(6) + "".join(f"fanout {fanout}".rjust(12) for fanout in FANOUTS))
+    for node_count in NODE_COUNTS:
+        row = str(node_count).rjust(6)
+        for fanout in FANOUTS:
+            seconds = sum(secondsToConverge(node_count, fanout) for _ in range(trials)) / trials
+            row += f"{seconds:.3f}".rjust(12)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Contention benchmark for LocalKVS served through the KVS manager, the way
+# Flask workers use it. Each worker process connects to the manager and runs a
+# GET-heavy mix of single key operations on random keys, while a thread in the
+# server keeps taking full getDict() snapshots the way gossip does.
+#
+# Usage: python3 benchmark_local_database.py [keys] [seconds per run]
+# Prints operations/second against the number of concurrent workers for the
+# store as it was before lock striping (GlobalLockKVS), and for LocalKVS with a
+# single lock stripe and with LOCK_STRIPES.
+
+import sys
+import time
+from functools import partial
+from multiprocessing import Event, Lock, Process, Value
+from random import randint, random
+from threading import Thread
+
+from local_database import KVSManager, LocalKVS, LOCK_STRIPES
+
+BENCHMARK_PORT = 51299
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+PUT_RATIO = 0.1
+
+benchmark_kvs: LocalKVS | None = None
+
+
+class GlobalLockKVS:
+    def __init__(self):
+        """
+        The store before lock striping, for comparison: one plain dict behind
+        one lock that every operation takes, snapshots copying it whole.
+        """
+        self.kvs_dict: dict[str, tuple[str, int, dict[str, int]]] = {}
+        self.lock = Lock()
+
+    def setDictValue(self, key: str, value: str | None, timestamp: int, dependencies: dict[str, int] | None) -> bool:
+        with self.lock:
+            old_val = self.kvs_dict.get(key)
+            if dependencies is None:
+                dependencies = {}
+            dependencies.pop(key, None)
+            if old_val is None:
+                self.kvs_dict[key] = (value, timestamp, dependencies)
+                return False
+            if old_val[1] > timestamp:
+                return True
+            self.kvs_dict[key] = (value, timestamp, dependencies)
+            return True
+
+    def getDictValue(self, key: str) -> tuple[str, int, dict[str, int]] | None:
+        with self.lock:
+            return self.kvs_dict.get(key)
+
+    def setDict(self, val: dict[str, tuple[str, int, dict[str, int]]]) -> None:
+        with self.lock:
+            self.kvs_dict = val
+
+    def getDict(self) -> dict[str, tuple[str, int, dict[str, int]]]:
+        with self.lock:
+            return self.kvs_dict.copy()
+
+
+def getBenchmarkKVS() -> LocalKVS:
+    return benchmark_kvs
+
+
+def getBenchmarkManager() -> KVSManager:
+    manager = KVSManager(address=("127.0.0.1", BENCHMARK_PORT), authkey=b"")
+    manager.register("get", getBenchmarkKVS)
+    return manager
+
+
+def serve(make_kvs, key_count: int) -> None:
+    global benchmark_kvs
+    benchmark_kvs = make_kvs()
+    benchmark_kvs.setDict({f"key{i}": ("v" * 100, i, {f"key{i - 1}": i - 1}) for i in range(key_count)})
+    Thread(target=snapshotter, daemon=True).start()
+    getBenchmarkManager().get_server().serve_forever()
+
+
+def worker(key_count: int, start: Event, stop: Event, ops: Value) -> None:
+    manager = getBenchmarkManager()
+    manager.connect()
+    kvs = manager.get()
+    count = 0
+    start.wait()
+    while not stop.is_set():
+        key = f"key{randint(0, key_count - 1)}"
+        if random() < PUT_RATIO:
+            kvs.setDictValue(key, "w" * 100, time.time_ns(), {})
+        else:
+            kvs.getDictValue(key)
+        count += 1
+    with ops.get_lock():
+        ops.value += count
+
+
+def snapshotter() -> None:
+    # Runs inside the server: what matters is how long taking the copy holds up
+    # writers, not the cost of pickling it over the socket
+    while True:
+        benchmark_kvs.getDict()
+
+
+def run(make_kvs, worker_count: int, key_count: int, seconds: float) -> float:
+    """
+    :param make_kvs: creates the store to serve, in the server process
+    """
+    server = Process(target=serve, args=(make_kvs, key_count), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    start, stop = Event(), Event()
+    ops = Value("q", 0)
+    processes = [Process(target=worker, args=(key_count, start, stop, ops)) for _ in range(worker_count)]
+    for p in processes:
+        p.start()
+    time.sleep(.5)
+    start.set()
+    time.sleep(seconds)
+    stop.set()
+    for p in processes:
+        p.join()
+
+    server.kill()
+    server.join()
+    return ops.value / seconds
+
+
+def main():
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print(f"{key_count} keys, {seconds}s per run, {int(PUT_RATIO * 100)}% PUTs, one concurrent getDict() loop")
+    print(f"{'workers':>8} {'global lock ops/s':>18} {'1 stripe ops/s':>15} {f'{LOCK_STRIPES} stripes ops/s':>17}")
+    for worker_count in WORKER_COUNTS:
+        baseline = run(GlobalLockKVS, worker_count, key_count, seconds)
+        single = run(partial(LocalKVS, 1), worker_count, key_count, seconds)
+        striped = run(partial(LocalKVS, LOCK_STRIPES), worker_count, key_count, seconds)
+        print(f"{worker_count:>8} {baseline:>18.0f} {single:>15.0f} {striped:>17.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,13 +23,22 @@ Request.on_json_loading_failed = on_json_loading_failed
 
 @app.before_request
 def checkInitialization():
-    # PUTs and GETs to /kvs/admin/view are the only endpoints that are allowed
-    # to be accessed whether the node is initialized or not
+    # PUTs and GETs to /kvs/admin/view are allowed to be accessed whether the
+    # node is initialized or not
     if str(request.url_rule) == "/kvs/admin/view" and (request.method == "PUT" or request.method == "GET"):
         return
+    # A node bootstrapping into a new view needs to know whether we're empty
+    # even if we haven't been sent the view yet; the endpoint checks itself
+    if str(request.url_rule) == "/gossip/snapshot":
+        return
 
     view_manager = getViewManager()
     view_manager.connect()
 
     if not view_manager.get().isInitialized():
         return {"error": "uninitialized"}, 418
+
+    # Until gossip has pulled a copy of the store from the rest of the view,
+    # we'd answer clients from an incomplete one
+    if request.path.startswith("/kvs/data") and not view_manager.get().isReady():
+        return {"error": "not ready"}, 503
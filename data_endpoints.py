@@ -1,29 +1,157 @@
-from time import sleep, time_ns
+import asyncio
+import json
+import os
+from contextlib import aclosing
+from time import monotonic, time_ns
 
-from flask import request
+from flask import Response, request, stream_with_context
 from flask_app import app, our_address
-from modules.local_database import getKVSManager
+from modules.hash_ring import isPartitioned, ownersOf, stores
+from modules.hybrid_clock import MAX_CLOCK_DRIFT, TIMESTAMP_STEP
+from modules.local_database import getKVSManager, supportsVectorMode, validCursor
+from modules.sorted_index import prefixEnd
+from modules.vector_clock import fromDependencies, isVectorKey, isVectorMetadata, merge as mergeClock, toDependencies
 from modules.view_tracker import getViewManager
-from supporting_libs.requests_handler import KVSRequest, executeRequestsFork
-
-
-def broadcastToOtherNodes(timestamp) -> None:
-    # Don't broadcast if on messages that have already been broadcast by another node
-    endpoint = request.path
-    request_method = request.method
-    json_body = request.json
-    if json_body.get("dont_broadcast"):
-        return
-    requests = []
-    json_body["dont_broadcast"] = True
-    json_body["timestamp"] = timestamp
+from supporting_libs.requests_handler import KVSRequest, asyncExecuteRequests, asyncIterResponses, \
+    getReplicationSender
+
+# Seconds a causally dependent read may wait for the writes it depends on
+CAUSAL_WAIT_TIMEOUT = float(os.environ.get("CAUSAL_WAIT_TIMEOUT", 20))
+# Seconds to wait on peers when pulling missing writes before falling back to gossip
+PULL_TIMEOUT = 1
+# Where other nodes send us batches of client writes they accepted
+REPLICATION_ENDPOINT = "/kvs/replicate"
+BATCH_OPERATIONS = {"GET", "PUT", "DELETE"}
+# Keys read from the KVS per call when listing everything in one response or stream
+LIST_PAGE_SIZE = 1000
+# Most keys a single range or prefix scan looks at
+MAX_SCAN_LIMIT = 10000
+# Seconds to wait on a replica we forward a request to in partitioned mode; it
+# may itself wait up to CAUSAL_WAIT_TIMEOUT
+FORWARD_TIMEOUT = CAUSAL_WAIT_TIMEOUT + 5
+
+
+def getCurrentView() -> list[str]:
     view_manager = getViewManager()
     view_manager.connect()
-    view = view_manager.get().getView()
+    return view_manager.get().getView()
+
+
+def fromPeer(view: list[str]) -> bool:
+    """
+    :return: whether the request came from a node in view rather than a client
+    """
+    return any(request.remote_addr == node.split(":")[0] for node in view)
+
+
+def forwardRequest(keys: list[str]):
+    """
+    In partitioned mode, hand a request for keys we don't store to a node
+    that stores all of them, trying each in turn until one answers. A
+    replica that has just taken over a key may not have it yet, so a 404 is
+    only the answer once every replica has given it.
+    :return: that node's response, or None if we should serve the request
+             ourselves
+    """
+    view = getCurrentView()
+    # Only a peer gets to say it already forwarded the request; a client
+    # claiming so would have us serve keys we don't store
+    if not isPartitioned(view) or (request.json.get("forwarded") and fromPeer(view)):
+        return None
+    owners = set(view)
+    for key in keys:
+        owners.intersection_update(ownersOf(key, view))
+    if our_address in owners:
+        return None
+    if not owners:
+        return {"error": "keys are stored on different nodes"}, 400
+
+    body = dict(request.json, forwarded=True)
+    not_found = None
+    # Same order on every node, so requests for a key all go to the same replica first
+    for node in sorted(owners, key=ownersOf(keys[0], view).index):
+        forward = KVSRequest(node, request.path, request.method, body)
+        responses = asyncio.run(asyncExecuteRequests([forward], timeout=FORWARD_TIMEOUT, process_requests=True))
+        # Uninitialized or still bootstrapping, try the next one
+        if not responses or responses[0][0] in (418, 503):
+            continue
+        status, resp_json = responses[0]
+        if status == 404:
+            not_found = not_found or (resp_json, status)
+            continue
+        return resp_json, status
+    if not_found is not None:
+        return not_found
+    return {"error": "no node storing the key is available"}, 503
+
+
+def storedVersions(versions: dict[str, int], view: list[str]) -> dict[str, int]:
+    """
+    :return: the entries of versions for keys we store; in partitioned mode
+             the others never reach us, so waiting on them would never end
+    """
+    if not isPartitioned(view):
+        return versions
+    return {key: ver for key, ver in versions.items() if stores(our_address, key, view)}
+
+
+def broadcastToOtherNodes(writes: dict[str, tuple[str | None, int, dict[str, int]]]) -> None:
+    """
+    Replicate writes accepted from a client to every other node in the view
+    that stores their keys. The replication sender batches them with other
+    recent writes per peer and sends them to REPLICATION_ENDPOINT.
+    :param writes: key -> (value, timestamp, dependencies)
+    """
+    view = getCurrentView()
+
+    # Don't bother sending to ourselves
+    nodes = [node for node in view if node != our_address]
+    if len(nodes) == 0:
+        return
+    if not isPartitioned(view):
+        getReplicationSender().enqueueWrites(nodes, REPLICATION_ENDPOINT, writes)
+        return
+    per_node: dict[str, dict[str, tuple[str | None, int, dict[str, int]]]] = {}
+    for key, value_tuple in writes.items():
+        for node in ownersOf(key, view):
+            if node != our_address:
+                per_node.setdefault(node, {})[key] = value_tuple
+    for node, node_writes in per_node.items():
+        getReplicationSender().enqueueWrites([node], REPLICATION_ENDPOINT, node_writes)
+
+
+def pullFromPeers(kvs, versions: dict[str, int]) -> None:
+    """
+    Ask every other node in the view, in parallel, for the given keys at or
+    past the given versions, and apply whatever they send back. Returns as
+    soon as answers have covered every key rather than waiting on the rest.
+    Saves a blocked causal read from waiting for gossip to bring the writes to us.
+    :param kvs: LocalKVS (proxy) to apply the pulled writes to
+    :param versions: key -> minimum version we're missing
+    """
+    if len(versions) == 0:
+        return
+    view = getCurrentView()
+    requests = [KVSRequest(node, "/gossip/fetch", "PUT", {"keys": versions}) for node in view if node != our_address]
+    if len(requests) == 0:
+        return
+    asyncio.run(pullResponses(kvs, requests, versions))
+
 
-    # Don't bother generating a request to send to ourselves
-    requests.extend([KVSRequest(node, endpoint, request_method, json_body) for node in view if node != our_address])
-    executeRequestsFork(requests)
+async def pullResponses(kvs, requests: list[KVSRequest], versions: dict[str, int]) -> None:
+    missing = dict(versions)
+    async with aclosing(asyncIterResponses(requests, timeout=PULL_TIMEOUT)) as responses:
+        async for status, body in responses:
+            if status != 200 or not isinstance(body, dict):
+                continue
+            pulled = {key: value_tuple for key, value_tuple in body.items() if validWrite(value_tuple)}
+            if len(pulled) == 0:
+                continue
+            app.logger.debug(f"Pulled {len(pulled)} keys from a peer")
+            kvs.setDictValues(pulled)
+            missing = {key: ver for key, ver in missing.items() if key not in pulled or pulled[key][1] < ver}
+            if len(missing) == 0:
+                return
 
 
 def getConflictingKeys(client_dependencies: dict[str, int], key_dependencies: dict[str, int]) -> set[str]:
@@ -35,43 +163,160 @@ def getConflictingKeys(client_dependencies: dict[str, int], key_dependencies: di
     return conflicting_keys
 
 
+def readCausally(kvs, key: str, prev_metadata: dict[str, int], deadline: float,
+                 val_tuple: tuple[str, int, dict[str, int]] | None) -> tuple[bool, tuple | None]:
+    """
+    Make sure the version of key we return to a client is one it may read,
+    pulling from peers or waiting for gossip if it isn't yet.
+    :param kvs: LocalKVS (proxy) to read from
+    :param prev_metadata: the client's causal metadata
+    :param deadline: monotonic() time to give up at
+    :param val_tuple: what we currently have for key, if already fetched
+    :return: (False, None) on timeout, else (True, key's tuple or None if we don't have it)
+    """
+    # The client has seen a newer version than we have. Try to get it from our
+    # peers, and otherwise wait for it to reach us.
+    if key in prev_metadata and (val_tuple is None or val_tuple[1] < prev_metadata[key]):
+        pullFromPeers(kvs, {key: prev_metadata[key]})
+        val_tuple = kvs.waitForVersion(key, prev_metadata[key], max(deadline - monotonic(), 0))
+        if val_tuple is None or val_tuple[1] < prev_metadata[key]:
+            return False, None
+    if val_tuple is None:
+        return True, None
+
+    # The newest version conflicts with what the client has seen. Serve an
+    # older one that doesn't if we still have it, otherwise wait for a newer
+    # write that doesn't, first checking whether a peer already has one
+    if len(getConflictingKeys(prev_metadata, val_tuple[2])) != 0:
+        if (consistent := kvs.getConsistentValue(key, prev_metadata)) is not None:
+            return True, consistent
+        pullFromPeers(kvs, {key: val_tuple[1] + 1})
+        val_tuple = kvs.getDictValue(key)
+    while len(getConflictingKeys(prev_metadata, val_tuple[2])) != 0:
+        if (remaining := deadline - monotonic()) <= 0:
+            return False, None
+        val_tuple = kvs.waitForVersion(key, val_tuple[1] + 1, remaining)
+    return True, val_tuple
+
+
+def addToMetadata(prev_metadata: dict[str, int], key: str, ver: int, dependencies: dict[str, int]) -> None:
+    # add returned key to client's dependencies
+    prev_metadata[key] = ver
+    # also add the key's dependencies to the client's, overriding older values when necessary
+    for d_key, d_ver in dependencies.items():
+        if isVectorKey(d_key):
+            # written by a vector clock client, means nothing to this one
+            continue
+        if (client_ver := prev_metadata.get(d_key)) is not None:
+            prev_metadata[d_key] = max(client_ver, d_ver)
+        else:
+            prev_metadata[d_key] = d_ver
+
+
+def validVersion(version) -> bool:
+    """
+    :return: whether version could be a write's timestamp: an int no further
+             ahead of our clock than newTimestamp() ever goes
+    """
+    return type(version) is int and 0 <= version <= time_ns() + MAX_CLOCK_DRIFT
+
+
+def parseMetadata(metadata) -> dict | None:
+    """
+    :return: the causal metadata a client sent ({} for null), or None if it
+             isn't well formed; see validVersion()
+    """
+    if metadata is None:
+        return {}
+    versions = metadata["vc"] if isVectorMetadata(metadata) else metadata
+    if not isinstance(versions, dict) or not all(validVersion(ver) for ver in versions.values()):
+        return None
+    return metadata
+
+
+def validWrite(value_tuple) -> bool:
+    """
+    :return: whether value_tuple, from a peer, is a (value, timestamp,
+             dependencies) write we can apply. Unlike a client's versions, a
+             peer's timestamps may be as far ahead of our clock as its own
+             clock is: gossip would bring us the write anyway, and our clock
+             only follows it so far (see hybrid_clock.py).
+    """
+    if not isinstance(value_tuple, (list, tuple)) or len(value_tuple) != 3:
+        return False
+    value, timestamp, dependencies = value_tuple
+    return (value is None or isinstance(value, str)) and type(timestamp) is int and timestamp >= 0 and \
+        isinstance(dependencies, dict) and all(type(ver) is int and ver >= 0 for ver in dependencies.values())
+
+
+def pruneMetadata(metadata: dict[str, int], stable_cut: int) -> dict[str, int]:
+    """
+    Drop entries for versions every replica has already applied (see
+    LocalKVS.getStableCut()): depending on them can never hold anything up,
+    and leaving them in would grow client metadata and stored dependency dicts
+    with every key a client has ever touched.
+    """
+    if isVectorMetadata(metadata):
+        return {"vc": {node: ver for node, ver in metadata["vc"].items() if ver > stable_cut}}
+    return {key: ver for key, ver in metadata.items() if ver > stable_cut}
+
+
+def vectorMetadata(kvs, clock: dict[str, int]) -> dict:
+    """
+    :return: vector mode metadata for a client with clock that has read
+             from the whole store, e.g. by listing or scanning it
+    """
+    return {"vc": mergeClock(clock, kvs.getVector())}
+
+
+def waitForClient(kvs, prev_metadata: dict, deadline: float) -> bool:
+    """
+    waitForCausalCut() for metadata in either mode.
+    """
+    if not isVectorMetadata(prev_metadata):
+        return waitForCausalCut(kvs, prev_metadata, deadline)
+    return kvs.waitForVector(prev_metadata["vc"], our_address, max(deadline - monotonic(), 0)) and \
+        waitForCausalCut(kvs, {}, deadline)
+
+
 @app.route("/kvs/data/<key>", methods=["GET"])
 def getKey(key: str):
     if not request.is_json or "causal-metadata" not in request.json.keys():
         return {"error": "bad request"}, 400
-    prev_metadata = request.json.get("causal-metadata")
-    if prev_metadata is None:
-        prev_metadata = {}
+    if (forwarded := forwardRequest([key])) is not None:
+        return forwarded
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
+        return {"error": "bad request"}, 400
+    if isVectorMetadata(prev_metadata) and not supportsVectorMode():
+        return {"error": "vector clock metadata isn't supported by this node's KVS backend"}, 400
 
     kvs_manager = getKVSManager()
     kvs_manager.connect()
-
-    val_tuple = kvs_manager.get().getDictValue(key)
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    deadline = monotonic() + CAUSAL_WAIT_TIMEOUT
+
+    if isVectorMetadata(prev_metadata):
+        # Once we have every write the client's clock covers, whatever we
+        # have for key is at least as new as anything it has seen of it
+        clock = prev_metadata["vc"]
+        if not kvs.waitForVector(clock, our_address, CAUSAL_WAIT_TIMEOUT):
+            return {"error": "timed out while waiting for depended updates", "causal-metadata": prev_metadata}, 500
+        if (val_tuple := kvs.getDictValue(key)) is None:
+            return {"causal-metadata": prev_metadata}, 404
+        mergeClock(clock, fromDependencies(val_tuple[2]))
+        if val_tuple[0] is None:
+            return {"causal-metadata": prev_metadata}, 404
+        return {"causal-metadata": prev_metadata, "val": val_tuple[0]}, 200
+
+    in_time, val_tuple = readCausally(kvs, key, prev_metadata, deadline, kvs.getDictValue(key))
+    if not in_time:
+        return {"error": "timed out while waiting for depended updates", "causal-metadata": prev_metadata}, 500
     if val_tuple is None:
         return {"causal-metadata": prev_metadata}, 404
     val, ver, dependencies = val_tuple
 
-    conflicting_keys = getConflictingKeys(prev_metadata, dependencies)
-    if key in prev_metadata or len(conflicting_keys) != 0:
-        i = 0
-        # Wait for update to save us
-        while i < 20 and (ver < prev_metadata[key] or len(conflicting_keys) != 0):
-            sleep(1)
-            val, ver, dependencies = kvs_manager.get().getDictValue(key)
-            conflicting_keys = getConflictingKeys(prev_metadata, dependencies)
-            i += 1
-
-        if ver < prev_metadata[key] or len(conflicting_keys) != 0:
-            return {"error": "timed out while waiting for depended updates", "causal-metadata": prev_metadata}, 500
-
-    # add returned key to client's dependencies
-    prev_metadata[key] = ver
-    # also add the key's dependencies to the client's, overriding older values when necessary
-    for d_key, d_ver in dependencies.items():
-        if (client_ver := prev_metadata.get(d_key)) is not None:
-            prev_metadata[d_key] = max(client_ver, d_ver)
-        else:
-            prev_metadata[d_key] = d_ver
+    addToMetadata(prev_metadata, key, ver, dependencies)
     # I believe we are supposed to return 404 on deleted keys?
     if val is None:
         return {"causal-metadata": prev_metadata}, 404
@@ -81,101 +326,389 @@ def getKey(key: str):
 @app.route("/kvs/data/<key>", methods=["PUT"])
 def putKey(key: str):
     if not request.is_json or not (val := request.json.get("val")) or \
-            "causal-metadata" not in request.json.keys():
+            "causal-metadata" not in request.json.keys() or isVectorKey(key):
+        return {"error": "bad request"}, 400
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
         return {"error": "bad request"}, 400
-    prev_metadata = request.json.get("causal-metadata")
-    if prev_metadata is None:
-        prev_metadata = {}
+    if isVectorMetadata(prev_metadata) and not supportsVectorMode():
+        return {"error": "vector clock metadata isn't supported by this node's KVS backend"}, 400
 
     app.logger.debug(f"putKey: key {key} with prev_metadata {prev_metadata}")
 
     if len(val) > 8000:
         return {"error": "val too large"}, 400
-
-    if (timestamp := request.json.get("timestamp")) is None:
-        timestamp = time_ns()
-        broadcastToOtherNodes(timestamp)
+    if (forwarded := forwardRequest([key])) is not None:
+        return forwarded
 
     kvs_manager = getKVSManager()
     kvs_manager.connect()
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    if isVectorMetadata(prev_metadata):
+        return writeVector(kvs, key, val, prev_metadata["vc"])
 
-    app.logger.debug(f"putKey current dict {kvs_manager.get().getDict()}")
-    replaced = kvs_manager.get().setDictValue(key, val, timestamp, prev_metadata)
-    app.logger.debug(f"putKey new dict {kvs_manager.get().getDict()}")
+    if (timestamp := request.json.get("timestamp")) is not None and not validVersion(timestamp):
+        return {"error": "bad request"}, 400
+    if timestamp is None:
+        dependencies = {d_key: d_ver for d_key, d_ver in prev_metadata.items() if d_key != key}
+        timestamp, replaced = kvs.setOwnValue(key, val, max(prev_metadata.values(), default=0), dependencies)
+        # Only writes straight from a client get broadcast; replicated ones
+        # already carry the timestamp the original node gave them
+        broadcastToOtherNodes({key: (val, timestamp, dependencies)})
+    else:
+        replaced = kvs.setDictValue(key, val, timestamp, prev_metadata)
     prev_metadata[key] = timestamp
     app.logger.debug(f"putKey returning metadata {prev_metadata}")
     return {"causal-metadata": prev_metadata}, 200 if replaced else 201
 
 
+def writeVector(kvs, key: str, val: str | None, clock: dict[str, int]):
+    """
+    PUT or DELETE (val None) for a vector mode client. The write depends on
+    the client's whole clock and advances our own entry in it.
+    """
+    timestamp, replaced = kvs.setOwnVectorValue(key, val, clock, our_address)
+    clock[our_address] = timestamp
+    broadcastToOtherNodes({key: (val, timestamp, toDependencies(clock))})
+    return {"causal-metadata": {"vc": clock}}, 200 if replaced else 201
+
+
 @app.route("/kvs/data/<key>", methods=["DELETE"])
 def deleteKey(key: str):
-    if not request.is_json or "causal-metadata" not in request.json.keys():
+    if not request.is_json or "causal-metadata" not in request.json.keys() or isVectorKey(key):
         return {"error": "bad request"}, 400
-    prev_metadata = request.json.get("causal-metadata")
-
-    if (timestamp := request.json.get("timestamp")) is None:
-        timestamp = time_ns()
-        broadcastToOtherNodes(timestamp)
+    if (forwarded := forwardRequest([key])) is not None:
+        return forwarded
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
+        return {"error": "bad request"}, 400
+    if isVectorMetadata(prev_metadata) and not supportsVectorMode():
+        return {"error": "vector clock metadata isn't supported by this node's KVS backend"}, 400
 
     kvs_manager = getKVSManager()
     kvs_manager.connect()
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    if isVectorMetadata(prev_metadata):
+        return writeVector(kvs, key, None, prev_metadata["vc"])
 
-    replaced = kvs_manager.get().removeDictValue(key, timestamp, prev_metadata)
+    if (timestamp := request.json.get("timestamp")) is not None and not validVersion(timestamp):
+        return {"error": "bad request"}, 400
+    if timestamp is None:
+        dependencies = {d_key: d_ver for d_key, d_ver in prev_metadata.items() if d_key != key}
+        timestamp, replaced = kvs.setOwnValue(key, None, max(prev_metadata.values(), default=0), dependencies)
+        broadcastToOtherNodes({key: (None, timestamp, dependencies)})
+    else:
+        replaced = kvs.removeDictValue(key, timestamp, prev_metadata)
     return {"causal-metadata": {key: timestamp}}, 200 if replaced else 201
 
 
-def existsMissingDependencies(current_kvs: dict[str, tuple[str, int, dict[str, int]]]) -> bool:
-    for key, (val, ver, dependencies) in current_kvs.items():
-        for d_key, d_ver in dependencies.items():
-            if d_key not in current_kvs:
-                return True
-            elif d_ver > current_kvs[d_key][1]:
-                return True
-    return False
+def parseBatchOperations(operations) -> list[dict] | None:
+    """
+    :return: operations if they are a valid batch, else None
+    """
+    if not isinstance(operations, list):
+        return None
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPERATIONS or \
+                not isinstance(operation.get("key"), str):
+            return None
+        if operation["op"] == "PUT" and (not isinstance(operation.get("val"), str) or not operation["val"]):
+            return None
+    return operations
+
+
+@app.route("/kvs/data", methods=["POST"])
+def batchData():
+    """
+    Several GETs, PUTs and DELETEs in one request, with one set of causal
+    metadata. Operations take effect in order, so a GET sees a PUT or DELETE
+    of the same key earlier in the batch, and each write depends on
+    everything before it.
+    Request body:
+        operations:      [{"op": "GET" | "PUT" | "DELETE", "key": key, "val": val for PUTs}]
+        causal-metadata: as for single key requests, per key mode only
+    Response body:
+        results:         [{"key": key, "status": status as for the single key
+                          request, "val": val for successful GETs}], in order
+        causal-metadata: metadata covering every operation in the batch
+    """
+    if not request.is_json or "causal-metadata" not in request.json.keys() or \
+            (operations := parseBatchOperations(request.json.get("operations"))) is None:
+        return {"error": "bad request"}, 400
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
+        return {"error": "bad request"}, 400
+    if isVectorMetadata(prev_metadata) or any(isVectorKey(operation["key"]) for operation in operations):
+        return {"error": "bad request"}, 400
+    if any(len(operation.get("val") or "") > 8000 for operation in operations):
+        return {"error": "val too large"}, 400
+    # In partitioned mode, a batch has to go to a node storing all its keys
+    if operations and (forwarded := forwardRequest([operation["key"] for operation in operations])) is not None:
+        return forwarded
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    deadline = monotonic() + CAUSAL_WAIT_TIMEOUT
+
+    # One round trip for everything we're asked to read
+    current = kvs.getDictValues(list({op["key"] for op in operations if op["op"] == "GET"}))
+    metadata = dict(prev_metadata)
+    writes: dict[str, tuple[str | None, int, dict[str, int]]] = {}
+    results = []
+    # Until the batch's writes are applied, peers mustn't take our frontier
+    # past them (see LocalKVS.reserveTimestamps())
+    base_timestamp = kvs.reserveTimestamps(max(prev_metadata.values(), default=0), len(operations))
+    try:
+        for i, operation in enumerate(operations):
+            key = operation["key"]
+            if operation["op"] == "GET":
+                if (val_tuple := writes.get(key)) is None:
+                    in_time, val_tuple = readCausally(kvs, key, metadata, deadline, current[key])
+                    if not in_time:
+                        return {"error": "timed out while waiting for depended updates",
+                                "causal-metadata": prev_metadata}, 500
+                    current[key] = val_tuple
+                if val_tuple is None:
+                    results.append({"key": key, "status": 404})
+                    continue
+                val, ver, dependencies = val_tuple
+                addToMetadata(metadata, key, ver, dependencies)
+                if val is None:
+                    results.append({"key": key, "status": 404})
+                else:
+                    results.append({"key": key, "status": 200, "val": val})
+            else:
+                # Later operations in the batch must win over earlier ones
+                timestamp = base_timestamp + i * TIMESTAMP_STEP
+                val = operation["val"] if operation["op"] == "PUT" else None
+                status = 200 if key in writes else None
+                writes[key] = (val, timestamp,
+                               {d_key: d_ver for d_key, d_ver in metadata.items() if d_key != key})
+                metadata[key] = timestamp
+                results.append({"key": key, "status": status})
+
+        if len(writes) != 0:
+            broadcastToOtherNodes(writes)
+            replaced = kvs.setDictValues(writes)
+            for result in results:
+                if result["status"] is None:
+                    result["status"] = 200 if replaced[result["key"]] else 201
+    finally:
+        kvs.releaseTimestamps(base_timestamp)
+
+    return {"results": results, "causal-metadata": metadata}, 200
+
+
+@app.route(REPLICATION_ENDPOINT, methods=["PUT"])
+def putReplicatedWrites():
+    """
+    Receive a batch of writes another node accepted from its clients.
+    Request body: {"writes": {key: (value, timestamp, dependencies)}}, where
+    a value of None is a delete. A malformed write doesn't hold up the rest
+    of the batch: we apply those and answer 400 with the keys we "rejected".
+    """
+    if not request.is_json or not isinstance(writes := request.json.get("writes"), dict):
+        return {"error": "bad request"}, 400
+    rejected = [key for key, value_tuple in writes.items() if not validWrite(value_tuple)]
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs_manager.get().setDictValues({key: value_tuple for key, value_tuple in writes.items() if key not in rejected})
+    if rejected:
+        return {"error": "bad request", "rejected": rejected}, 400
+    return {}, 200
+
+
+def waitForCausalCut(kvs, prev_metadata: dict[str, int], deadline: float) -> bool:
+    """
+    Wait until we've seen everything the client has, then until every
+    dependency of what we have has arrived too, so that anything we read from
+    the store afterwards is causally consistent. Whatever we're missing, try
+    pulling from our peers before waiting on gossip.
+    :return: False if that didn't happen by deadline
+    """
+    view = getCurrentView()
+    prev_metadata = storedVersions(prev_metadata, view)
+    current = kvs.getDictValues(list(prev_metadata))
+    pullFromPeers(kvs, {key: ver for key, ver in prev_metadata.items()
+                        if current[key] is None or current[key][1] < ver})
+    if not kvs.waitForVersions(prev_metadata, max(deadline - monotonic(), 0)):
+        return False
+    while len(missing := storedVersions(kvs.getMissingDependencies(), view)) != 0:
+        app.logger.debug(f"Waiting for missing dependencies {missing}")
+        pullFromPeers(kvs, missing)
+        if (remaining := deadline - monotonic()) <= 0 or not kvs.waitForVersions(missing, remaining):
+            return False
+    return True
 
 
 @app.route("/kvs/data", methods=["GET"])
 def getData():
+    """
+    List every key we hold, once we've caught up with the client's metadata.
+    In partitioned mode that's only the keys this node stores.
+    Optional body fields:
+        page-size: return at most this many keys' worth of the listing, along
+                   with a "cursor" to send back for the next page (null at the end)
+        cursor:    where the previous page left off
+    A listing that can't be finished any more as a consistent snapshot (it
+    took longer than the versions we keep, or the store was replaced) gets a
+    410; the client has to start it over.
+        stream:    if true, stream the whole listing as newline delimited JSON
+                   (see streamKeys) instead of building one response
+    """
     if not request.is_json or "causal-metadata" not in request.json.keys():
         return {"error": "bad request"}, 400
+    page_size = request.json.get("page-size")
+    cursor = request.json.get("cursor")
+    if page_size is not None and (type(page_size) is not int or page_size <= 0):
+        return {"error": "bad request"}, 400
+    if cursor is not None and not validCursor(cursor):
+        return {"error": "bad request"}, 400
 
-    prev_metadata = request.json.get("causal-metadata")
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
+        return {"error": "bad request"}, 400
+    if isVectorMetadata(prev_metadata) and not supportsVectorMode():
+        return {"error": "vector clock metadata isn't supported by this node's KVS backend"}, 400
     kvs_manager = getKVSManager()
     kvs_manager.connect()
-    data = kvs_manager.get().getDict()
-    keys = list(data.keys())
-
-    # This is dumb, but I can't think of a better way to do this rn
-    # (where are C style for-loops when you need them...)
-    has_conflict = True
-    missing_dependencies = existsMissingDependencies(data)
-    i = 0
-    while i < 20 and (has_conflict or missing_dependencies):
-        app.logger.debug(f"Waiting because (has_conflict = {has_conflict} or missing_dependencies "
-                         f"= {missing_dependencies})")
-        has_conflict = False
-        for key, client_ver in prev_metadata.items():
-            if key not in data or client_ver > data[key][1]:
-                has_conflict = True
-        if not has_conflict:
-            break
-        sleep(1)
-        data = kvs_manager.get().getDict()
-        missing_dependencies = existsMissingDependencies(data)
-        i += 1
-    if has_conflict or missing_dependencies:
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    deadline = monotonic() + CAUSAL_WAIT_TIMEOUT
+
+    if not waitForClient(kvs, prev_metadata, deadline):
         return {"error": "timed out while waiting for depended updates", "causal-metadata": prev_metadata}, 500
+    if isVectorMetadata(prev_metadata):
+        # Covering the whole store covers any page of it
+        prev_metadata = vectorMetadata(kvs, prev_metadata["vc"])
+
+    if request.json.get("stream", False):
+        return Response(stream_with_context(streamKeys(kvs, prev_metadata)), mimetype="application/x-ndjson")
+
+    if page_size is not None:
+        try:
+            page, next_cursor = kvs.listKeys(cursor, page_size)
+        except ValueError as e:
+            return {"error": str(e)}, 410
+        return {"count": len(page), "keys": list(page), "cursor": next_cursor,
+                "causal-metadata": mergeVersions(prev_metadata, page)}
+
+    keys = []
+    next_cursor = None
+    while True:
+        try:
+            page, next_cursor = kvs.listKeys(next_cursor, LIST_PAGE_SIZE)
+        except ValueError as e:
+            return {"error": str(e)}, 410
+        keys.extend(page)
+        mergeVersions(prev_metadata, page)
+        if next_cursor is None:
+            break
+    return {"count": len(keys), "keys": keys, "causal-metadata": prev_metadata}
+
+
+def mergeVersions(metadata: dict, versions: dict[str, int]) -> dict:
+    if isVectorMetadata(metadata):
+        return metadata
+    for key, ver in versions.items():
+        metadata[key] = max(ver, metadata.get(key, ver))
+    return metadata
+
+
+def streamKeys(kvs, prev_metadata: dict[str, int]):
+    """
+    Yield every key as newline delimited JSON, one line per page read from
+    the KVS: {"keys": [...], "causal-metadata": {key: version}}, then a
+    final {"count": n, "causal-metadata": prev_metadata}. Nothing but the
+    current page is held in memory. Pages carry no metadata of their own for
+    vector mode clients, prev_metadata already covers them. The status has
+    long been sent by the time a listing could expire, so that ends the
+    stream with an {"error": ...} line instead.
+    """
+    vector = isVectorMetadata(prev_metadata)
+    count = 0
+    cursor = None
+    while True:
+        try:
+            page, cursor = kvs.listKeys(cursor, LIST_PAGE_SIZE)
+        except ValueError as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        if len(page) != 0:
+            count += len(page)
+            yield json.dumps({"keys": list(page)} if vector else {"keys": list(page), "causal-metadata": page}) + "\n"
+        if cursor is None:
+            break
+    yield json.dumps({"count": count, "causal-metadata": prev_metadata}) + "\n"
+
+
+@app.route("/kvs/data/scan/range", methods=["GET"])
+def scanRange():
+    """
+    Read every key from start up to (not including) end, in key order.
+    Body: {"causal-metadata", "start", optional "end" (default: no upper
+    bound), optional "limit" (default and maximum MAX_SCAN_LIMIT)}.
+    Responds with {"count", "kvs": {key: val}, "next", "causal-metadata"}; if
+    "next" isn't null there's more, starting from that key.
+    """
+    if not request.is_json or "causal-metadata" not in request.json.keys() or \
+            type(request.json.get("start")) is not str:
+        return {"error": "bad request"}, 400
+    return scanKeys(request.json["start"], request.json.get("end"))
+
+
+@app.route("/kvs/data/scan/prefix", methods=["GET"])
+def scanPrefix():
+    """
+    Read every key starting with prefix, in key order. Body: {"causal-metadata",
+    "prefix", optional "start" to carry on from a previous response's "next",
+    optional "limit"}. Responds the same way as /kvs/data/scan/range.
+    """
+    if not request.is_json or "causal-metadata" not in request.json.keys() or \
+            type(request.json.get("prefix")) is not str:
+        return {"error": "bad request"}, 400
+    prefix = request.json["prefix"]
+    start = request.json.get("start", prefix)
+    if type(start) is not str or not start.startswith(prefix):
+        return {"error": "bad request"}, 400
+    return scanKeys(start, prefixEnd(prefix))
 
-    return_metadata = {}
-    for key, (val, ver, dependencies) in data.items():
-        return_metadata[key] = ver
-        # Don't return deleted vals
-        for d_key, d_ver in dependencies.items():
-            if return_metadata.get(key) is not None:
-                return_metadata[key] = max(d_ver, return_metadata[key])
-            else:
-                return_metadata[key] = d_ver
-        if val is None:
-            keys.pop(key)
 
-    return {"count": len(keys), "keys": keys, "causal-metadata": "TODO"}
+def scanKeys(start: str, end: str | None):
+    limit = request.json.get("limit", MAX_SCAN_LIMIT)
+    if (end is not None and type(end) is not str) or type(limit) is not int or not 0 < limit <= MAX_SCAN_LIMIT:
+        return {"error": "bad request"}, 400
+    if (prev_metadata := parseMetadata(request.json.get("causal-metadata"))) is None:
+        return {"error": "bad request"}, 400
+    if isVectorMetadata(prev_metadata) and not supportsVectorMode():
+        return {"error": "vector clock metadata isn't supported by this node's KVS backend"}, 400
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+    prev_metadata = pruneMetadata(prev_metadata, kvs.getStableCut())
+    deadline = monotonic() + CAUSAL_WAIT_TIMEOUT
+
+    if not waitForClient(kvs, prev_metadata, deadline):
+        return {"error": "timed out while waiting for depended updates", "causal-metadata": prev_metadata}, 500
+    entries, next_key = kvs.scanKeys(start, end, limit)
+    response_kvs = {}
+    for key, (val, ver, dependencies) in entries.items():
+        response_kvs[key] = val
+        if not isVectorMetadata(prev_metadata):
+            addToMetadata(prev_metadata, key, ver, dependencies)
+    if isVectorMetadata(prev_metadata):
+        prev_metadata = vectorMetadata(kvs, prev_metadata["vc"])
+    return {"count": len(response_kvs), "kvs": response_kvs, "next": next_key, "causal-metadata": prev_metadata}
+
+
+@app.route("/kvs/admin/stats", methods=["GET"])
+def getStats():
+    """
+    How many keys hold a value and how many are deletes whose tombstones
+    haven't been garbage collected yet.
+    """
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    return kvs_manager.get().getEntryCounts(), 200
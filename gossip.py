@@ -1,20 +1,49 @@
 import asyncio
-import json
 import os
 import time
 import logging
 
-from random import randint
+from random import sample
 
 import aiohttp
 
-from local_database import getKVSManager, KVSManager
+from hash_ring import isPartitioned, stores
+from local_database import getKVSManager, LocalKVS
+from merkle_tree import MERKLE_DEPTH, MerkleTree
 from view_tracker import getViewManager
 
-from supporting_libs.requests_handler import KVSRequest, asyncExecuteRequests
+from supporting_libs.requests_handler import KVSRequest
 
 GOSSIP_ENDPOINT = "/gossip"
+MERKLE_ENDPOINT = "/gossip/merkle"
+MERKLE_BUCKETS_ENDPOINT = "/gossip/merkle/buckets"
+SNAPSHOT_ENDPOINT = "/gossip/snapshot"
+# How many tree levels to descend per request when looking for differences
+MERKLE_LEVELS_PER_REQUEST = 4
+# Do a hash tree check instead of a delta round every this many rounds with a peer
+MERKLE_CHECK_ROUNDS = 20
 GOSSIP_REQUEST_METHOD = "PUT"
+# Seconds between rounds while there's something to spread; each round
+# exchanges with GOSSIP_FANOUT peers. While replicas agree the interval backs
+# off by GOSSIP_BACKOFF every round, up to GOSSIP_MAX_INTERVAL.
+GOSSIP_MIN_INTERVAL = float(os.environ.get("GOSSIP_MIN_INTERVAL", 0.1))
+GOSSIP_MAX_INTERVAL = float(os.environ.get("GOSSIP_MAX_INTERVAL", 2))
+GOSSIP_BACKOFF = 2
+GOSSIP_FANOUT = int(os.environ.get("GOSSIP_FANOUT", 2))
+# Seconds before a single gossip request fails
+GOSSIP_TIMEOUT = 5
+# Most exchanges, each with a different peer, running at once
+GOSSIP_CONCURRENCY = max(4, 2 * GOSSIP_FANOUT)
+# Keep-alive connections kept open to each peer
+GOSSIP_CONNECTIONS_PER_PEER = 2
+# Most entries we send, or ask for, in a single gossip request
+GOSSIP_CHUNK_SIZE = int(os.environ.get("GOSSIP_CHUNK_SIZE", 1000))
+# A joining node splits the hash tree buckets into this many ranges per peer
+# it copies from, so faster peers end up copying more of them
+BOOTSTRAP_RANGES_PER_PEER = 4
+# Seconds a bootstrapping node keeps trying a peer it can't reach before
+# counting it as having nothing to copy, so one down node can't keep us out
+BOOTSTRAP_UNREACHABLE_TIMEOUT = float(os.environ.get("BOOTSTRAP_UNREACHABLE_TIMEOUT", 15))
 MY_ADDRESS = os.environ.get("ADDRESS")
 
 logger = logging.getLogger(__name__)
@@ -22,72 +51,432 @@ logging.basicConfig(format="[%(asctime)s] %(levelname)s in %(funcName)s: %(messa
 logger.setLevel(logging.DEBUG)
 
 
+class PeerState:
+    def __init__(self):
+        """
+        What we know about how up to date a peer is, for delta and hash tree gossip.
+        """
+        # Our change log position the peer has acknowledged
+        self.acked_epoch: str | None = None
+        self.acked_seq = 0
+        # The peer's change log position we have applied
+        self.peer_epoch: str | None = None
+        self.peer_seq = 0
+        # Entries the peer sent us last round; they come back out of our change
+        # log as changes, but there's no point sending them back
+        self.received: dict[str, int] = {}
+        # Gossip rounds we've had with this peer, for scheduling hash tree checks
+        self.rounds = 0
+        # Whether the last exchange found anything either of us was missing
+        self.diverged = False
+        # The peer's origin frontier as of the last exchange: we have every
+        # write it accepted up to here once that exchange is done
+        self.origin_frontier = 0
+
+
+peer_states: dict[str, PeerState] = {}
+# When each peer a bootstrap couldn't reach first failed, by time.monotonic()
+unreachable_since: dict[str, float] = {}
+
+
+async def requestPeer(node: str, endpoint: str, json_body: dict, current_view: list[str],
+                      session: aiohttp.ClientSession, accept: tuple[int, ...] = (200, 201)) -> dict | None:
+    """
+    Send a single gossip request to node.
+    :param accept: response statuses whose body the caller wants
+    :return: the response body, or None if the node failed or didn't accept it
+    """
+    response = await KVSRequest(node, endpoint, GOSSIP_REQUEST_METHOD, json_body).executeRequest(session)
+    if response is None:
+        return None
+    try:
+        resp_status = response.status
+        resp_json = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Reading gossip response from {node} failed: {e!r}")
+        return None
+    finally:
+        # Give the connection back to the pool
+        response.release()
+    if resp_status == 418:
+        # They haven't seen the light! (they lack critical info (send them view))
+        logger.info(f"Telling node {node} the our current view ({current_view}")
+        response = await KVSRequest(node, "/kvs/admin/view", "PUT",
+                                    {"view": current_view, "bootstrap": True}).executeRequest(session)
+        if response is not None:
+            response.release()
+        return None
+    elif resp_status not in accept:
+        logger.error(f"Gossip endpoint returned weird status! ({resp_status}")
+        return None
+    return resp_json
+
+
+async def deltaSync(node: str, current_view: list[str], peer_state: PeerState, kvs: LocalKVS,
+                    session: aiohttp.ClientSession) -> bool:
+    """
+    Exchange only what changed on either side since our last exchange with
+    node, at most GOSSIP_CHUNK_SIZE entries each way per request, until
+    neither side has more to send. Every chunk is applied as it arrives and
+    moves peer_state along, so a failed exchange picks up where it stopped.
+    :return: whether the exchange went through
+    """
+    peer_state.diverged = False
+    received: dict[str, int] = {}
+    ours_complete = theirs_complete = False
+    delta = {}
+    while not (ours_complete and theirs_complete):
+        if not ours_complete:
+            # Only send what changed since the peer last acknowledged; a new
+            # epoch on either side (restart or reset) falls back to a full sync
+            my_epoch, my_seq, changes, ours_complete = await asyncio.to_thread(
+                kvs.getChangePage, peer_state.acked_seq, peer_state.acked_epoch, GOSSIP_CHUNK_SIZE)
+            delta = {key: value_tuple for key, value_tuple in changes.items()
+                     if peer_state.received.get(key) != value_tuple[1] and received.get(key) != value_tuple[1]
+                     and stores(node, key, current_view)}
+        else:
+            # Still pulling the peer's backlog; ours has all gone
+            delta = {}
+
+        json_body = {}
+        json_body["kvs"] = delta
+        json_body["origin"] = MY_ADDRESS
+        json_body["epoch"] = my_epoch
+        json_body["seq"] = my_seq
+        json_body["peer_epoch"] = peer_state.peer_epoch
+        json_body["since"] = peer_state.peer_seq
+        json_body["limit"] = GOSSIP_CHUNK_SIZE
+        json_body["frontiers"] = await asyncio.to_thread(kvs.updateFrontiers, {})
+
+        if (resp_json := await requestPeer(node, GOSSIP_ENDPOINT, json_body, current_view, session)) is None:
+            return False
+        await asyncio.to_thread(kvs.updateFrontiers, resp_json.get("frontiers", {}), current_view)
+        if resp_json["kvs"]:
+            logger.info(f"Gossip returned {len(resp_json['kvs'])} new values from {node}")
+            await asyncio.to_thread(kvs.setDictValues, resp_json["kvs"])
+
+        sent_everything = peer_state.acked_epoch != my_epoch
+        peer_was_reset = peer_state.peer_epoch is not None and resp_json["epoch"] != peer_state.peer_epoch
+        if peer_was_reset and not sent_everything:
+            # Whatever we sent the peer before it restarted is gone, start over
+            peer_state.acked_epoch = None
+            ours_complete = False
+        else:
+            peer_state.acked_epoch = my_epoch
+            peer_state.acked_seq = my_seq
+        peer_state.peer_epoch = resp_json["epoch"]
+        peer_state.peer_seq = resp_json["seq"]
+        theirs_complete = resp_json.get("complete", True)
+        # The last page's frontier holds: that page brings us up to date
+        peer_state.origin_frontier = resp_json.get("origin_frontier", 0)
+        received.update((key, value_tuple[1]) for key, value_tuple in resp_json["kvs"].items())
+        peer_state.diverged = peer_state.diverged or bool(delta) or bool(resp_json["kvs"])
+    peer_state.received = received
+    return True
+
+
+async def merkleSync(node: str, current_view: list[str], peer_state: PeerState, kvs: LocalKVS,
+                     session: aiohttp.ClientSession) -> bool:
+    """
+    Reconcile with node by comparing hash trees top down, then exchanging only
+    the buckets that differ. Costs a single small request when we agree.
+    :return: whether the exchange went through
+    """
+    # Both sides' positions from before the comparison: anything that changes
+    # during it is picked up by the next delta round
+    my_epoch, my_seq = await asyncio.to_thread(kvs.getChangePosition)
+    json_body = {"hashes": await asyncio.to_thread(kvs.getMerkleHashes, [1]),
+                 "frontiers": await asyncio.to_thread(kvs.updateFrontiers, {})}
+    if (resp_json := await requestPeer(node, MERKLE_ENDPOINT, json_body, current_view, session)) is None:
+        return False
+    await asyncio.to_thread(kvs.updateFrontiers, resp_json.get("frontiers", {}), current_view)
+    peer_epoch, peer_seq = resp_json["epoch"], resp_json["seq"]
+    # Anything written before the comparison shows up in the differing buckets
+    origin_frontier = resp_json.get("origin_frontier", 0)
+
+    frontier = resp_json["differing"]
+    level = 0
+    while frontier and level < MERKLE_DEPTH:
+        step = min(MERKLE_LEVELS_PER_REQUEST, MERKLE_DEPTH - level)
+        nodes = MerkleTree.descendants(frontier, step)
+        json_body = {"hashes": await asyncio.to_thread(kvs.getMerkleHashes, nodes)}
+        if (resp_json := await requestPeer(node, MERKLE_ENDPOINT, json_body, current_view, session)) is None:
+            return False
+        frontier = resp_json["differing"]
+        level += step
+
+    buckets = [leaf - (1 << MERKLE_DEPTH) for leaf in frontier]
+    if buckets:
+        logger.debug(f"Merkle sync with {node}: {len(buckets)} buckets differ")
+    # A chunk of buckets at a time, as many as fit in GOSSIP_CHUNK_SIZE
+    # entries on our side. The peer may cover fewer of them if it has more in
+    # there; we send the rest again with the next chunk.
+    while buckets:
+        entries, covered = await asyncio.to_thread(kvs.getBucketPage, buckets, GOSSIP_CHUNK_SIZE)
+        json_body = {"buckets": buckets[:covered], "kvs": entries, "limit": GOSSIP_CHUNK_SIZE}
+        if (resp_json := await requestPeer(node, MERKLE_BUCKETS_ENDPOINT, json_body, current_view,
+                                           session)) is None:
+            return False
+        await asyncio.to_thread(kvs.setDictValues, resp_json["kvs"])
+        buckets = buckets[resp_json.get("covered", covered):]
+
+    peer_state.acked_epoch = my_epoch
+    peer_state.acked_seq = my_seq
+    peer_state.peer_epoch = peer_epoch
+    peer_state.peer_seq = peer_seq
+    peer_state.received = {}
+    peer_state.diverged = bool(frontier)
+    peer_state.origin_frontier = origin_frontier
+    return True
+
+
 async def sendGossip(
+        node: str,
         current_view: list[str],
-        current_kvs: dict[str, tuple[str, int, dict[str, int]]],
-        kvs_manager: KVSManager
-) -> float:
-    random_node = current_view[randint(0, len(current_view) - 1)]
+        kvs: LocalKVS,
+        session: aiohttp.ClientSession
+) -> bool:
+    """
+    One exchange with node. Only one runs per peer at a time, which is what
+    keeps its PeerState consistent.
+    :return: whether it found anything either side was missing
+    """
+    peer_state = peer_states.setdefault(node, PeerState())
+    peer_state.rounds += 1
+    my_epoch, _ = await asyncio.to_thread(kvs.getChangePosition)
+
+    start_time = time.time_ns()
+    # A peer we've never synced with (or that has been reset since) would need
+    # a full copy of the store from a delta round; the hash trees find what it
+    # is actually missing instead. Every so often we also double check peers
+    # we're in sync with, in case a delta got lost.
+    # In partitioned mode two nodes' trees cover different keys and never
+    # match, so a full sync is a delta round from the start of the change log.
+    if not isPartitioned(current_view) and (
+            peer_state.acked_epoch != my_epoch or peer_state.peer_epoch is None or
+            peer_state.rounds % MERKLE_CHECK_ROUNDS == 0):
+        synced = await merkleSync(node, current_view, peer_state, kvs, session)
+    else:
+        synced = await deltaSync(node, current_view, peer_state, kvs, session)
+    if synced:
+        # The peer told us how far its own clock got with writes it has
+        # finished, so no wall clocks are compared here or in our frontier
+        await asyncio.to_thread(kvs.updateOriginFrontier, node, peer_state.origin_frontier)
+        await asyncio.to_thread(kvs.updateOwnFrontier, MY_ADDRESS, current_view)
 
-    while random_node == MY_ADDRESS:
-        random_node = current_view[randint(0, len(current_view) - 1)]
+    logger.debug(f"Gossip with {node} finished in {(time.time_ns() - start_time) * pow(10, -9):.3f}s")
+    return synced and peer_state.diverged
 
-    json_body = {}
-    json_body["kvs"] = current_kvs
-    json_body["origin"] = MY_ADDRESS
 
-    requests = [KVSRequest(random_node, GOSSIP_ENDPOINT, GOSSIP_REQUEST_METHOD, json_body)]
-    start_time = time.time_ns()
-    response_list: list[tuple[int, dict]] = await asyncExecuteRequests(requests, timeout=GOSSIP_INTERVAL,
-                                                                       process_requests=True)
-    if len(response_list) != 0:
-        resp_status, resp_json = response_list[0]
-        if resp_status == 418:
-            # They haven't seen the light! (they lack critical info (send them view))
-            logger.info(f"Telling node {random_node} the our current view ({current_view}")
-            await asyncExecuteRequests([KVSRequest(random_node, "/kvs/admin/view", "PUT", {"view": current_view})])
-        elif resp_status == 200 or resp_status == 201:
-            for key, (val, ver, timestamp) in resp_json.items():
-                logger.info(f"Gossip returned new value {key}: {(val, ver, timestamp)}")
-                kvs_manager.get().setDictValue(key, val, ver, timestamp)
-        else:
-            logger.error(f"Gossip endpoint returned weird status! ({resp_status}")
+def resetPeerStates(old_view: list[str], new_view: list[str]) -> None:
+    """
+    In partitioned mode a view change hands keys to new owners, which never
+    got them from us: we only sent each peer the keys it stored. Forget what
+    every peer has acknowledged, so the next delta round sends it everything
+    it stores now.
+    """
+    if not isPartitioned(old_view) and not isPartitioned(new_view):
+        return
+    logger.info("View changed, resyncing every peer")
+    for peer_state in peer_states.values():
+        peer_state.acked_epoch = None
+
+
+async def copyRanges(node: str, ranges: asyncio.Queue, positions: dict[str, tuple[str, int]],
+                     empty_peers: set[str], current_view: list[str], kvs: LocalKVS,
+                     session: aiohttp.ClientSession) -> bool:
+    """
+    Copy (start, end) bucket ranges off ranges from node, a chunk at a time,
+    until there are none left. Records node's change log position from
+    before we read anything of it in positions, or node in empty_peers if it
+    isn't ready to serve us and has nothing to serve anyway, or we haven't
+    been able to reach it for BOOTSTRAP_UNREACHABLE_TIMEOUT.
+    :return: False if node couldn't or wouldn't serve us; what's left of its
+             range goes back on the queue
+    """
+    while True:
+        try:
+            start, end = ranges.get_nowait()
+        except asyncio.QueueEmpty:
+            return True
+        while start is not None:
+            json_body = {"start": start, "end": end, "limit": GOSSIP_CHUNK_SIZE, "origin": MY_ADDRESS}
+            resp_json = await requestPeer(node, SNAPSHOT_ENDPOINT, json_body, current_view, session,
+                                          accept=(200, 503))
+            if resp_json is None:
+                failed_at = unreachable_since.setdefault(node, time.monotonic())
+                if time.monotonic() - failed_at >= BOOTSTRAP_UNREACHABLE_TIMEOUT:
+                    logger.info(f"Giving up on {node} for bootstrap, counting it as empty")
+                    empty_peers.add(node)
+            else:
+                unreachable_since.pop(node, None)
+            if resp_json is None or "error" in resp_json:
+                if resp_json is not None and resp_json.get("entries") == 0:
+                    empty_peers.add(node)
+                ranges.put_nowait((start, end))
+                return False
+            positions.setdefault(node, (resp_json["epoch"], resp_json["seq"]))
+            if resp_json["kvs"]:
+                await asyncio.to_thread(kvs.setDictValues, resp_json["kvs"])
+            start = resp_json["next"]
 
-    end_time = time.time_ns()
-    execute_time = (end_time - start_time) * pow(10, -9)
-    time_to_sleep = GOSSIP_INTERVAL - execute_time
-    if time_to_sleep < 0:
-        time_to_sleep = 0
 
-    logger.debug(f"Gossip finished, returning time_to_sleep = {time_to_sleep}")
-    return time_to_sleep
+async def bootstrap(current_view: list[str], kvs: LocalKVS, session: aiohttp.ClientSession) -> bool:
+    """
+    Bring a node that just joined the view up to date before it serves
+    clients. Every peer that is ready itself copies ranges of the store to us
+    in parallel. Then a delta round with each of them, from the position it
+    had before we read anything of it, picks up what it was written since.
+    That leaves us with everything every one of them had as of that round.
+    :return: whether we're done: everything was copied, or every peer has
+             nothing to copy, by its own account or because it has been
+             unreachable for too long
+    """
+    peers = sources = [node for node in current_view if node != MY_ADDRESS]
+    bucket_count = 1 << MERKLE_DEPTH
+    range_count = max(len(sources), 1) * BOOTSTRAP_RANGES_PER_PEER
+    ranges = asyncio.Queue()
+    for i in range(range_count):
+        ranges.put_nowait((bucket_count * i // range_count, bucket_count * (i + 1) // range_count))
+    positions: dict[str, tuple[str, int]] = {}
+    empty_peers: set[str] = set()
 
+    # A range a failing peer gives back may be left once the rest have
+    # finished, so go again with whoever is still serving us
+    while sources and not ranges.empty():
+        served = await asyncio.gather(*[copyRanges(node, ranges, positions, empty_peers, current_view, kvs,
+                                                   session) for node in sources])
+        sources = [node for node, ok in zip(sources, served) if ok]
+    if not positions and empty_peers.issuperset(peers):
+        logger.info("No peer has anything to bootstrap from, starting out empty")
+        unreachable_since.clear()
+        return True
+    if not ranges.empty():
+        # Peers we haven't been able to reach for long, or that are catching
+        # up themselves, may well have data; try again rather than serve from
+        # an empty store
+        logger.info("Bootstrap incomplete, retrying")
+        return False
 
-GOSSIP_INTERVAL = 0.5
+    my_epoch, my_seq = await asyncio.to_thread(kvs.getChangePosition)
+    for node, (epoch, seq) in positions.items():
+        peer_state = peer_states.setdefault(node, PeerState())
+        # Everything we have came from our peers, there's nothing to send back
+        peer_state.acked_epoch, peer_state.acked_seq = my_epoch, my_seq
+        peer_state.peer_epoch, peer_state.peer_seq = epoch, seq
+    caught_up = await asyncio.gather(*[deltaSync(node, current_view, peer_states[node], kvs, session)
+                                       for node in positions])
+    if not all(caught_up):
+        return False
+    logger.info(f"Bootstrapped from {list(positions)}")
+    unreachable_since.clear()
+    return True
 
 
-async def send_gossip():
+def choosePeers(view: list[str], busy, fanout: int) -> list[str]:
     """
-    For every GOSSIP_INTERVAL seconds, send the node's KVS contents and vector clock to a random node in the current view.
+    :param busy: peers we're already exchanging with
+    :return: up to fanout distinct peers from view, picked at random,
+             leaving out ourselves and busy peers
+    """
+    idle_peers = [node for node in view if node != MY_ADDRESS and node not in busy]
+    return sample(idle_peers, min(fanout, len(idle_peers)))
+
+
+class GossipPacer:
+    def __init__(self):
+        """
+        Picks the time between gossip rounds: GOSSIP_MIN_INTERVAL while there
+        are recent writes here or exchanges keep finding differences, backing
+        off towards GOSSIP_MAX_INTERVAL while all replicas agree.
+        """
+        self.interval = GOSSIP_MIN_INTERVAL
+        self.active = False
+        self.position: tuple[str, int] | None = None
+
+    def exchangeDone(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        if (e := task.exception()) is not None:
+            logger.error(f"Gossip exchange failed: {e!r}")
+        elif task.result():
+            self.active = True
+
+    def nextInterval(self, position: tuple[str, int]) -> float:
+        """
+        :param position: our change log position now; it moves on every write
+                         we apply, from clients, replication or gossip
+        """
+        if self.active or position != self.position:
+            self.interval = GOSSIP_MIN_INTERVAL
+        else:
+            self.interval = min(self.interval * GOSSIP_BACKOFF, GOSSIP_MAX_INTERVAL)
+        self.active = False
+        self.position = position
+        return self.interval
+
 
-    Return: return_description
+async def send_gossip():
+    """
+    Every round, start exchanging KVS changes with GOSSIP_FANOUT random nodes
+    in the current view that we aren't already exchanging with, up to
+    GOSSIP_CONCURRENCY exchanges at once, so one slow peer doesn't hold up the
+    rest. GossipPacer decides how long a round is. A node that has just
+    joined a view bootstraps before it starts any. All exchanges share one
+    HTTP session, keeping connections to each peer alive between rounds. KVS
+    and view calls are blocking round trips to their manager processes, so
+    they run in worker threads.
     """
     view_manager = getViewManager()
     view_manager.connect()
     kvs_manager = getKVSManager()
     kvs_manager.connect()
+    view_tracker = view_manager.get()
+    kvs = kvs_manager.get()
+    in_flight: dict[str, asyncio.Task] = {}
+    pacer = GossipPacer()
+    last_view: list[str] | None = None
 
-    while True:
-        if view_manager.get().isInitialized():
-            view = view_manager.get().getView()
-
-            kvs = kvs_manager.get().getDict()
-
-            if view and len(kvs) != 0:
-                time_to_sleep = await sendGossip(view, kvs, kvs_manager)
-                time.sleep(time_to_sleep)
-            else:
-                time.sleep(GOSSIP_INTERVAL)
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=GOSSIP_TIMEOUT),
+        connector=aiohttp.TCPConnector(limit_per_host=GOSSIP_CONNECTIONS_PER_PEER),
+    ) as session:
+        while True:
+            # Waiting to be initialized or bootstrapped isn't idling: check
+            # again as soon as we would for a write
+            interval = GOSSIP_MIN_INTERVAL
+            if await asyncio.to_thread(view_tracker.isInitialized):
+                view = await asyncio.to_thread(view_tracker.getView)
+                if view != last_view:
+                    # Exchanges still running would acknowledge what they
+                    # sent under the old view after we've reset it
+                    if in_flight:
+                        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+                    if last_view is not None:
+                        resetPeerStates(last_view, view or [])
+                    last_view = view
+                    # A peer down while we bootstrapped into the last view
+                    # gets another chance in this one
+                    unreachable_since.clear()
+                if not await asyncio.to_thread(view_tracker.isReady):
+                    # No exchanges until we're bootstrapped: they'd race
+                    # bootstrap() for peer_states. Any left over from before
+                    # we were last uninitialized have to finish first.
+                    if in_flight:
+                        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+                    if await bootstrap(view or [], kvs, session):
+                        await asyncio.to_thread(view_tracker.setReady, True)
+                else:
+                    # Gossip even with an empty store: the exchange is a delta in both
+                    # directions, so it's also how we pull what we're missing
+                    fanout = min(GOSSIP_FANOUT, GOSSIP_CONCURRENCY - len(in_flight))
+                    for node in choosePeers(view or [], in_flight, fanout):
+                        task = asyncio.create_task(sendGossip(node, view, kvs, session))
+                        in_flight[node] = task
+                        task.add_done_callback(lambda _, node=node: in_flight.pop(node, None))
+                        task.add_done_callback(pacer.exchangeDone)
+                    interval = pacer.nextInterval(await asyncio.to_thread(kvs.getChangePosition))
+            await asyncio.sleep(interval)
 
 
 def main():
@@ -1,62 +1,198 @@
 from flask_app import app
 from flask import request
+from modules.hash_ring import stores
+from modules.hybrid_clock import versionOrder
 from modules.local_database import getKVSManager
+from modules.view_tracker import getViewManager
 
 VALUE = 0
 TIMESTAMP = 1
 DEPENDENCY_LIST = 2
+# Most entries we return for a single gossip request, whatever the sender asks for
+MAX_GOSSIP_CHUNK = 10000
 
 
 @app.route("/gossip", methods=["PUT"])
 def putGossip():
-    response_body = {}
-    response_status_code = 200
-
     request_body = request.json
-    gossiped_node = request_body["origin"]
+    if "epoch" in request_body:
+        return putDeltaGossip(request_body)
+
     gossiped_node_kvs = request_body["kvs"]
 
     kvs_manager = getKVSManager()
     kvs_manager.connect()
+    kvs = kvs_manager.get()
 
-    my_kvs = kvs_manager.get().getDict()
-
-    missing_keys_in_my_kvs = gossiped_node_kvs.keys() - my_kvs.keys()
-    missing_keys_in_gossiped_node = my_kvs.keys() - gossiped_node_kvs.keys()
-    intersection = my_kvs.keys() & gossiped_node_kvs.keys()
-
-    if missing_keys_in_my_kvs:
-        response_status_code = 201
-
-    for key in missing_keys_in_my_kvs:
-        # format: Tuple(value, timestamp, dependency list)
-        value_tuple = gossiped_node_kvs[key]
-        app.logger.info(f"gossip: Adding missing key {key} with val {value_tuple}")
-        kvs_manager.get().setDictValue(
-            key,
-            value_tuple[VALUE],
-            value_tuple[TIMESTAMP],
-            value_tuple[DEPENDENCY_LIST],
-        )
-
-    for key in intersection:
-        my_value_tuple = my_kvs[key]
-        gossiped_node_value_tuple = gossiped_node_kvs[key]
-
-        if my_value_tuple[TIMESTAMP] < gossiped_node_value_tuple[TIMESTAMP]:
-            app.logger.info(f"gossip: Overriding old key {key} with val {gossiped_node_value_tuple}")
-            kvs_manager.get().setDictValue(
-                key,
-                gossiped_node_value_tuple[VALUE],
-                gossiped_node_value_tuple[TIMESTAMP],
-                gossiped_node_value_tuple[DEPENDENCY_LIST],
-            )
-
-            response_status_code = 201
-        elif my_value_tuple[TIMESTAMP] > gossiped_node_value_tuple[TIMESTAMP]:
-            response_body[key] = my_value_tuple
-
-    for key in missing_keys_in_gossiped_node:
+    my_kvs = kvs.getDict()
+    # Applies whatever of theirs is newer and gives back whatever of ours is
+    # newer, in one round trip to the manager rather than one per key
+    changed, response_body = kvs.mergeEntries(gossiped_node_kvs)
+    response_status_code = 201 if changed else 200
+
+    for key in my_kvs.keys() - gossiped_node_kvs.keys():
         response_body[key] = my_kvs[key]
-    
+
     return response_body, response_status_code
+
+
+def putDeltaGossip(request_body: dict):
+    """
+    Delta gossip: rather than whole stores, both sides only exchange what
+    changed since the last exchange between them, a chunk at a time.
+    Request body:
+        origin:     address of the sender
+        kvs:        a chunk of the entries the sender changed since we last
+                    acknowledged, oldest first
+        epoch, seq: the sender's change log position as of kvs
+        peer_epoch, since: our change log position the sender is up to date with
+        limit:      most entries to respond with
+        frontiers:  what the sender knows of each node's frontier, see
+                    LocalKVS.updateFrontiers()
+    Response body:
+        kvs:        the oldest of the entries we changed since `since` that the
+                    sender doesn't already have (starting from scratch if
+                    peer_epoch isn't our epoch), and stores if partitioned
+        epoch, seq: our change log position as of kvs
+        complete:   whether kvs brings the sender up to date; if not, it asks
+                    again from seq
+        frontiers:  what we know of each node's frontier
+        origin_frontier: LocalKVS.getOriginFrontier() from before kvs was read;
+                    once complete, the sender has all of the writes we
+                    accepted up to it
+    """
+    gossiped_node_kvs = request_body["kvs"]
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+
+    changed, _ = kvs.mergeEntries(gossiped_node_kvs)
+    response_status_code = 201 if changed else 200
+
+    # Take our delta after applying theirs so our seq covers what they just
+    # sent; the timestamp check keeps us from echoing those entries back
+    limit = min(request_body.get("limit", MAX_GOSSIP_CHUNK), MAX_GOSSIP_CHUNK)
+    # Before reading the page: every write it covers then reaches the sender
+    origin_frontier = kvs.getOriginFrontier()
+    my_epoch, my_seq, my_changes, complete = kvs.getChangePage(request_body["since"], request_body["peer_epoch"],
+                                                               limit)
+    frontiers = kvs.updateFrontiers(request_body.get("frontiers", {}))
+    view_manager = getViewManager()
+    view_manager.connect()
+    view = view_manager.get().getView()
+    response_kvs = {}
+    for key, my_value_tuple in my_changes.items():
+        if not stores(request_body["origin"], key, view):
+            continue
+        if key not in gossiped_node_kvs or versionOrder(gossiped_node_kvs[key]) < versionOrder(my_value_tuple):
+            response_kvs[key] = my_value_tuple
+
+    return {"kvs": response_kvs, "epoch": my_epoch, "seq": my_seq, "complete": complete,
+            "frontiers": frontiers, "origin_frontier": origin_frontier}, response_status_code
+
+
+@app.route("/gossip/fetch", methods=["PUT"])
+def fetchKeys():
+    """
+    Lets a peer pull specific keys it is blocked on instead of waiting for
+    gossip to deliver them. Request body: {"keys": {key: minimum version}}.
+    Only returns keys we have at or past the requested version.
+    """
+    if not request.is_json or not isinstance(requested_versions := request.json.get("keys"), dict):
+        return {"error": "bad request"}, 400
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+
+    # One round trip to the manager for all of them
+    value_tuples = kvs_manager.get().getDictValues(list(requested_versions))
+    response_body = {}
+    for key, version in requested_versions.items():
+        value_tuple = value_tuples[key]
+        if value_tuple is not None and type(version) is int and value_tuple[TIMESTAMP] >= version:
+            response_body[key] = value_tuple
+
+    return response_body, 200
+
+
+@app.route("/gossip/merkle", methods=["PUT"])
+def compareMerkle():
+    """
+    First half of hash tree anti-entropy. Request body: {"hashes": {node: hash}}
+    from the sender's tree, plus its "frontiers" as for delta gossip. Responds
+    with the nodes where ours differs, our change log position so the sender
+    can switch to delta gossip afterwards, our frontiers, and our
+    "origin_frontier" as for delta gossip.
+    """
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+
+    origin_frontier = kvs.getOriginFrontier()
+    epoch, seq = kvs.getChangePosition()
+    differing = kvs.compareMerkleHashes(request.json["hashes"])
+    frontiers = kvs.updateFrontiers(request.json.get("frontiers", {}))
+    return {"differing": differing, "epoch": epoch, "seq": seq, "frontiers": frontiers,
+            "origin_frontier": origin_frontier}, 200
+
+
+@app.route("/gossip/merkle/buckets", methods=["PUT"])
+def exchangeBuckets():
+    """
+    Second half of hash tree anti-entropy, once the sender has narrowed things
+    down to the buckets that differ. Request body: {"buckets": [bucket],
+    "kvs": sender's entries in those buckets, "limit": most entries to respond
+    with}. Applies the newer of theirs and responds with {"kvs": ours that the
+    sender is missing or has older, "covered": how many of the buckets, in
+    order, kvs covers}; the sender sends the rest again.
+    """
+    gossiped_node_kvs = request.json["kvs"]
+    limit = min(request.json.get("limit", MAX_GOSSIP_CHUNK), MAX_GOSSIP_CHUNK)
+
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+
+    my_entries, covered = kvs.getBucketPage(request.json["buckets"], limit)
+    changed, _ = kvs.mergeEntries(gossiped_node_kvs)
+    response_status_code = 201 if changed else 200
+    response_kvs = {}
+    for key, my_value_tuple in my_entries.items():
+        if key not in gossiped_node_kvs or versionOrder(gossiped_node_kvs[key]) < versionOrder(my_value_tuple):
+            response_kvs[key] = my_value_tuple
+
+    return {"kvs": response_kvs, "covered": covered}, response_status_code
+
+
+@app.route("/gossip/snapshot", methods=["PUT"])
+def getSnapshotPage():
+    """
+    Bulk copy of our store for a node joining the view, by hash tree bucket.
+    Request body: {"start": first bucket, "end": bucket to stop before,
+    "limit": most entries to respond with, "origin": address of the sender}.
+    Responds with {"kvs": entries in buckets from start on that the sender
+    stores, "next": bucket to ask for next time, or None once
+    we reach end, "epoch", "seq": our change log position from before we read
+    any of kvs}. If we aren't initialized or are still catching up ourselves,
+    answers 503 with {"error", "entries": how many entries we hold}, so the
+    sender can tell a new cluster from one it can't copy yet.
+    """
+    view_manager = getViewManager()
+    view_manager.connect()
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs = kvs_manager.get()
+    if not view_manager.get().isReady():
+        return {"error": "not ready", "entries": sum(kvs.getEntryCounts().values())}, 503
+
+    start, end = request.json["start"], request.json["end"]
+    limit = min(request.json.get("limit", MAX_GOSSIP_CHUNK), MAX_GOSSIP_CHUNK)
+
+    epoch, seq = kvs.getChangePosition()
+    entries, covered = kvs.getBucketPage(range(start, end), limit)
+    view = view_manager.get().getView()
+    entries = {key: value_tuple for key, value_tuple in entries.items()
+               if stores(request.json.get("origin"), key, view)}
+    next_bucket = start + covered if start + covered < end else None
+    return {"kvs": entries, "next": next_bucket, "epoch": epoch, "seq": seq}, 200
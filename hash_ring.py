@@ -0,0 +1,67 @@
+# Consistent hashing of keys onto the nodes in the view, for partitioned mode.
+#
+# By default every node stores every key. With REPLICATION_FACTOR set to n,
+# smaller than the view, each key is stored only on the n nodes that follow
+# its hash clockwise on a ring, so capacity and write throughput grow with
+# the number of nodes. Each node sits on the ring at VIRTUAL_NODES points, so
+# its share of the keys is even, and adding or removing a node only moves
+# the keys next to its points.
+#
+# Every node builds the same ring from the same view, so they all agree on
+# who stores what without talking to each other.
+
+import os
+from bisect import bisect_right
+from functools import lru_cache
+from hashlib import blake2b
+
+REPLICATION_FACTOR = int(os.environ.get("REPLICATION_FACTOR", 0))
+VIRTUAL_NODES = 64
+
+
+def _point(name: str) -> int:
+    return int.from_bytes(blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
+class HashRing:
+    def __init__(self, nodes: list[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.node_count = len(set(nodes))
+        ring = sorted((_point(f"{node}#{i}"), node) for node in set(nodes) for i in range(virtual_nodes))
+        self.points = [point for point, _ in ring]
+        self.nodes = [node for _, node in ring]
+
+    def owners(self, key: str, count: int) -> list[str]:
+        """
+        :return: the count distinct nodes storing key, in ring order
+        """
+        count = min(count, self.node_count)
+        owners = []
+        index = bisect_right(self.points, _point(key))
+        while len(owners) < count:
+            node = self.nodes[index % len(self.nodes)]
+            if node not in owners:
+                owners.append(node)
+            index += 1
+        return owners
+
+
+@lru_cache(maxsize=8)
+def _ringFor(view: tuple[str, ...]) -> HashRing:
+    return HashRing(list(view))
+
+
+def isPartitioned(view: list[str]) -> bool:
+    return 0 < REPLICATION_FACTOR < len(view)
+
+
+def ownersOf(key: str, view: list[str]) -> list[str]:
+    """
+    :return: the nodes in view that store key; all of them unless partitioned
+    """
+    if not isPartitioned(view):
+        return view
+    return _ringFor(tuple(sorted(view))).owners(key, REPLICATION_FACTOR)
+
+
+def stores(node: str, key: str, view: list[str]) -> bool:
+    return not isPartitioned(view) or node in ownersOf(key, view)
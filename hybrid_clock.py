@@ -0,0 +1,61 @@
+# Hybrid logical clock timestamps for writes, shared by every KVS backend.
+#
+# A node issues timestamps that are never behind its wall clock and always
+# past every timestamp it has issued or seen, so a write orders after what it
+# follows however far its wall clock is behind another node's. The low
+# NODE_ID_BITS of every timestamp a node issues are its node id, so two nodes
+# never issue the same timestamp for different writes however close their
+# clocks are.
+#
+# Node ids come from a hash of the node's address and two nodes can share one,
+# so last-writer-wins still breaks ties between equal timestamps the same way
+# everywhere; see versionOrder().
+
+import os
+from hashlib import blake2b
+from time import time_ns
+
+# Furthest ahead of the wall clock (ns) a clock follows the timestamps it
+# sees, so one bogus timestamp can't run it off into the future
+MAX_CLOCK_DRIFT = 60 * 10 ** 9
+NODE_ID_BITS = 10
+# Gap between consecutive timestamps issued by one node
+TIMESTAMP_STEP = 1 << NODE_ID_BITS
+
+
+def nodeId(address: str | None) -> int:
+    if address is None:
+        return 0
+    return int.from_bytes(blake2b(address.encode(), digest_size=8).digest(), "little") % TIMESTAMP_STEP
+
+
+NODE_ID = nodeId(os.environ.get("ADDRESS"))
+
+
+def nextTimestamp(clock: int, observed: int, node_id: int) -> int:
+    """
+    :param clock: newest timestamp issued or seen
+    :param observed: newest timestamp the client writing has seen; only
+                     followed up to MAX_CLOCK_DRIFT ahead of the wall clock
+    :return: the first timestamp past both that is node_id's to issue
+    """
+    now = time_ns()
+    timestamp = max(now, clock + 1, min(observed, now + MAX_CLOCK_DRIFT) + 1)
+    return timestamp + (node_id - timestamp) % TIMESTAMP_STEP
+
+
+def observe(clock: int, timestamp: int) -> int:
+    """
+    :return: clock once it has seen timestamp, which it follows only up to
+             MAX_CLOCK_DRIFT ahead of the wall clock
+    """
+    return max(clock, min(timestamp, time_ns() + MAX_CLOCK_DRIFT))
+
+
+def versionOrder(val_tuple: tuple[str | None, int, dict[str, int]]) -> tuple[int, bool, str]:
+    """
+    :return: sort key for last-writer-wins between (value, timestamp,
+             dependencies) tuples: the newer timestamp wins, and on a tie a
+             delete, then the greater value
+    """
+    return val_tuple[1], val_tuple[0] is None, "" if val_tuple[0] is None else str(val_tuple[0])
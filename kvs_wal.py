@@ -0,0 +1,209 @@
+# Crash recovery for LocalKVS: an append-only write-ahead log of every
+# setDictValue/removeDictValue plus periodic snapshots of the whole dict.
+#
+# On disk, a data directory holds
+#   snapshot.pickle       (first WAL segment not covered, dict contents)
+#   wal.<segment>.log     records of (u32 length, u32 crc32, pickled record)
+#
+# Recovery loads the snapshot and replays every segment from the one it names
+# onwards. A torn record at the tail of the last segment (crash mid-write) is
+# detected by its length/crc and ignored.
+
+import os
+import pickle
+import struct
+import threading
+import zlib
+from time import sleep
+from typing import Iterator
+
+RECORD_HEADER = struct.Struct("<II")
+SNAPSHOT_FILE = "snapshot.pickle"
+
+# "always":   a write returns only once it is fsynced. Concurrent writers share
+#             one fsync (group commit).
+# "batch":    fsync once every batch_size records
+# "interval": fsync from a background thread every interval seconds
+FSYNC_POLICIES = {"always", "batch", "interval"}
+
+
+def _segmentName(segment: int) -> str:
+    return f"wal.{segment:010d}.log"
+
+
+def _listSegments(directory: str) -> list[int]:
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("wal.") and name.endswith(".log"):
+            segments.append(int(name[4:-4]))
+    return sorted(segments)
+
+
+class WriteAheadLog:
+    def __init__(self, directory: str, fsync_policy: str = "batch", batch_size: int = 128, interval: float = 0.05):
+        """
+        Open a WAL in directory, starting a fresh segment after any existing ones.
+        :param directory: directory for the log segments; created if missing
+        :param fsync_policy: one of FSYNC_POLICIES
+        :param batch_size: records per fsync for the "batch" policy
+        :param interval: seconds between background fsyncs for "batch" and "interval"
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {str(FSYNC_POLICIES)}!")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.cond = threading.Condition()
+        self.buffer: list[bytes] = []
+        # sequence numbers of the last record appended and last one made durable
+        self.next_seq = 0
+        self.durable_seq = 0
+        self.flushing = False
+
+        existing = _listSegments(directory)
+        self.segment = existing[-1] + 1 if existing else 0
+        self.file = open(os.path.join(directory, _segmentName(self.segment)), "ab")
+
+        self.closed = False
+        if fsync_policy != "always":
+            threading.Thread(target=self._syncDaemon, daemon=True).start()
+
+    def append(self, record: tuple) -> int:
+        """
+        Buffer a record. Cheap enough to call while holding the KVS lock; the
+        caller should call waitDurable() with the result after releasing it.
+        :return: sequence number of the record
+        """
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.cond:
+            self.buffer.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.next_seq += 1
+            return self.next_seq
+
+    def waitDurable(self, seq: int) -> None:
+        """
+        Block as long as the fsync policy requires for record seq.
+        """
+        if self.fsync_policy == "always":
+            self.sync(seq)
+        elif self.fsync_policy == "batch" and seq - self.durable_seq >= self.batch_size:
+            self.sync()
+
+    def sync(self, seq: int | None = None) -> None:
+        """
+        Write and fsync buffered records, at least up to seq (default: all).
+        Whichever caller gets here first becomes the leader and flushes
+        everything buffered so far; the others just wait for it.
+        """
+        with self.cond:
+            target = self.next_seq if seq is None else seq
+            while self.durable_seq < target:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                data = b"".join(self.buffer)
+                self.buffer.clear()
+                flushed_seq = self.next_seq
+                file = self.file
+                self.cond.release()
+                written = False
+                try:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    written = True
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    if written:
+                        self.durable_seq = flushed_seq
+                    self.cond.notify_all()
+
+    def rotate(self) -> int:
+        """
+        Make everything logged so far durable and start a new segment.
+        :return: the new segment number; everything before it may be discarded
+                 once a snapshot covering it is on disk
+        """
+        self.sync()
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            # anything appended since sync() belongs in the old segment too
+            self.file.write(b"".join(self.buffer))
+            self.buffer.clear()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.durable_seq = self.next_seq
+            self.file.close()
+            self.segment += 1
+            self.file = open(os.path.join(self.directory, _segmentName(self.segment)), "ab")
+            return self.segment
+
+    def removeSegmentsBefore(self, segment: int) -> None:
+        for old_segment in _listSegments(self.directory):
+            if old_segment < segment:
+                os.remove(os.path.join(self.directory, _segmentName(old_segment)))
+
+    def close(self) -> None:
+        self.sync()
+        with self.cond:
+            self.closed = True
+            self.file.close()
+
+    def _syncDaemon(self) -> None:
+        while not self.closed:
+            sleep(self.interval)
+            if self.durable_seq < self.next_seq and not self.closed:
+                self.sync()
+
+
+def replay(directory: str, from_segment: int) -> Iterator[tuple]:
+    """
+    Yield every intact record in segments >= from_segment, oldest first.
+    """
+    for segment in _listSegments(directory):
+        if segment < from_segment:
+            continue
+        with open(os.path.join(directory, _segmentName(segment)), "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                # torn write at the tail, nothing after it can be trusted
+                break
+            yield pickle.loads(payload)
+            offset += RECORD_HEADER.size + length
+
+
+def writeSnapshot(directory: str, contents: dict, next_segment: int) -> None:
+    """
+    Atomically replace the snapshot in directory.
+    :param contents: dict contents as of the start of next_segment
+    :param next_segment: first WAL segment that is *not* reflected in contents
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((next_segment, contents), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def loadSnapshot(directory: str) -> tuple[dict, int]:
+    """
+    :return: (contents, first WAL segment to replay on top of them)
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return {}, 0
+    with open(path, "rb") as f:
+        next_segment, contents = pickle.load(f)
+    return contents, next_segment
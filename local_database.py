@@ -4,21 +4,726 @@
 # within a Flask application.
 # https://stackoverflow.com/questions/28423069/store-large-data-or-a-service-connection-per-flask-session/28426819#28426819
 
-from multiprocessing import Lock, Process
+import os
+import sys
+from bisect import bisect_right
+from collections.abc import MutableMapping
+from contextlib import ExitStack, contextmanager
 from multiprocessing.managers import BaseManager
-from time import sleep
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep, time_ns
+from uuid import uuid4
+
+from hybrid_clock import NODE_ID, TIMESTAMP_STEP, nextTimestamp, observe, versionOrder
+from kvs_wal import WriteAheadLog, loadSnapshot, replay, writeSnapshot
+from merkle_tree import MerkleTree
+from segment_store import SegmentStore
+from shared_kvs import SharedKVSManager
+from sorted_index import SortedKeys
+from vector_clock import fromDependencies, isVectorKey, toDependencies
+
+# "manager" serves LocalKVS from this process over a BaseManager socket,
+# "shared_memory" has every Flask worker map the store directly (see shared_kvs.py)
+KVS_BACKEND = os.environ.get("KVS_BACKEND", "manager")
+SHARED_KVS_PATH = os.environ.get("KVS_SHM_PATH", "/dev/shm/kvs_store")
+# Persist the manager backend's store to this directory; unset keeps it in memory only
+KVS_DATA_DIR = os.environ.get("KVS_DATA_DIR")
+# "always", "batch" or "interval", see kvs_wal.py
+WAL_FSYNC_POLICY = os.environ.get("WAL_FSYNC_POLICY", "batch")
+SNAPSHOT_INTERVAL = 60
+# "dict" keeps the whole store in memory (optionally persisted with the WAL),
+# "segments" keeps values on disk in KVS_DATA_DIR (see segment_store.py)
+KVS_ENGINE = os.environ.get("KVS_ENGINE", "dict")
+# Number of locks (and dict shards) writes are spread over by key hash
+LOCK_STRIPES = 64
+# Older versions kept per key for causal and snapshot reads, at most this many
+# and only for as long as VERSION_RETENTION (in timestamp units, ns) after
+# they were overwritten
+VERSION_CHAIN_LENGTH = 8
+VERSION_RETENTION = 30 * 10 ** 9
+VERSION_GC_INTERVAL = 5
+# Seconds between sweeps dropping dependencies below the stable cut from stored values
+DEPENDENCY_PRUNE_INTERVAL = 60
+# A tombstone is removed once every replica has it (it's below the stable cut)
+# and it's at least this old (ns). Longer than VERSION_RETENTION, so no
+# listing still running can need the key's older versions.
+TOMBSTONE_GRACE = 60 * 10 ** 9
+# Superseded entries allowed in the change log's sequence order beyond one per
+# key before it's compacted
+CHANGE_LOG_SLACK = 1024
 
 
 class KVSManager(BaseManager):
     pass
 
 
+def validCursor(cursor) -> bool:
+    """
+    :return: whether cursor looks like one listKeys() handed out:
+             "epoch:cut:started_at:next key"
+    """
+    if type(cursor) is not str or len(fields := cursor.split(":", 3)) != 4:
+        return False
+    return fields[1].isdigit() and fields[2].isdigit()
+
+
+class StripedDict(MutableMapping):
+    """
+    A dict split into shards by key hash. copy() copies one shard at a time,
+    so it never stops the world for longer than it takes to copy a single shard.
+    """
+    def __init__(self, contents: dict | None = None, shards: int = LOCK_STRIPES):
+        self.shards: list[dict[str, tuple[str, int, dict[str, int]]]] = [{} for _ in range(shards)]
+        if contents:
+            self.update(contents)
+
+    def _shard(self, key: str) -> dict[str, tuple[str, int, dict[str, int]]]:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __getitem__(self, key: str) -> tuple[str, int, dict[str, int]]:
+        return self._shard(key)[key]
+
+    def get(self, key: str, default=None):
+        return self._shard(key).get(key, default)
+
+    def __setitem__(self, key: str, val_tuple: tuple[str, int, dict[str, int]]) -> None:
+        self._shard(key)[key] = val_tuple
+
+    def __delitem__(self, key: str) -> None:
+        del self._shard(key)[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._shard(key)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard.copy()
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def clear(self) -> None:
+        for shard in self.shards:
+            shard.clear()
+
+    def copy(self) -> dict[str, tuple[str, int, dict[str, int]]]:
+        # Each shard's copy() runs without releasing the GIL, so it is atomic
+        # with respect to writers. Between shards, writers get to run.
+        contents = {}
+        for shard in self.shards:
+            contents.update(shard.copy())
+        return contents
+
+
 class LocalKVS:
-    def __init__(self):
+    def __init__(self, lock_stripes: int = LOCK_STRIPES, node_id: int = NODE_ID):
         # Our dict matches keys to a three-tuple containing the key's value,
-        # last updated timestamp, and the key's dependency list
-        self.kvs_dict: dict[str, tuple[str, int, dict[str, int]]] = {}
-        self.lock = Lock()
+        # last updated timestamp, and the key's dependency list. Any mapping
+        # with a copy() method will do, see useEngine().
+        self.kvs_dict: MutableMapping[str, tuple[str, int, dict[str, int]]] = StripedDict(shards=lock_stripes)
+        # Writes to a key only need to exclude other writes to the same key, so
+        # keys are spread over several locks. Reads of a single tuple are atomic
+        # and don't lock at all.
+        self.locks = [Lock() for _ in range(lock_stripes)]
+        # Serializes whole-store operations (snapshots, setDict) with each other
+        self.snapshot_lock = Lock()
+        # Only set once enablePersistence() is called, i.e. in the server process
+        self.wal: WriteAheadLog | None = None
+        self.data_dir: str | None = None
+        # WAL sequence number as of the last snapshot
+        self.snapshot_seq = 0
+        # Causal reads blocked on a key reaching some version:
+        # key -> list of (version, event to set once it has)
+        self.waiters: dict[str, list[tuple[int, Event]]] = {}
+        self.waiters_lock = Lock()
+        # Every key with the change sequence number of its last change, so
+        # gossip can ship only what a peer hasn't seen yet (see
+        # getChangesSince()). The epoch identifies this sequence: whenever the
+        # store is replaced wholesale we start a new one.
+        self.change_log: dict[str, int] = {}
+        self.change_seq = 0
+        # Every change in sequence order, so a page can seek straight to where
+        # the caller left off. A key's earlier changes stay in here, skipped,
+        # until they outnumber the keys and we compact it.
+        self.change_seqs: list[int] = []
+        self.change_keys: list[str] = []
+        self.change_lock = Lock()
+        self.epoch = uuid4().hex
+        # Hash tree over (key, timestamp, value) for anti-entropy, see merkle_tree.py
+        self.merkle = MerkleTree()
+        # Every key in order, for range and prefix scans, see sorted_index.py
+        self.key_index = SortedKeys()
+        # Versions each key had before its current one, oldest first, for
+        # reads that can't use the newest (see getConsistentValue() and
+        # listKeys()). Memory only; a restart starts every chain over.
+        self.versions: dict[str, list[tuple[str, int, dict[str, int]]]] = {}
+        # key -> (timestamp of its oldest kept version, time_ns() when that
+        # became so) for keys whose chain lost versions to garbage collection:
+        # we can't tell what the key held before that timestamp
+        self.version_floor: dict[str, tuple[int, int]] = {}
+        # Newest timestamp written, the cut listKeys() reads the store at
+        self.max_timestamp = 0
+        # Hybrid logical clock timestamps for writes are issued from: never
+        # behind the wall clock, and always past every timestamp we have
+        # issued or seen, so a write always orders after what it follows no
+        # matter how far our wall clock is behind another node's; see
+        # hybrid_clock.py
+        self.clock = 0
+        self.node_id = node_id
+        self.clock_lock = Lock()
+        # Timestamps of client writes accepted here that are still being
+        # applied, for getOriginFrontier(); guarded by clock_lock
+        self.own_writes: set[int] = set()
+        # Deleted keys, for collectTombstones() and getEntryCounts()
+        self.tombstone_keys: set[str] = set()
+        self.tombstone_lock = Lock()
+        # node -> timestamp up to which it is known to have applied every
+        # write, as spread by gossip, and the minimum of those over the view:
+        # versions at or below it are applied everywhere (see gossip.py)
+        self.frontiers: dict[str, int] = {}
+        self.stable_cut = 0
+        self.frontier_lock = Lock()
+        # Stable cut as of the last pruneDependencies() sweep
+        self.pruned_cut = 0
+        # For vector clock metadata (see vector_clock.py), the newest entry
+        # for each node over every value we hold. For each other node, the
+        # timestamp up to which we have all of the writes it accepted, which
+        # is also what our own frontier is made of (see updateOwnFrontier()).
+        self.max_vector: dict[str, int] = {}
+        self.origin_frontiers: dict[str, int] = {}
+        self.origin_cond = Condition()
+        # Dependencies we don't have yet: dependency key -> {dependent key ->
+        # version of the dependency it needs}. Kept up to date on every write
+        # so finding what we're missing doesn't mean scanning the whole store.
+        self.unresolved: dict[str, dict[str, int]] = {}
+        self.unresolved_lock = Lock()
+
+    def _lockFor(self, key: str) -> Lock:
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def _allLocks(self):
+        with ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            yield
+
+    def _applyValue(self, key: str, value: str | None, timestamp: int, dependencies: dict[str, int]) \
+            -> tuple[bool, bool]:
+        """
+        Last-writer-wins update of kvs_dict; caller must hold the key's lock.
+        :return: (whether the key existed before, whether kvs_dict changed)
+        """
+        old_val = self.kvs_dict.get(key)
+        self._observe(timestamp)
+        # always write a new value
+        if old_val is None:
+            if value is None and self._collectable(timestamp):
+                # A tombstone we (or everyone else) already collected, coming
+                # back from a replica that hasn't yet
+                return False, False
+            self.kvs_dict[key] = (value, timestamp, dependencies)
+            self._logChange(key)
+            self.merkle.update(key, None, self.kvs_dict[key])
+            self.key_index.add(key)
+            self._indexDependencies(key, timestamp, {}, dependencies)
+            self._raiseVector(dependencies)
+            if value is None:
+                with self.tombstone_lock:
+                    self.tombstone_keys.add(key)
+            return False, True
+
+        # don't overwrite if we have a newer val, or the same timestamp's
+        # winner
+        if versionOrder(old_val) > versionOrder((value, timestamp)):
+            return True, False
+
+        if old_val[1] < timestamp:
+            # Readers look at kvs_dict before the chain, so the old version
+            # has to be in the chain before it stops being the current one
+            self._pushVersion(key, old_val, timestamp)
+        self.kvs_dict[key] = (value, timestamp, dependencies)
+        self._logChange(key)
+        self.merkle.update(key, old_val, self.kvs_dict[key])
+        self._indexDependencies(key, timestamp, old_val[2], dependencies)
+        self._raiseVector(dependencies)
+        if (value is None) != (old_val[0] is None):
+            with self.tombstone_lock:
+                if value is None:
+                    self.tombstone_keys.add(key)
+                else:
+                    self.tombstone_keys.discard(key)
+        return True, True
+
+    def _pushVersion(self, key: str, old_val: tuple[str, int, dict[str, int]], timestamp: int) -> None:
+        """
+        Keep old_val, which a write at timestamp is replacing, in key's chain
+        and drop whatever that pushes past VERSION_CHAIN_LENGTH or
+        VERSION_RETENTION. Caller must hold the key's lock.
+        """
+        chain = self.versions.get(key, [])
+        self.versions[key] = self._trimChain(key, chain + [old_val], timestamp, timestamp)
+
+    def _trimChain(self, key: str, chain: list[tuple[str, int, dict[str, int]]], current_timestamp: int,
+                   now: int) -> list[tuple[str, int, dict[str, int]]]:
+        """
+        :return: chain without the versions that are too many or were
+                 overwritten more than VERSION_RETENTION before now
+        """
+        keep_from = max(len(chain) - VERSION_CHAIN_LENGTH, 0)
+        while keep_from < len(chain):
+            overwritten_at = chain[keep_from + 1][1] if keep_from + 1 < len(chain) else current_timestamp
+            if now - overwritten_at <= VERSION_RETENTION:
+                break
+            keep_from += 1
+        if keep_from != 0:
+            # Set before the versions go so a reader never sees them missing
+            # without the floor that says so
+            floor = chain[keep_from][1] if keep_from < len(chain) else current_timestamp
+            self.version_floor[key] = (floor, time_ns())
+        return chain[keep_from:]
+
+    def collectVersions(self) -> int:
+        """
+        Drop every kept version overwritten more than VERSION_RETENTION ago.
+        :return: number of keys left with older versions kept
+        """
+        now = time_ns()
+        for key in list(self.versions):
+            with self._lockFor(key):
+                if (chain := self.versions.get(key)) is None:
+                    continue
+                current_timestamp = self.kvs_dict[key][1]
+                if len(chain := self._trimChain(key, chain, current_timestamp, now)) != 0:
+                    self.versions[key] = chain
+                else:
+                    del self.versions[key]
+        # listKeys() turns down listings started more than VERSION_RETENTION
+        # ago, and any listing started after a floor was set reads at or past
+        # it, so floors set before then can't matter to anyone anymore
+        for key, (_, set_at) in list(self.version_floor.items()):
+            if now - set_at > VERSION_RETENTION:
+                with self._lockFor(key):
+                    if now - self.version_floor.get(key, (0, now))[1] > VERSION_RETENTION:
+                        del self.version_floor[key]
+        return len(self.versions)
+
+    def updateFrontiers(self, frontiers: dict[str, int], view: list[str] | None = None) -> dict[str, int]:
+        """
+        Merge what another node knows about how far each node has applied
+        writes, keeping the newest for each.
+        :param view: if given, recompute the stable cut over these nodes
+        :return: everything we know now, to pass on
+        """
+        with self.frontier_lock:
+            for node, frontier in frontiers.items():
+                self.frontiers[node] = max(frontier, self.frontiers.get(node, frontier))
+            if view is not None:
+                self.stable_cut = min(self.frontiers.get(node, 0) for node in view)
+            return self.frontiers.copy()
+
+    def updateOwnFrontier(self, own_node: str, view: list[str]) -> None:
+        """
+        Work out our own frontier and recompute the stable cut over view.
+        Once an exchange brought us everything a peer had, we have every write
+        it accepted up to the origin frontier it reported, and it timestamps
+        anything it accepts later past that on its own clock. So we have every
+        write up to the lowest of those over our peers (and our own origin
+        frontier), however far apart the nodes' wall clocks are.
+        Does nothing until we've heard from every peer.
+        """
+        with self.origin_cond:
+            reported = [self.origin_frontiers.get(node) for node in view if node != own_node]
+        if None in reported:
+            return
+        self.updateFrontiers({own_node: min(reported + [self.getOriginFrontier()])}, view)
+
+    def getStableCut(self) -> int:
+        """
+        :return: timestamp at or below which every replica in the view has
+                 applied every write, 0 until we know
+        """
+        return self.stable_cut
+
+    def pruneDependencies(self) -> int:
+        """
+        Drop dependencies at or below the stable cut from every stored value.
+        Only the dependency dict changes, so this isn't a new version.
+        :return: number of values rewritten
+        """
+        cut = self.stable_cut
+        if cut <= self.pruned_cut:
+            return 0
+        pruned = 0
+        for key in list(self.kvs_dict):
+            val_tuple = self.kvs_dict.get(key)
+            if val_tuple is None or all(d_ver > cut for d_ver in val_tuple[2].values()):
+                continue
+            with self._lockFor(key):
+                value, timestamp, dependencies = self.kvs_dict[key]
+                kept = {d_key: d_ver for d_key, d_ver in dependencies.items() if d_ver > cut}
+                self.kvs_dict[key] = (value, timestamp, kept)
+                self._indexDependencies(key, timestamp, dependencies, kept)
+            pruned += 1
+        self.pruned_cut = cut
+        return pruned
+
+    def _collectable(self, timestamp: int) -> bool:
+        """
+        :return: whether a tombstone written at timestamp may be removed:
+                 every node in the view has acknowledged applying everything
+                 up to it (it's at or below the stable cut, which is built from
+                 clock readings the nodes themselves reported, see
+                 updateOwnFrontier()), so no replica still holds an older
+                 value of the key to bring back
+        """
+        return timestamp <= self.stable_cut and time_ns() - timestamp > TOMBSTONE_GRACE
+
+    def collectTombstones(self) -> int:
+        """
+        Remove deleted keys whose tombstones every replica has, everything
+        kept about them included.
+        :return: number of keys removed
+        """
+        with self.tombstone_lock:
+            candidates = list(self.tombstone_keys)
+        removed = 0
+        for key in candidates:
+            with self._lockFor(key):
+                if (val_tuple := self.kvs_dict.get(key)) is None or val_tuple[0] is not None or \
+                        not self._collectable(val_tuple[1]):
+                    continue
+                del self.kvs_dict[key]
+                with self.change_lock:
+                    self.change_log.pop(key, None)
+                self.merkle.remove(key, val_tuple)
+                self.key_index.remove(key)
+                self.versions.pop(key, None)
+                self.version_floor.pop(key, None)
+                with self.unresolved_lock:
+                    for d_key in val_tuple[2]:
+                        if (dependents := self.unresolved.get(d_key)) is not None:
+                            dependents.pop(key, None)
+                            if len(dependents) == 0:
+                                del self.unresolved[d_key]
+                with self.tombstone_lock:
+                    self.tombstone_keys.discard(key)
+            removed += 1
+        return removed
+
+    def getEntryCounts(self) -> dict[str, int]:
+        """
+        :return: {"live": keys with a value, "tombstones": deleted keys still kept}
+        """
+        with self.tombstone_lock:
+            tombstones = len(self.tombstone_keys)
+        return {"live": len(self.kvs_dict) - tombstones, "tombstones": tombstones}
+
+    def _maintenanceDaemon(self) -> None:
+        last_prune = monotonic()
+        while True:
+            sleep(VERSION_GC_INTERVAL)
+            self.collectVersions()
+            self.collectTombstones()
+            if monotonic() - last_prune >= DEPENDENCY_PRUNE_INTERVAL:
+                self.pruneDependencies()
+                last_prune = monotonic()
+
+    def _versionsOf(self, key: str) -> list[tuple[str, int, dict[str, int]]]:
+        """
+        :return: every version of key we still have, newest first
+        """
+        if (current := self.kvs_dict.get(key)) is None:
+            return []
+        return [current] + self.versions.get(key, [])[::-1]
+
+    def _valueAsOf(self, key: str, cut: int) -> tuple[str, int, dict[str, int]] | None:
+        """
+        :return: the version of key that was current at timestamp cut, or None
+                 if key didn't exist yet
+        """
+        for val_tuple in self._versionsOf(key):
+            if val_tuple[1] <= cut:
+                return val_tuple
+        if (floor := self.version_floor.get(key)) is not None and cut < floor[0]:
+            raise ValueError("the listing is older than the versions we keep, start it over")
+        return None
+
+    def getConsistentValue(self, key: str, metadata: dict[str, int]) -> tuple[str, int, dict[str, int]] | None:
+        """
+        The newest version of key a client with causal metadata may read: at
+        least as new as the one it has seen, and not depending on a newer
+        version of anything than it has seen.
+        :return: that version, or None if we don't have one
+        """
+        for val_tuple in self._versionsOf(key):
+            if val_tuple[1] < metadata.get(key, val_tuple[1]):
+                break
+            if all(d_ver <= metadata[d_key] for d_key, d_ver in val_tuple[2].items() if d_key in metadata):
+                return val_tuple
+        return None
+
+    def _indexDependencies(self, key: str, timestamp: int, old_dependencies: dict[str, int],
+                           dependencies: dict[str, int]) -> None:
+        """
+        Update the unresolved dependency index for key having just been
+        written at timestamp, replacing a value that had old_dependencies.
+        Must be called after kvs_dict is updated: a dependency is checked
+        against kvs_dict under unresolved_lock, and a write to it resolves it
+        under unresolved_lock afterwards, so one of the two always sees the other.
+        """
+        with self.unresolved_lock:
+            for d_key in old_dependencies:
+                if (dependents := self.unresolved.get(d_key)) is not None:
+                    dependents.pop(key, None)
+                    if len(dependents) == 0:
+                        del self.unresolved[d_key]
+            for d_key, d_ver in dependencies.items():
+                # Everyone has everything below the stable cut, even if it's
+                # a delete whose tombstone has been collected since
+                if isVectorKey(d_key) or d_ver <= self.stable_cut:
+                    continue
+                if (d_val := self.kvs_dict.get(d_key)) is None or d_val[1] < d_ver:
+                    self.unresolved.setdefault(d_key, {})[key] = d_ver
+            if (dependents := self.unresolved.get(key)) is not None:
+                for dependent, d_ver in list(dependents.items()):
+                    if d_ver <= timestamp:
+                        del dependents[dependent]
+                if len(dependents) == 0:
+                    del self.unresolved[key]
+
+    def _raiseVector(self, dependencies: dict[str, int]) -> None:
+        if len(clock := fromDependencies(dependencies)) == 0:
+            return
+        with self.origin_cond:
+            for node, timestamp in clock.items():
+                if timestamp > self.max_vector.get(node, 0):
+                    self.max_vector[node] = timestamp
+
+    def getVector(self) -> dict[str, int]:
+        """
+        :return: a vector clock covering every value we hold that was written
+                 with vector clock metadata
+        """
+        with self.origin_cond:
+            return self.max_vector.copy()
+
+    def updateOriginFrontier(self, node: str, timestamp: int) -> None:
+        """
+        Record that we have every write node accepted up to timestamp.
+        """
+        with self.origin_cond:
+            if timestamp > self.origin_frontiers.get(node, 0):
+                self.origin_frontiers[node] = timestamp
+                self.origin_cond.notify_all()
+
+    def waitForVector(self, clock: dict[str, int], own_node: str, timeout: float) -> bool:
+        """
+        Block until we have every write the vector clock covers, or timeout.
+        :param own_node: our own address; we always have our own writes
+        :return: whether we got there in time
+        """
+        deadline = monotonic() + timeout
+        with self.origin_cond:
+            while any(timestamp > self.origin_frontiers.get(node, 0)
+                      for node, timestamp in clock.items() if node != own_node):
+                if (remaining := deadline - monotonic()) <= 0:
+                    return False
+                self.origin_cond.wait(remaining)
+            return True
+
+    def getMissingDependencies(self) -> dict[str, int]:
+        """
+        :return: key -> version of every dependency of what we store that we
+                 don't have yet
+        """
+        with self.unresolved_lock:
+            return {d_key: max(dependents.values()) for d_key, dependents in self.unresolved.items()}
+
+    def _observe(self, timestamp: int) -> None:
+        with self.clock_lock:
+            if timestamp > self.max_timestamp:
+                self.max_timestamp = timestamp
+                # A timestamp from a badly wrong clock mustn't drag ours along
+                self.clock = observe(self.clock, timestamp)
+
+    def newTimestamp(self, observed: int = 0, count: int = 1) -> int:
+        """
+        Issue timestamps for new writes from the hybrid logical clock.
+        :param observed: newest timestamp the client writing has seen; only
+                         followed up to MAX_CLOCK_DRIFT ahead of the wall clock
+        :param count: number of consecutive timestamps to reserve, each
+                      TIMESTAMP_STEP after the one before
+        :return: the first of them
+        """
+        with self.clock_lock:
+            return self._issueTimestamps(observed, count)
+
+    def _issueTimestamps(self, observed: int, count: int) -> int:
+        """
+        newTimestamp(), for a caller already holding clock_lock.
+        """
+        timestamp = nextTimestamp(self.clock, observed, self.node_id)
+        self.clock = timestamp + (count - 1) * TIMESTAMP_STEP
+        return timestamp
+
+    def reserveTimestamps(self, observed: int = 0, count: int = 1) -> int:
+        """
+        newTimestamp() for client writes accepted here and applied later:
+        getOriginFrontier() stays below them until releaseTimestamps().
+        """
+        with self.clock_lock:
+            timestamp = self._issueTimestamps(observed, count)
+            self.own_writes.add(timestamp)
+            return timestamp
+
+    def releaseTimestamps(self, timestamp: int) -> None:
+        """
+        :param timestamp: as returned by reserveTimestamps(), once its writes
+                          are applied or given up on
+        """
+        with self.clock_lock:
+            self.own_writes.discard(timestamp)
+
+    def setOwnValue(self, key: str, value: str | None, observed: int, dependencies: dict[str, int]) \
+            -> tuple[int, bool]:
+        """
+        Write key for a client at a new timestamp past observed.
+        :return: (the write's timestamp, whether the key was replaced)
+        """
+        timestamp = self.reserveTimestamps(observed)
+        try:
+            return timestamp, self.setDictValue(key, value, timestamp, dependencies)
+        finally:
+            self.releaseTimestamps(timestamp)
+
+    def setOwnVectorValue(self, key: str, value: str | None, clock: dict[str, int], own_node: str) \
+            -> tuple[int, bool]:
+        """
+        Write key for a vector mode client: at a new timestamp past everything
+        in the client's clock, depending on the clock with own_node's entry
+        advanced to that timestamp.
+        :return: (the write's timestamp, whether the key was replaced)
+        """
+        timestamp = self.reserveTimestamps(max(clock.values(), default=0))
+        try:
+            dependencies = toDependencies({**clock, own_node: timestamp})
+            return timestamp, self.setDictValue(key, value, timestamp, dependencies)
+        finally:
+            self.releaseTimestamps(timestamp)
+
+    def getOriginFrontier(self) -> int:
+        """
+        :return: a timestamp such that every client write accepted here at or
+                 below it is in the store, so a peer that gets everything we
+                 have from here on has all of them
+        """
+        with self.clock_lock:
+            if self.own_writes:
+                return min(self.own_writes) - 1
+            # Anything we issue from here on is past the clock, so moving it
+            # up to the wall clock lets an idle node's frontier keep moving
+            self.clock = max(self.clock, time_ns())
+            return self.clock
+
+    def _logChange(self, key: str) -> None:
+        with self.change_lock:
+            self.change_seq += 1
+            self.change_log[key] = self.change_seq
+            self.change_seqs.append(self.change_seq)
+            self.change_keys.append(key)
+            if len(self.change_seqs) > 2 * len(self.change_log) + CHANGE_LOG_SLACK:
+                self._compactChangeLog()
+
+    def _compactChangeLog(self) -> None:
+        """
+        Drop superseded changes from the sequence order. Caller must hold change_lock.
+        """
+        live = [(seq, key) for seq, key in zip(self.change_seqs, self.change_keys)
+                if self.change_log.get(key) == seq]
+        self.change_seqs = [seq for seq, _ in live]
+        self.change_keys = [key for _, key in live]
+
+    def _rebuildIndexes(self) -> None:
+        """
+        Rebuild everything derived from kvs_dict after it was replaced
+        wholesale: start a new change log epoch in which every key currently
+        stored counts as changed, a new hash tree, key index, unresolved
+        dependency index and set of tombstones, and forget older versions. Caller must hold all of
+        the key locks.
+        """
+        with self.change_lock:
+            self.epoch = uuid4().hex
+            self.change_seq = 0
+            self.change_log = {}
+            self.change_seqs = []
+            self.change_keys = []
+        for key in list(self.kvs_dict):
+            self._logChange(key)
+        self.merkle = MerkleTree.fromItems(self.kvs_dict.items())
+        self.key_index = SortedKeys.fromKeys(self.kvs_dict.keys())
+        self.versions = {}
+        self.version_floor = {}
+        with self.clock_lock:
+            self.max_timestamp = max((val_tuple[1] for val_tuple in self.kvs_dict.values()), default=0)
+            self.clock = max(self.clock, self.max_timestamp)
+        unresolved = {}
+        max_vector = {}
+        for key, (_, _, dependencies) in self.kvs_dict.items():
+            for d_key, d_ver in dependencies.items():
+                if isVectorKey(d_key):
+                    continue
+                if (d_val := self.kvs_dict.get(d_key)) is None or d_val[1] < d_ver:
+                    unresolved.setdefault(d_key, {})[key] = d_ver
+            for node, timestamp in fromDependencies(dependencies).items():
+                max_vector[node] = max(timestamp, max_vector.get(node, timestamp))
+        with self.origin_cond:
+            self.max_vector = max_vector
+        with self.tombstone_lock:
+            self.tombstone_keys = {key for key, val_tuple in self.kvs_dict.items() if val_tuple[0] is None}
+        with self.unresolved_lock:
+            self.unresolved = unresolved
+
+    def getChangesSince(self, since: int, epoch: str | None) \
+            -> tuple[str, int, dict[str, tuple[str, int, dict[str, int]]]]:
+        """
+        Everything changed after change sequence number since, for delta gossip.
+        :param since: sequence number the caller is already up to date with
+        :param epoch: epoch that since belongs to; if it isn't our current one
+                      (or None), the caller gets the whole store instead
+        :return: (current epoch, current sequence number, changed entries)
+        """
+        current_epoch, current_seq, changes, _ = self.getChangePage(since, epoch, None)
+        return current_epoch, current_seq, changes
+
+    def getChangePage(self, since: int, epoch: str | None, limit: int | None) \
+            -> tuple[str, int, dict[str, tuple[str, int, dict[str, int]]], bool]:
+        """
+        Same as getChangesSince, but only the limit oldest changes after since
+        (all of them if limit is None), so a long backlog can be sent in chunks.
+        :return: (current epoch, sequence number the page brings the caller up
+                 to, changed entries, whether that's every change)
+        """
+        with self.change_lock:
+            if epoch != self.epoch:
+                since = 0
+            changed_keys = []
+            page_seq, complete = self.change_seq, True
+            for index in range(bisect_right(self.change_seqs, since), len(self.change_seqs)):
+                seq, key = self.change_seqs[index], self.change_keys[index]
+                if self.change_log.get(key) != seq:
+                    continue
+                if limit is not None and len(changed_keys) == limit:
+                    # Oldest first, so the page ends at a sequence number
+                    page_seq, complete = self.change_log[changed_keys[-1]], False
+                    break
+                changed_keys.append(key)
+            current_epoch = self.epoch
+        changes = {}
+        for key in changed_keys:
+            if (val_tuple := self.kvs_dict.get(key)) is not None:
+                changes[key] = val_tuple
+        return current_epoch, page_seq, changes, complete
 
     def setDictValue(self, key: str, value: str | None, timestamp: int, dependencies: dict[str, int] | None) -> bool:
         """
@@ -30,29 +735,249 @@ class LocalKVS:
         :param dependencies: list of dependencies we must meet to commit this update
         :return: bool of whether the key was replaced or not
         """
-        with self.lock:
-            # give dependencies a default value on None
-            old_val = self.kvs_dict.get(key)
-            if dependencies is None:
-                dependencies = {}
-
-            # ignore dependencies on self
-            dependencies.pop(key, None)
-            # always write a new value
-            if old_val is None:
-                self.kvs_dict[key] = (value, timestamp, dependencies)
+        # give dependencies a default value on None
+        if dependencies is None:
+            dependencies = {}
+        # ignore dependencies on self
+        dependencies.pop(key, None)
+
+        seq = None
+        with self._lockFor(key):
+            replaced, changed = self._applyValue(key, value, timestamp, dependencies)
+            if changed and self.wal is not None:
+                seq = self.wal.append((key, value, timestamp, dependencies))
+        # Wait for the disk outside the lock so concurrent writers can share an fsync
+        if seq is not None:
+            self.wal.waitDurable(seq)
+        if changed and self.waiters:
+            self._wakeWaiters(key, timestamp)
+        return replaced
+
+    def setDictValues(self, entries: dict[str, tuple[str | None, int, dict[str, int]]]) -> dict[str, bool]:
+        """
+        Apply a batch of writes, each last-writer-wins like setDictValue, in
+        one call. Each key lock is taken once for all of the batch's keys that
+        fall under it, and the whole batch shares one wait for the WAL.
+        :param entries: key -> (value, timestamp, dependencies)
+        :return: key -> whether the key was replaced or not, as for setDictValue
+        """
+        return self._applyBatch(entries, merging=False)[0]
+
+    def mergeEntries(self, entries: dict[str, tuple[str | None, int, dict[str, int]]]) \
+            -> tuple[bool, dict[str, tuple[str, int, dict[str, int]]]]:
+        """
+        Merge another replica's entries into ours in one call: apply the ones
+        that are newer than what we have, and hand back ours where they're newer.
+        :param entries: key -> (value, timestamp, dependencies) from the other replica
+        :return: (whether anything of ours changed, our entries that are newer than theirs)
+        """
+        replaced, changed_keys, newer = self._applyBatch(entries, merging=True)
+        return len(changed_keys) != 0, newer
+
+    def _applyBatch(self, entries: dict[str, tuple[str | None, int, dict[str, int]]], merging: bool) \
+            -> tuple[dict[str, bool], list[str], dict[str, tuple[str, int, dict[str, int]]]]:
+        """
+        :param merging: leave keys we already have at the same version alone
+                        rather than rewriting them, since replicas exchanging
+                        state mostly send each other what they both have
+        :return: (key -> whether it was replaced, keys that changed, our entries
+                  that were newer than the ones given)
+        """
+        by_lock: dict[int, list[str]] = {}
+        for key in entries:
+            by_lock.setdefault(hash(key) % len(self.locks), []).append(key)
+
+        replaced = {}
+        changed_keys = []
+        newer = {}
+        seq = None
+        for lock_index, keys in by_lock.items():
+            with self.locks[lock_index]:
+                for key in keys:
+                    value, timestamp, dependencies = entries[key]
+                    if merging and (old_val := self.kvs_dict.get(key)) is not None and \
+                            versionOrder(old_val) >= versionOrder(entries[key]):
+                        replaced[key] = True
+                        if versionOrder(old_val) > versionOrder(entries[key]):
+                            newer[key] = old_val
+                        continue
+                    dependencies = dict(dependencies or {})
+                    # ignore dependencies on self
+                    dependencies.pop(key, None)
+                    replaced[key], changed = self._applyValue(key, value, timestamp, dependencies)
+                    if changed:
+                        changed_keys.append(key)
+                        if self.wal is not None:
+                            seq = self.wal.append((key, value, timestamp, dependencies))
+        if seq is not None:
+            self.wal.waitDurable(seq)
+        if self.waiters:
+            for key in changed_keys:
+                self._wakeWaiters(key, entries[key][1])
+        return replaced, changed_keys, newer
+
+    def getDictValues(self, keys: list[str]) -> dict[str, tuple[str, int, dict[str, int]] | None]:
+        """
+        getDictValue for several keys in one call.
+        :return: key -> its tuple, or None if we don't have it
+        """
+        return {key: self.kvs_dict.get(key) for key in keys}
+
+    def listKeys(self, cursor: str | None, limit: int) -> tuple[dict[str, int], str | None]:
+        """
+        One page of a listing of every key we hold that isn't deleted, in key
+        order, without copying the store. Every page of a listing reads the
+        store as of the newest timestamp when it started, from the keys' older
+        versions where they have been written to since, so the listing as a
+        whole is a consistent snapshot. Raises ValueError once it's too old for that.
+        :param cursor: where the previous page left off, None to start over
+        :param limit: number of stored keys (deleted ones included) to look at
+        :return: (key -> version for this page's keys, cursor for the next
+                 page or None if this was the last one)
+        """
+        with self.change_lock:
+            epoch = self.epoch
+        cut, started_at, start = self.max_timestamp, time_ns(), ""
+        if cursor is not None:
+            if not validCursor(cursor):
+                raise ValueError("malformed cursor")
+            # the key goes last, it may contain anything
+            cursor_epoch, cut, started_at, start = cursor.split(":", 3)
+            if cursor_epoch != epoch:
+                raise ValueError("cursor is from before the store was replaced, start the listing over")
+            cut, started_at = int(cut), int(started_at)
+            if time_ns() - started_at > VERSION_RETENTION:
+                raise ValueError("the listing is older than the versions we keep, start it over")
+
+        # Resuming from a key rather than a position means keys removed in
+        # between (see collectTombstones()) can't make us skip any others
+        keys = self.key_index.range(start, None, limit + 1)
+        page: dict[str, int] = {}
+        for key in keys[:limit]:
+            if (val_tuple := self._valueAsOf(key, cut)) is not None and val_tuple[0] is not None:
+                page[key] = val_tuple[1]
+        next_cursor = f"{epoch}:{cut}:{started_at}:{keys[limit]}" if len(keys) > limit else None
+        return page, next_cursor
+
+    def scanKeys(self, start: str, end: str | None, limit: int) \
+            -> tuple[dict[str, tuple[str, int, dict[str, int]]], str | None]:
+        """
+        Read the keys from start up to (not including) end in key order.
+        :param end: None to scan to the last key
+        :param limit: number of stored keys (deleted ones included) to look at
+        :return: (key -> tuple for the keys that aren't deleted, the key to
+                  start the next scan from or None if there's nothing left)
+        """
+        keys = self.key_index.range(start, end, limit + 1)
+        entries = {}
+        for key in keys[:limit]:
+            if (val_tuple := self.kvs_dict.get(key)) is not None and val_tuple[0] is not None:
+                entries[key] = val_tuple
+        return entries, keys[limit] if len(keys) > limit else None
+
+    def _wakeWaiters(self, key: str, timestamp: int) -> None:
+        with self.waiters_lock:
+            if (key_waiters := self.waiters.get(key)) is None:
+                return
+            still_waiting = []
+            for version, event in key_waiters:
+                if timestamp >= version:
+                    event.set()
+                else:
+                    still_waiting.append((version, event))
+            if still_waiting:
+                self.waiters[key] = still_waiting
+            else:
+                del self.waiters[key]
+
+    def waitForVersion(self, key: str, version: int, timeout: float) -> tuple[str, int, dict[str, int]] | None:
+        """
+        Block until key has been written with a timestamp >= version, waking
+        as soon as setDictValue commits such a write.
+        :param key: key to wait on
+        :param version: minimum timestamp to wait for
+        :param timeout: seconds to wait at most
+        :return: key's current tuple, which is older than version on timeout
+        """
+        val_tuple = self.kvs_dict.get(key)
+        if val_tuple is not None and val_tuple[1] >= version:
+            return val_tuple
+
+        event = Event()
+        with self.waiters_lock:
+            self.waiters.setdefault(key, []).append((version, event))
+        # The write may have landed between our first look and registering
+        val_tuple = self.kvs_dict.get(key)
+        if val_tuple is None or val_tuple[1] < version:
+            event.wait(timeout)
+            val_tuple = self.kvs_dict.get(key)
+
+        with self.waiters_lock:
+            if (key_waiters := self.waiters.get(key)) is not None:
+                key_waiters = [waiter for waiter in key_waiters if waiter[1] is not event]
+                if key_waiters:
+                    self.waiters[key] = key_waiters
+                else:
+                    del self.waiters[key]
+        return val_tuple
+
+    def waitForVersions(self, versions: dict[str, int], timeout: float) -> bool:
+        """
+        Block until every key in versions has reached at least its version,
+        e.g. until a client's causal metadata is satisfied.
+        :return: whether all versions were reached before the timeout
+        """
+        deadline = monotonic() + timeout
+        for key, version in versions.items():
+            val_tuple = self.waitForVersion(key, version, max(deadline - monotonic(), 0))
+            if val_tuple is None or val_tuple[1] < version:
                 return False
+        return True
 
-            # don't overwrite if we have a newer val
-            if old_val[1] > timestamp:
-                return True
+    def getChangePosition(self) -> tuple[str, int]:
+        """
+        :return: (epoch, sequence number) of the latest change, see getChangesSince()
+        """
+        with self.change_lock:
+            return self.epoch, self.change_seq
 
-            self.kvs_dict[key] = (value, timestamp, dependencies)
-            return True
+    def getMerkleHashes(self, nodes: list[int]) -> dict[int, str]:
+        return self.merkle.hashes(nodes)
+
+    def compareMerkleHashes(self, their_hashes: dict[int, str]) -> list[int]:
+        """
+        :param their_hashes: another replica's getMerkleHashes()
+        :return: the nodes where our tree differs from theirs
+        """
+        return self.merkle.differing(their_hashes)
+
+    def getBucketEntries(self, buckets: list[int]) -> dict[str, tuple[str, int, dict[str, int]]]:
+        """
+        :return: every entry whose key falls in one of the hash tree buckets
+        """
+        entries = {}
+        for key in self.merkle.keysIn(buckets):
+            if (val_tuple := self.kvs_dict.get(key)) is not None:
+                entries[key] = val_tuple
+        return entries
+
+    def getBucketPage(self, buckets: list[int], limit: int) -> tuple[dict[str, tuple[str, int, dict[str, int]]], int]:
+        """
+        Entries of as many of buckets, in order, as fit in limit entries; at
+        least the first bucket, however big it is.
+        :return: (entries, number of buckets they cover)
+        """
+        entries = {}
+        covered = 0
+        for bucket in buckets:
+            if covered and len(entries) >= limit:
+                break
+            entries.update(self.getBucketEntries([bucket]))
+            covered += 1
+        return entries, covered
 
     def getDictValue(self, key: str) -> tuple[str, int, dict[str, int]] | None:
-        with self.lock:
-            return self.kvs_dict.get(key)
+        return self.kvs_dict.get(key)
 
     def removeDictValue(self, key: str, timestamp: int, dependencies: dict[str, int]) -> bool:
         """
@@ -65,12 +990,78 @@ class LocalKVS:
         return self.setDictValue(key, None, timestamp, dependencies)
 
     def setDict(self, val: dict[str, str]) -> None:
-        with self.lock:
-            self.kvs_dict = val
+        with self.snapshot_lock, self._allLocks():
+            self.kvs_dict.clear()
+            self.kvs_dict.update(val)
+            self._rebuildIndexes()
+            if self.wal is not None:
+                # Nothing logged before this point matters anymore
+                self._snapshot()
+        # Whatever we had applied up to is gone with the old contents, so
+        # nothing is known to be everywhere until peers vouch for it again
+        with self.frontier_lock:
+            self.frontiers.clear()
+            self.stable_cut = 0
+        with self.origin_cond:
+            self.origin_frontiers.clear()
+        with self.waiters_lock:
+            waiting_keys = list(self.waiters)
+        for key in waiting_keys:
+            if (val_tuple := self.kvs_dict.get(key)) is not None:
+                self._wakeWaiters(key, val_tuple[1])
+
+    def useEngine(self, engine: MutableMapping[str, tuple[str, int, dict[str, int]]]) -> None:
+        """
+        Store values in engine instead of an in-memory dict, e.g. a SegmentStore
+        for stores that don't fit in memory. engine.copy() is what getDict()
+        returns, so it should be cheap (a lazy snapshot) for large engines.
+        """
+        with self.snapshot_lock, self._allLocks():
+            self.kvs_dict = engine
+            self._rebuildIndexes()
+
+    def enablePersistence(self, data_dir: str, fsync_policy: str = "batch") -> None:
+        """
+        Recover kvs_dict from the snapshot and WAL in data_dir, then log every
+        write from here on.
+        :param data_dir: directory holding the snapshot and WAL segments
+        :param fsync_policy: see kvs_wal.FSYNC_POLICIES
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        with self.snapshot_lock, self._allLocks():
+            contents, next_segment = loadSnapshot(data_dir)
+            self.kvs_dict = StripedDict(contents, len(self.locks))
+            self._rebuildIndexes()
+            for key, value, timestamp, dependencies in replay(data_dir, next_segment):
+                self._applyValue(key, value, timestamp, dependencies)
+            self.data_dir = data_dir
+            self.wal = WriteAheadLog(data_dir, fsync_policy)
+            # Fold what we just replayed into a snapshot so the next restart is quicker
+            self._snapshot()
+        Thread(target=self._snapshotDaemon, daemon=True).start()
+
+    def _snapshot(self) -> None:
+        """
+        Write kvs_dict out as a snapshot and drop the WAL segments it covers.
+        Caller must hold self.snapshot_lock, but writers may keep going: the
+        WAL is rotated *before* the dict is copied, so any write the copy
+        misses is in a segment we keep, and replaying it is idempotent.
+        """
+        next_segment = self.wal.rotate()
+        seq = self.wal.next_seq
+        writeSnapshot(self.data_dir, self.kvs_dict.copy(), next_segment)
+        self.wal.removeSegmentsBefore(next_segment)
+        self.snapshot_seq = seq
+
+    def _snapshotDaemon(self) -> None:
+        while True:
+            sleep(SNAPSHOT_INTERVAL)
+            with self.snapshot_lock:
+                if self.wal.next_seq != self.snapshot_seq:
+                    self._snapshot()
 
     def getDict(self) -> dict[str, tuple[str, int, dict[str, int]]]:
-        with self.lock:
-            return self.kvs_dict.copy()
+        return self.kvs_dict.copy()
 
 
 kvs = LocalKVS()
@@ -80,7 +1071,10 @@ def get() -> LocalKVS:
     return kvs
 
 
-def getKVSManager() -> KVSManager:
+def getKVSManager() -> KVSManager | SharedKVSManager:
+    if KVS_BACKEND == "shared_memory":
+        return SharedKVSManager(SHARED_KVS_PATH)
+
     # Our manager should only bind to localhost
     # Pick high af port number to avoid clashes
     manager = KVSManager(address=('127.0.0.1', 51234), authkey=b'')
@@ -88,6 +1082,15 @@ def getKVSManager() -> KVSManager:
     return manager
 
 
+def supportsVectorMode() -> bool:
+    """
+    :return: whether the backend can serve vector mode metadata. The shared
+             memory one has nowhere to keep the origin frontiers its reads
+             wait on (see shared_kvs.py), so it only takes per key metadata.
+    """
+    return KVS_BACKEND != "shared_memory"
+
+
 def putProcessingDaemon() -> None:
     while True:
         kvs.processPuts()
@@ -95,6 +1098,21 @@ def putProcessingDaemon() -> None:
 
 
 def main():
+    if KVS_BACKEND == "shared_memory":
+        # Nothing to serve, workers map the store themselves. Create it up front
+        # so the first request doesn't pay for it.
+        getKVSManager().connect()
+        return
+
+    if KVS_ENGINE == "segments":
+        if not KVS_DATA_DIR:
+            sys.exit("KVS_ENGINE=segments keeps the store on disk; set KVS_DATA_DIR to the directory to keep it in")
+        # Segments are their own log, no WAL needed on top
+        kvs.useEngine(SegmentStore(KVS_DATA_DIR))
+    elif KVS_DATA_DIR:
+        kvs.enablePersistence(KVS_DATA_DIR, WAL_FSYNC_POLICY)
+    Thread(target=kvs._maintenanceDaemon, daemon=True).start()
+
     manager = getKVSManager()
     server = manager.get_server()
     server.serve_forever()
@@ -0,0 +1,116 @@
+# Hash tree over the key space for anti-entropy between replicas.
+#
+# Keys are spread over 2^depth buckets by key hash; each bucket is a leaf of a
+# complete binary tree stored heap-style (node 1 is the root, node i has
+# children 2i and 2i + 1, and bucket b is node 2^depth + b). Every node's hash
+# is the XOR of hash(key, timestamp, value) over all keys beneath it, which
+# lets a write update the tree in O(depth) without rehashing anything else.
+# The value is in there for the rare two writes with equal timestamps, see
+# hybrid_clock.py.
+#
+# Two replicas with the same root hash hold the same versions of every key
+# (barring a 128-bit collision). If the roots differ, comparing children tells
+# them which half of the key space to look at, and so on down to the buckets
+# that actually need to be exchanged.
+
+import threading
+from hashlib import blake2b
+
+MERKLE_DEPTH = 16
+
+
+def entryHash(key: str, val_tuple: tuple[str | None, int, dict[str, int]]) -> int:
+    value, timestamp, _ = val_tuple
+    key_bytes = key.encode()
+    # A tombstone hashes differently from any value
+    value_bytes = b"" if value is None else b"v" + str(value).encode()
+    digest = blake2b(len(key_bytes).to_bytes(4, "little") + key_bytes +
+                     timestamp.to_bytes(16, "little", signed=True) + value_bytes, digest_size=16).digest()
+    return int.from_bytes(digest, "little")
+
+
+def bucketOf(key: str, depth: int = MERKLE_DEPTH) -> int:
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "little") >> (64 - depth)
+
+
+class MerkleTree:
+    def __init__(self, depth: int = MERKLE_DEPTH):
+        self.depth = depth
+        self.leaf_offset = 1 << depth
+        self.nodes = [0] * (2 << depth)
+        # bucket -> keys in it, so a bucket's contents can be found without a scan
+        self.buckets: dict[int, set[str]] = {}
+        self.lock = threading.Lock()
+
+    def bucketOf(self, key: str) -> int:
+        return bucketOf(key, self.depth)
+
+    def update(self, key: str, old_val: tuple | None, new_val: tuple) -> None:
+        """
+        Account for key moving from old_val (None if it's new) to new_val,
+        both (value, timestamp, dependencies).
+        """
+        bucket = self.bucketOf(key)
+        delta = entryHash(key, new_val)
+        if old_val is not None:
+            delta ^= entryHash(key, old_val)
+        with self.lock:
+            self.buckets.setdefault(bucket, set()).add(key)
+            node = self.leaf_offset + bucket
+            while node >= 1:
+                self.nodes[node] ^= delta
+                node >>= 1
+
+    def remove(self, key: str, val_tuple: tuple) -> None:
+        """
+        Take key, currently holding val_tuple, out of the tree entirely.
+        """
+        bucket = self.bucketOf(key)
+        delta = entryHash(key, val_tuple)
+        with self.lock:
+            if (bucket_keys := self.buckets.get(bucket)) is not None:
+                bucket_keys.discard(key)
+            node = self.leaf_offset + bucket
+            while node >= 1:
+                self.nodes[node] ^= delta
+                node >>= 1
+
+    def hashes(self, nodes: list[int]) -> dict[int, str]:
+        """
+        :return: node -> hash as hex for each of nodes, JSON friendly
+        """
+        return {int(node): format(self.nodes[int(node)], "x") for node in nodes}
+
+    def differing(self, their_hashes: dict[int, str]) -> list[int]:
+        """
+        :param their_hashes: node -> hash as returned by another tree's hashes()
+        :return: the nodes whose hash differs from ours
+        """
+        # node numbers arrive as strings when they've been through JSON
+        return [int(node) for node, node_hash in their_hashes.items() if self.nodes[int(node)] != int(node_hash, 16)]
+
+    def keysIn(self, buckets: list[int]) -> list[str]:
+        with self.lock:
+            return [key for bucket in buckets for key in self.buckets.get(bucket, ())]
+
+    @staticmethod
+    def descendants(nodes: list[int], levels: int) -> list[int]:
+        """
+        :return: all nodes levels below each of nodes
+        """
+        return [(node << levels) + i for node in nodes for i in range(1 << levels)]
+
+    @classmethod
+    def fromItems(cls, items, depth: int = MERKLE_DEPTH) -> "MerkleTree":
+        """
+        Build a tree from (key, (value, timestamp, dependencies)) pairs in one
+        pass, filling in the leaves first and then every level above them.
+        """
+        tree = cls(depth)
+        for key, val_tuple in items:
+            bucket = tree.bucketOf(key)
+            tree.buckets.setdefault(bucket, set()).add(key)
+            tree.nodes[tree.leaf_offset + bucket] ^= entryHash(key, val_tuple)
+        for node in range(tree.leaf_offset - 1, 0, -1):
+            tree.nodes[node] = tree.nodes[2 * node] ^ tree.nodes[2 * node + 1]
+        return tree
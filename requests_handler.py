@@ -1,8 +1,23 @@
 import asyncio
 import aiohttp
 import os
+import threading
+from collections.abc import AsyncIterator
 
 ALLOWED_REQUEST_TYPES = {"GET", "PUT", "DELETE", "POST"}
+# Most requests the replication sender will hold on to before it starts
+# dropping new ones (gossip still delivers whatever it drops)
+REPLICATION_QUEUE_SIZE = 10000
+REPLICATION_RETRIES = 5
+# Seconds before the first retry; doubles on every attempt
+REPLICATION_BACKOFF = 0.1
+REPLICATION_TIMEOUT = 10
+# Keep-alive connections kept open to each peer
+REPLICATION_CONNECTIONS_PER_PEER = 8
+# Writes for one peer are held back for up to REPLICATION_BATCH_WINDOW seconds,
+# or until REPLICATION_BATCH_SIZE distinct keys are waiting, and sent together
+REPLICATION_BATCH_WINDOW = 0.005
+REPLICATION_BATCH_SIZE = 500
 
 
 class KVSRequest:
@@ -32,6 +47,21 @@ class KVSRequest:
         except asyncio.TimeoutError:
             print(f"Request to {url} timed out!")
 
+    async def executeRequestJSON(self, session: aiohttp.ClientSession) -> tuple[int, dict] | None:
+        """
+        Same as executeRequest, but reads the response too.
+        :return: (status, JSON body), or None if the request failed or the
+                 body isn't JSON (e.g. an error page from a proxy)
+        """
+        if (response := await self.executeRequest(session)) is None:
+            return None
+        try:
+            return response.status, await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"Reading response from http://{self.hostname}{self.endpoint} failed: {e!r}")
+        finally:
+            response.release()
+
 
 def executeRequestsFork(request_list: list[KVSRequest], timeout=300):
     """
@@ -54,15 +84,168 @@ def executeRequestsFork(request_list: list[KVSRequest], timeout=300):
 async def asyncExecuteRequests(request_list: list[KVSRequest], timeout=300, process_requests=False):
     client_timeout = aiohttp.ClientTimeout(total=timeout)
     async with aiohttp.ClientSession(timeout=client_timeout) as session:
-        client_responses = await asyncio.gather(*[request.executeRequest(session) for request in request_list])
-        processed_responses: list[tuple[int, dict]] = []
         if process_requests:
-            for client_response in client_responses:
-                if client_response is None:
-                    return processed_responses
-                json = await client_response.json()
-                status = client_response.status
-                processed_responses.append((status, json))
-            return processed_responses
-        else:
-            return None
+            processed_responses = await asyncio.gather(*[request.executeRequestJSON(session)
+                                                         for request in request_list])
+            # Skip peers that failed rather than dropping everyone after them
+            return [response for response in processed_responses if response is not None]
+        client_responses = await asyncio.gather(*[request.executeRequest(session) for request in request_list])
+        for client_response in client_responses:
+            if client_response is not None:
+                client_response.release()
+        return None
+
+
+async def asyncIterResponses(request_list: list[KVSRequest], timeout=300) -> AsyncIterator[tuple[int, dict]]:
+    """
+    Send every request at once, yielding (status, JSON body) for each as soon
+    as it answers; failed ones are skipped. Whatever hasn't answered by the
+    time the caller stops iterating is cancelled.
+    :param timeout: time in seconds before a request fails; default: 300
+    """
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(timeout=client_timeout) as session:
+        tasks = [asyncio.ensure_future(request.executeRequestJSON(session)) for request in request_list]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                if (response := await next_done) is not None:
+                    yield response
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class ReplicationSender:
+    def __init__(self, max_queued: int = REPLICATION_QUEUE_SIZE, retries: int = REPLICATION_RETRIES,
+                 timeout: float = REPLICATION_TIMEOUT):
+        """
+        Long-lived sender for requests to other nodes: a background thread runs
+        an event loop with one aiohttp session, so connections to each peer are
+        kept alive and reused. Callers just enqueue() and return.
+        :param max_queued: requests in flight or waiting past which new ones are dropped
+        :param retries: attempts per request before giving up on it
+        :param timeout: time in seconds before a single attempt fails
+        """
+        self.max_queued = max_queued
+        self.retries = retries
+        self.timeout = timeout
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.session: aiohttp.ClientSession | None = None
+        # (node, endpoint) -> key -> latest (value, timestamp, dependencies)
+        # waiting to go out, and the timer that will flush it. Only touched
+        # from the sender thread.
+        self.write_buffers: dict[tuple[str, str], dict[str, tuple]] = {}
+        self.flush_timers: dict[tuple[str, str], asyncio.TimerHandle] = {}
+        self.started = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+        self.started.wait()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._createSession())
+        self.started.set()
+        self.loop.run_forever()
+
+    async def _createSession(self) -> None:
+        # The session and its connection pool have to be created on our loop
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit_per_host=REPLICATION_CONNECTIONS_PER_PEER),
+        )
+
+    def enqueue(self, request_list: list[KVSRequest]) -> None:
+        """
+        Hand requests to the sender thread; never blocks on the network.
+        """
+        with self.pending_lock:
+            accepted = max(min(len(request_list), self.max_queued - self.pending), 0)
+            self.pending += accepted
+        if accepted < len(request_list):
+            print(f"Replication queue full, dropping {len(request_list) - accepted} requests")
+        for request in request_list[:accepted]:
+            asyncio.run_coroutine_threadsafe(self._send(request), self.loop)
+
+    def enqueueWrites(self, nodes: list[str], endpoint: str, writes: dict[str, tuple]) -> None:
+        """
+        Queue writes for each of nodes to be sent as {"writes": {key: (value,
+        timestamp, dependencies)}} batches to endpoint. Several writes to the
+        same key before a batch goes out collapse to the latest one.
+        """
+        self.loop.call_soon_threadsafe(self._bufferWrites, nodes, endpoint, writes)
+
+    def _bufferWrites(self, nodes: list[str], endpoint: str, writes: dict[str, tuple]) -> None:
+        for node in nodes:
+            buffer = self.write_buffers.setdefault((node, endpoint), {})
+            dropped = 0
+            for key, value_tuple in writes.items():
+                if (buffered := buffer.get(key)) is not None:
+                    # last writer wins, same as the receiving end would decide
+                    if buffered[1] <= value_tuple[1]:
+                        buffer[key] = value_tuple
+                    continue
+                with self.pending_lock:
+                    if self.pending >= self.max_queued:
+                        dropped += 1
+                        continue
+                    self.pending += 1
+                buffer[key] = value_tuple
+            if dropped:
+                print(f"Replication queue full, dropping {dropped} writes for {node}")
+
+            if len(buffer) >= REPLICATION_BATCH_SIZE:
+                self._flushWrites(node, endpoint)
+            elif buffer and (node, endpoint) not in self.flush_timers:
+                self.flush_timers[(node, endpoint)] = self.loop.call_later(
+                    REPLICATION_BATCH_WINDOW, self._flushWrites, node, endpoint)
+
+    def _flushWrites(self, node: str, endpoint: str) -> None:
+        if (timer := self.flush_timers.pop((node, endpoint), None)) is not None:
+            timer.cancel()
+        batch = self.write_buffers.pop((node, endpoint), None)
+        if batch:
+            request = KVSRequest(node, endpoint, "PUT", {"writes": batch})
+            self.loop.create_task(self._send(request, len(batch)))
+
+    async def _send(self, request: KVSRequest, weight: int = 1) -> None:
+        """
+        :param weight: how many entries of the pending count this request stands for
+        """
+        try:
+            for attempt in range(self.retries):
+                response = await request.executeRequest(self.session)
+                if response is not None:
+                    # Give the connection back to the pool
+                    response.release()
+                    if response.status < 400:
+                        return
+                    # The peer won't take it however often we ask, but it
+                    # didn't get it either; say so rather than drop it quietly
+                    if response.status < 500:
+                        print(f"{request.hostname} rejected {request.request_type} {request.endpoint} "
+                              f"({response.status})")
+                        return
+                await asyncio.sleep(REPLICATION_BACKOFF * 2 ** attempt)
+            print(f"Giving up on {request.request_type} {request.hostname}{request.endpoint}")
+        finally:
+            with self.pending_lock:
+                self.pending -= weight
+
+
+_replication_sender: ReplicationSender | None = None
+_replication_sender_pid: int | None = None
+_replication_sender_lock = threading.Lock()
+
+
+def getReplicationSender() -> ReplicationSender:
+    """
+    The current process's ReplicationSender, started on first use. A forked
+    child doesn't inherit the parent's sender thread, so it gets its own.
+    """
+    global _replication_sender, _replication_sender_pid
+    with _replication_sender_lock:
+        if _replication_sender is None or _replication_sender_pid != os.getpid():
+            _replication_sender = ReplicationSender()
+            _replication_sender_pid = os.getpid()
+        return _replication_sender
@@ -0,0 +1,268 @@
+# A log-structured storage engine for LocalKVS for stores larger than memory.
+#
+# Values live in append-only, memory-mapped segment files on disk. All that is
+# kept in RAM is a key directory mapping each key to the (segment, offset,
+# timestamp) of its latest record, so memory use is proportional to the number
+# of keys rather than to the size of their values and dependency dicts.
+#
+# Segment record layout:
+#   u32 crc32(key + payload), u32 key_len, u32 payload_len, key, pickled payload
+# where payload is the usual (value, timestamp, dependencies) tuple.
+#
+# Overwritten records become garbage in their segment. A background thread
+# compacts sealed segments that are mostly garbage by copying their live
+# records to the active segment and deleting the file.
+
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+from collections.abc import Iterator, Mapping, MutableMapping
+from time import sleep
+
+RECORD_HEADER = struct.Struct("<III")
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Compact a sealed segment once this fraction of it is overwritten records
+COMPACTION_THRESHOLD = 0.5
+COMPACTION_INTERVAL = 10
+
+
+class Segment:
+    def __init__(self, path: str, segment_id: int, size: int):
+        """
+        A single preallocated segment file, mapped into memory. Records are
+        written through the mapping; the OS decides when to write them back.
+        :param path: file backing the segment; created with the given size if missing
+        :param segment_id: position of this segment in the log
+        :param size: size to preallocate for new segments
+        """
+        self.path = path
+        self.segment_id = segment_id
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(size)
+        with open(path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.size = len(self.map)
+        self.write_offset = 0
+        # bytes belonging to records that are still the latest for their key
+        self.live_bytes = 0
+
+    def append(self, key: bytes, payload: bytes) -> int | None:
+        """
+        :return: offset the record was written at, or None if it doesn't fit
+        """
+        record_len = RECORD_HEADER.size + len(key) + len(payload)
+        if self.write_offset + record_len > self.size:
+            return None
+        offset = self.write_offset
+        RECORD_HEADER.pack_into(self.map, offset, zlib.crc32(key + payload), len(key), len(payload))
+        self.map[offset + RECORD_HEADER.size:offset + record_len] = key + payload
+        self.write_offset += record_len
+        return offset
+
+    def read(self, offset: int) -> tuple[bytes, bytes, int]:
+        """
+        :return: (key, payload, record length) of the record at offset
+        """
+        crc, key_len, payload_len = RECORD_HEADER.unpack_from(self.map, offset)
+        key_start = offset + RECORD_HEADER.size
+        key = self.map[key_start:key_start + key_len]
+        payload = self.map[key_start + key_len:key_start + key_len + payload_len]
+        return key, payload, RECORD_HEADER.size + key_len + payload_len
+
+    def scan(self) -> Iterator[tuple[int, bytes, bytes]]:
+        """
+        Yield (offset, key, payload) for each intact record, stopping at the
+        zeroed tail of the preallocated file or at a torn record.
+        """
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            crc, key_len, payload_len = RECORD_HEADER.unpack_from(self.map, offset)
+            if key_len == 0 or offset + RECORD_HEADER.size + key_len + payload_len > self.size:
+                break
+            key, payload, record_len = self.read(offset)
+            if zlib.crc32(key + payload) != crc:
+                break
+            yield offset, key, payload
+            offset += record_len
+        self.write_offset = offset
+
+    def close(self) -> None:
+        self.map.flush()
+        self.map.close()
+
+
+class SegmentSnapshot(Mapping):
+    """
+    Read-only, point-in-time view of a SegmentStore, as returned by
+    SegmentStore.copy(). Only the key directory is copied; values are read from
+    the segments lazily as the snapshot is iterated, so iterating a store much
+    larger than memory never holds more than one value at a time.
+    """
+    def __init__(self, directory: dict[str, tuple[int, int, int]], segments: dict[int, Segment]):
+        self.directory = directory
+        # Holding on to the Segment objects keeps their mappings alive even if
+        # compaction deletes the files underneath us
+        self.segments = segments
+
+    def __getitem__(self, key: str) -> tuple[str | None, int, dict[str, int]]:
+        segment_id, offset, _ = self.directory[key]
+        return pickle.loads(self.segments[segment_id].read(offset)[1])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.directory)
+
+    def __len__(self) -> int:
+        return len(self.directory)
+
+    def timestamp(self, key: str) -> int:
+        """
+        Timestamp of key straight from the key directory, without touching disk.
+        """
+        return self.directory[key][2]
+
+    def __reduce__(self):
+        # Sending a snapshot to another process (e.g. through the KVS manager)
+        # has to materialize it
+        return dict, (dict(self.items()),)
+
+
+class SegmentStore(MutableMapping):
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        """
+        Open (or create) a segment store in directory, rebuilding the key
+        directory from the segments already there.
+        :param directory: where segment files are kept
+        :param segment_size: preallocated size of each segment file
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.data_dir = directory
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+        self.directory: dict[str, tuple[int, int, int]] = {}
+        self.segments: dict[int, Segment] = {}
+
+        segment_ids = sorted(int(name[4:-4]) for name in os.listdir(directory)
+                             if name.startswith("seg.") and name.endswith(".dat"))
+        for segment_id in segment_ids:
+            segment = Segment(self._segmentPath(segment_id), segment_id, segment_size)
+            self.segments[segment_id] = segment
+            for offset, key, payload in segment.scan():
+                _, timestamp, _ = pickle.loads(payload)
+                self._point(key.decode(), segment_id, offset, timestamp, RECORD_HEADER.size + len(key) + len(payload))
+
+        # Carry on appending where the last run left off
+        self.active = self.segments[segment_ids[-1]] if segment_ids else self._newSegment(0)
+        threading.Thread(target=self._compactionDaemon, daemon=True).start()
+
+    def _segmentPath(self, segment_id: int) -> str:
+        return os.path.join(self.data_dir, f"seg.{segment_id:010d}.dat")
+
+    def _newSegment(self, segment_id: int, min_size: int = 0) -> Segment:
+        segment = Segment(self._segmentPath(segment_id), segment_id, max(self.segment_size, min_size))
+        self.segments[segment_id] = segment
+        return segment
+
+    def _point(self, key: str, segment_id: int, offset: int, timestamp: int, record_len: int) -> None:
+        """
+        Point key's directory entry at a new record, updating the live byte
+        counts used to decide what to compact.
+        """
+        if (old_entry := self.directory.get(key)) is not None:
+            old_segment = self.segments[old_entry[0]]
+            old_segment.live_bytes -= old_segment.read(old_entry[1])[2]
+        self.directory[key] = (segment_id, offset, timestamp)
+        self.segments[segment_id].live_bytes += record_len
+
+    def _append(self, key: bytes, payload: bytes) -> tuple[int, int]:
+        offset = self.active.append(key, payload)
+        if offset is None:
+            self.active.map.flush()
+            record_len = RECORD_HEADER.size + len(key) + len(payload)
+            self.active = self._newSegment(self.active.segment_id + 1, record_len)
+            offset = self.active.append(key, payload)
+        return self.active.segment_id, offset
+
+    # --- MutableMapping -----------------------------------------------------
+
+    def __getitem__(self, key: str) -> tuple[str | None, int, dict[str, int]]:
+        with self.lock:
+            segment_id, offset, _ = self.directory[key]
+            return pickle.loads(self.segments[segment_id].read(offset)[1])
+
+    def __setitem__(self, key: str, val_tuple: tuple[str | None, int, dict[str, int]]) -> None:
+        key_bytes = key.encode()
+        payload = pickle.dumps(val_tuple, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            segment_id, offset = self._append(key_bytes, payload)
+            self._point(key, segment_id, offset, val_tuple[1], RECORD_HEADER.size + len(key_bytes) + len(payload))
+
+    def __delitem__(self, key: str) -> None:
+        # Records for key are left for compaction to clean up. Without a
+        # tombstone record the key would reappear on restart, so only use this
+        # for keys that are also being removed from every other replica.
+        with self.lock:
+            segment_id, offset, _ = self.directory.pop(key)
+            segment = self.segments[segment_id]
+            segment.live_bytes -= segment.read(offset)[2]
+
+    def __contains__(self, key) -> bool:
+        return key in self.directory
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.copy().directory)
+
+    def __len__(self) -> int:
+        return len(self.directory)
+
+    def copy(self) -> SegmentSnapshot:
+        with self.lock:
+            return SegmentSnapshot(self.directory.copy(), self.segments.copy())
+
+    def clear(self) -> None:
+        with self.lock:
+            # Outstanding snapshots keep their own references to the mappings
+            for segment in self.segments.values():
+                os.remove(segment.path)
+            self.directory = {}
+            self.segments = {}
+            self.active = self._newSegment(self.active.segment_id + 1)
+
+    # --- compaction ---------------------------------------------------------
+
+    def compact(self) -> int:
+        """
+        Rewrite the live records of sealed segments that are mostly garbage
+        into the active segment and delete them.
+        :return: number of segments reclaimed
+        """
+        with self.lock:
+            candidates = [segment for segment in self.segments.values()
+                          if segment is not self.active and
+                          segment.live_bytes < segment.write_offset * (1 - COMPACTION_THRESHOLD)]
+        reclaimed = 0
+        for segment in candidates:
+            # Move records one at a time so writers only wait for a single copy
+            for offset, key_bytes, payload in segment.scan():
+                key = key_bytes.decode()
+                with self.lock:
+                    entry = self.directory.get(key)
+                    if entry is None or entry[0] != segment.segment_id or entry[1] != offset:
+                        continue
+                    segment_id, new_offset = self._append(key_bytes, payload)
+                    self._point(key, segment_id, new_offset, entry[2],
+                                RECORD_HEADER.size + len(key_bytes) + len(payload))
+            with self.lock:
+                self.active.map.flush()
+                del self.segments[segment.segment_id]
+                os.remove(segment.path)
+            reclaimed += 1
+        return reclaimed
+
+    def _compactionDaemon(self) -> None:
+        while True:
+            sleep(COMPACTION_INTERVAL)
+            self.compact()
@@ -0,0 +1,669 @@
+# A LocalKVS backend that lives in a memory-mapped file instead of behind the
+# local_database.py manager process. Every Flask worker maps the same file and
+# reads/writes it directly, so a GET costs a lock and a hash probe rather than
+# a pickled proxy call over a localhost socket.
+#
+# File layout (all integers little-endian unsigned 64-bit unless noted):
+#   header:  magic, capacity, heap_end, heap_size, count, retired, clock, epoch
+#   tree:    2^(MERKLE_DEPTH + 1) u128 hash tree nodes, laid out as in merkle_tree.py
+#   slots:   capacity * (key_hash, record_offset), record_offset 0 == empty
+#   heap:    records of (u32 key_len, u32 payload_len, key, json payload)
+#
+# Records are append-only; an update appends a new record and repoints the
+# slot. When the heap or slot table fills up the writer rebuilds the table
+# into a new, larger file, atomically renames it over the old one and marks
+# the old mapping as retired so other processes know to reopen it.
+#
+# That makes the heap the change log delta gossip pages through: a record's
+# offset is its place in the log, and it's a live change for as long as its
+# key's slot points at it. A rebuild rewrites the heap, so it starts a new
+# epoch and peers get a full sync from us.
+#
+# The header's clock is the hybrid logical clock every process issues
+# timestamps from (see hybrid_clock.py), advanced under the same lock as the
+# writes it has to stay ahead of.
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from hashlib import blake2b
+from time import monotonic, sleep
+
+from hybrid_clock import NODE_ID, TIMESTAMP_STEP, nextTimestamp, observe, versionOrder
+from merkle_tree import MERKLE_DEPTH, MerkleTree, bucketOf, entryHash
+from vector_clock import fromDependencies, isVectorKey, toDependencies
+
+MAGIC = b"KVSSHM03"
+HEADER = struct.Struct("<8sQQQQQQQ")
+TREE_NODE_SIZE = 16
+TREE_START = HEADER.size
+SLOTS_START = TREE_START + (2 << MERKLE_DEPTH) * TREE_NODE_SIZE
+SLOT = struct.Struct("<QQ")
+RECORD_HEADER = struct.Struct("<II")
+
+DEFAULT_CAPACITY = 1 << 14
+DEFAULT_HEAP_SIZE = 1 << 24
+MAX_LOAD_FACTOR = 0.7
+# How often causal reads re-check the table while waiting for a write
+WAIT_POLL_INTERVAL = 0.005
+
+
+def _keyHash(key: bytes) -> int:
+    # Python's hash() is randomized per process, so we need a stable hash that
+    # every worker mapping the table agrees on. Never return 0 so that an empty
+    # slot can't be mistaken for a key.
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+class SharedKVS:
+    def __init__(self, path: str, node_id: int = NODE_ID):
+        """
+        Shared-memory implementation of the LocalKVS API. Safe to use from
+        several processes and threads at once.
+        :param path: file to map, preferably on a tmpfs such as /dev/shm
+        :param node_id: low bits of every timestamp we issue, see hybrid_clock.py
+        """
+        self.path = path
+        self.lock_path = path + ".lock"
+        # flock() is held per open file description, so threads in the same
+        # process would share it; serialize them with a regular lock first
+        self.thread_lock = threading.Lock()
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.map: mmap.mmap | None = None
+        self.capacity = 0
+        self.heap_start = 0
+        self.node_id = node_id
+
+        self._lock(fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(self.path):
+                self._create(self.path, {})
+            self._open()
+        finally:
+            self._unlock()
+
+    # --- locking and mapping ------------------------------------------------
+
+    def _lock(self, mode: int) -> None:
+        self.thread_lock.acquire()
+        fcntl.flock(self.lock_fd, mode)
+
+    def _unlock(self) -> None:
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def _open(self) -> None:
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        magic, self.capacity, _, _, _, _, _, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a shared KVS file")
+        self.heap_start = SLOTS_START + self.capacity * SLOT.size
+
+    def _ensureCurrent(self) -> None:
+        # Another process may have rebuilt the table into a new file; it flags
+        # the old one as retired before releasing the lock
+        if self._header()[5]:
+            self._open()
+
+    def _header(self) -> tuple[bytes, int, int, int, int, int, int, int]:
+        return HEADER.unpack_from(self.map, 0)
+
+    def _setHeader(self, heap_end: int, count: int, retired: int = 0) -> None:
+        _, capacity, _, heap_size, _, _, clock, epoch = self._header()
+        HEADER.pack_into(self.map, 0, MAGIC, capacity, heap_end, heap_size, count, retired, clock, epoch)
+
+    def _setClock(self, clock: int) -> None:
+        _, capacity, heap_end, heap_size, count, retired, _, epoch = self._header()
+        HEADER.pack_into(self.map, 0, MAGIC, capacity, heap_end, heap_size, count, retired, clock, epoch)
+
+    def _epoch(self) -> str:
+        return format(self._header()[7], "016x")
+
+    @staticmethod
+    def _create(path: str, contents: dict[str, tuple[str | None, int, dict[str, int]]], extra: int = 0,
+                clock: int = 0) -> None:
+        """
+        Write a fresh table containing contents to path via a temporary file,
+        then atomically move it into place, starting a new change log epoch.
+        The table is sized so that both the slots and the heap have room for at
+        least as much again as contents.
+        :param extra: additional heap bytes the caller is about to append
+        :param clock: the clock to carry over from the table being replaced
+        """
+        records = [(key.encode(), SharedKVS._encodeRecord(key.encode(), val_tuple))
+                   for key, val_tuple in contents.items()]
+        capacity = DEFAULT_CAPACITY
+        while 2 * (len(records) + 1) > capacity * MAX_LOAD_FACTOR:
+            capacity *= 2
+        heap_size = DEFAULT_HEAP_SIZE
+        while heap_size < 2 * (sum(len(record) for _, record in records) + extra):
+            heap_size *= 2
+
+        heap_start = SLOTS_START + capacity * SLOT.size
+        tree = MerkleTree.fromItems(contents.items())
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w+b") as f:
+            f.truncate(heap_start + heap_size)
+            new_map = mmap.mmap(f.fileno(), 0)
+            new_map[TREE_START:SLOTS_START] = b"".join(node.to_bytes(TREE_NODE_SIZE, "little") for node in tree.nodes)
+            heap_end = heap_start
+            for key_bytes, record in records:
+                new_map[heap_end:heap_end + len(record)] = record
+                SharedKVS._insertSlot(new_map, capacity, _keyHash(key_bytes), heap_end)
+                heap_end += len(record)
+            epoch = int.from_bytes(os.urandom(8), "little")
+            HEADER.pack_into(new_map, 0, MAGIC, capacity, heap_end, heap_size, len(records), 0, clock, epoch)
+            new_map.flush()
+            new_map.close()
+        os.replace(tmp_path, path)
+
+    # --- records and slots --------------------------------------------------
+
+    @staticmethod
+    def _encodeRecord(key: bytes, val_tuple: tuple[str | None, int, dict[str, int]]) -> bytes:
+        payload = json.dumps(val_tuple, separators=(",", ":")).encode()
+        return RECORD_HEADER.pack(len(key), len(payload)) + key + payload
+
+    def _readRecord(self, offset: int) -> tuple[bytes, bytes]:
+        key_len, payload_len = RECORD_HEADER.unpack_from(self.map, offset)
+        key_start = offset + RECORD_HEADER.size
+        payload_start = key_start + key_len
+        return self.map[key_start:payload_start], self.map[payload_start:payload_start + payload_len]
+
+    @staticmethod
+    def _recordSize(key: bytes, payload: bytes) -> int:
+        return RECORD_HEADER.size + len(key) + len(payload)
+
+    @staticmethod
+    def _decodePayload(payload: bytes) -> tuple[str | None, int, dict[str, int]]:
+        value, timestamp, dependencies = json.loads(payload)
+        return value, timestamp, dependencies
+
+    @staticmethod
+    def _insertSlot(table: mmap.mmap, capacity: int, key_hash: int, offset: int) -> None:
+        index = key_hash % capacity
+        while SLOT.unpack_from(table, SLOTS_START + index * SLOT.size)[1] != 0:
+            index = (index + 1) % capacity
+        SLOT.pack_into(table, SLOTS_START + index * SLOT.size, key_hash, offset)
+
+    def _findSlot(self, key: bytes) -> tuple[int, int]:
+        """
+        Linear probe for key.
+        :return: (slot index, record offset); offset is 0 if key is absent and
+                 the index is then the empty slot where it would be inserted
+        """
+        key_hash = _keyHash(key)
+        index = key_hash % self.capacity
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.map, SLOTS_START + index * SLOT.size)
+            if offset == 0:
+                return index, 0
+            if slot_hash == key_hash and self._readRecord(offset)[0] == key:
+                return index, offset
+            index = (index + 1) % self.capacity
+
+    def _items(self):
+        for index in range(self.capacity):
+            _, offset = SLOT.unpack_from(self.map, SLOTS_START + index * SLOT.size)
+            if offset != 0:
+                key, payload = self._readRecord(offset)
+                yield key.decode(), self._decodePayload(payload)
+
+    def _rebuild(self, contents: dict[str, tuple[str | None, int, dict[str, int]]], extra: int = 0) -> None:
+        self._create(self.path, contents, extra, self._header()[6])
+        # Let everyone still mapping the old file know it's stale
+        _, _, heap_end, _, count, _, _, _ = self._header()
+        self._setHeader(heap_end, count, retired=1)
+        self._open()
+
+    # --- LocalKVS API -------------------------------------------------------
+
+    def setDictValue(self, key: str, value: str | None, timestamp: int, dependencies: dict[str, int] | None) -> bool:
+        """
+        Same semantics as LocalKVS.setDictValue: last writer wins on timestamp.
+        :return: bool of whether the key was replaced or not
+        """
+        if dependencies is None:
+            dependencies = {}
+        # ignore dependencies on self
+        dependencies.pop(key, None)
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            return self._setLocked(key, value, timestamp, dependencies)
+        finally:
+            self._unlock()
+
+    def setDictValues(self, entries: dict[str, tuple[str | None, int, dict[str, int]]]) -> dict[str, bool]:
+        """
+        Same as LocalKVS.setDictValues: apply a batch under a single lock.
+        """
+        replaced = {}
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            for key, (value, timestamp, dependencies) in entries.items():
+                dependencies = dict(dependencies or {})
+                dependencies.pop(key, None)
+                replaced[key] = self._setLocked(key, value, timestamp, dependencies)
+            return replaced
+        finally:
+            self._unlock()
+
+    def mergeEntries(self, entries: dict[str, tuple[str | None, int, dict[str, int]]]) \
+            -> tuple[bool, dict[str, tuple[str, int, dict[str, int]]]]:
+        """
+        Same as LocalKVS.mergeEntries, under a single lock.
+        """
+        changed = False
+        newer = {}
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            for key, (value, timestamp, dependencies) in entries.items():
+                if (old_val := self._getLocked(key)) is not None and \
+                        versionOrder(old_val) >= versionOrder((value, timestamp)):
+                    if versionOrder(old_val) > versionOrder((value, timestamp)):
+                        newer[key] = old_val
+                    continue
+                dependencies = dict(dependencies or {})
+                dependencies.pop(key, None)
+                self._setLocked(key, value, timestamp, dependencies)
+                changed = True
+            return changed, newer
+        finally:
+            self._unlock()
+
+    def getDictValues(self, keys: list[str]) -> dict[str, tuple[str, int, dict[str, int]] | None]:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return {key: self._getLocked(key) for key in keys}
+        finally:
+            self._unlock()
+
+    def _getLocked(self, key: str) -> tuple[str, int, dict[str, int]] | None:
+        _, offset = self._findSlot(key.encode())
+        if offset == 0:
+            return None
+        return self._decodePayload(self._readRecord(offset)[1])
+
+    def _setLocked(self, key: str, value: str | None, timestamp: int, dependencies: dict[str, int]) -> bool:
+        """
+        Body of setDictValue; caller must hold the exclusive lock.
+        """
+        # A timestamp from a badly wrong clock mustn't drag ours along
+        self._setClock(observe(self._header()[6], timestamp))
+        key_bytes = key.encode()
+        index, offset = self._findSlot(key_bytes)
+        old_val = None
+        if offset != 0:
+            old_val = self._decodePayload(self._readRecord(offset)[1])
+            # don't overwrite if we have a newer val, or the same timestamp's
+            # winner
+            if versionOrder(old_val) > versionOrder((value, timestamp)):
+                return True
+
+        record = self._encodeRecord(key_bytes, (value, timestamp, dependencies))
+        _, _, heap_end, heap_size, count, _, _, _ = self._header()
+        new_count = count if offset != 0 else count + 1
+        if heap_end + len(record) > self.heap_start + heap_size or \
+                new_count > self.capacity * MAX_LOAD_FACTOR:
+            contents = dict(self._items())
+            contents[key] = (value, timestamp, dependencies)
+            self._rebuild(contents, len(record))
+            return offset != 0
+
+        self.map[heap_end:heap_end + len(record)] = record
+        SLOT.pack_into(self.map, SLOTS_START + index * SLOT.size, _keyHash(key_bytes), heap_end)
+        self._setHeader(heap_end + len(record), new_count)
+        self._updateTree(key, old_val, (value, timestamp, dependencies))
+        return offset != 0
+
+    def _treeNode(self, node: int) -> int:
+        start = TREE_START + node * TREE_NODE_SIZE
+        return int.from_bytes(self.map[start:start + TREE_NODE_SIZE], "little")
+
+    def _updateTree(self, key: str, old_val: tuple | None, new_val: tuple) -> None:
+        """
+        Same as MerkleTree.update, on the tree in the file. Caller must hold
+        the exclusive lock.
+        """
+        delta = entryHash(key, new_val)
+        if old_val is not None:
+            delta ^= entryHash(key, old_val)
+        node = (1 << MERKLE_DEPTH) + bucketOf(key)
+        while node >= 1:
+            start = TREE_START + node * TREE_NODE_SIZE
+            self.map[start:start + TREE_NODE_SIZE] = (self._treeNode(node) ^ delta).to_bytes(TREE_NODE_SIZE, "little")
+            node >>= 1
+
+    def getDictValue(self, key: str) -> tuple[str, int, dict[str, int]] | None:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return self._getLocked(key)
+        finally:
+            self._unlock()
+
+    def waitForVersion(self, key: str, version: int, timeout: float) -> tuple[str, int, dict[str, int]] | None:
+        """
+        Same as LocalKVS.waitForVersion. Writers may be in any process, so
+        there is nobody to wake us up; poll every WAIT_POLL_INTERVAL instead.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            val_tuple = self.getDictValue(key)
+            if (val_tuple is not None and val_tuple[1] >= version) or monotonic() >= deadline:
+                return val_tuple
+            sleep(min(WAIT_POLL_INTERVAL, max(deadline - monotonic(), 0)))
+
+    def waitForVersions(self, versions: dict[str, int], timeout: float) -> bool:
+        deadline = monotonic() + timeout
+        for key, version in versions.items():
+            val_tuple = self.waitForVersion(key, version, max(deadline - monotonic(), 0))
+            if val_tuple is None or val_tuple[1] < version:
+                return False
+        return True
+
+    def getChangesSince(self, since: int, epoch: str | None) \
+            -> tuple[str, int, dict[str, tuple[str, int, dict[str, int]]]]:
+        """
+        Same as LocalKVS.getChangesSince; sequence numbers are heap offsets.
+        """
+        current_epoch, current_seq, changes, _ = self.getChangePage(since, epoch, None)
+        return current_epoch, current_seq, changes
+
+    def getChangePage(self, since: int, epoch: str | None, limit: int | None) \
+            -> tuple[str, int, dict[str, tuple[str, int, dict[str, int]]], bool]:
+        """
+        Same as LocalKVS.getChangePage, walking the heap from since and
+        skipping records that have been superseded since they were written.
+        """
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            current_epoch = self._epoch()
+            heap_end = self._header()[2]
+            offset = since if epoch == current_epoch and self.heap_start <= since <= heap_end else self.heap_start
+            changes = {}
+            page_seq, complete = heap_end, True
+            while offset < heap_end:
+                key, payload = self._readRecord(offset)
+                if self._findSlot(key)[1] == offset:
+                    if limit is not None and len(changes) == limit:
+                        # Everything before this record has been sent or superseded
+                        page_seq, complete = offset, False
+                        break
+                    changes[key.decode()] = self._decodePayload(payload)
+                offset += self._recordSize(key, payload)
+            return current_epoch, page_seq, changes, complete
+        finally:
+            self._unlock()
+
+    def getChangePosition(self) -> tuple[str, int]:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return self._epoch(), self._header()[2]
+        finally:
+            self._unlock()
+
+    def getMerkleHashes(self, nodes: list[int]) -> dict[int, str]:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return {int(node): format(self._treeNode(int(node)), "x") for node in nodes}
+        finally:
+            self._unlock()
+
+    def compareMerkleHashes(self, their_hashes: dict[int, str]) -> list[int]:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return [int(node) for node, node_hash in their_hashes.items()
+                    if self._treeNode(int(node)) != int(node_hash, 16)]
+        finally:
+            self._unlock()
+
+    # Nothing indexes keys by bucket here, so these scan the store. Peers only
+    # ask for the buckets whose hashes differ.
+
+    def getBucketEntries(self, buckets: list[int]) -> dict[str, tuple[str, int, dict[str, int]]]:
+        wanted = set(buckets)
+        return {key: val_tuple for key, val_tuple in self.getDict().items() if bucketOf(key) in wanted}
+
+    def getBucketPage(self, buckets: list[int], limit: int) -> tuple[dict[str, tuple[str, int, dict[str, int]]], int]:
+        by_bucket: dict[int, dict[str, tuple[str, int, dict[str, int]]]] = {}
+        for key, val_tuple in self.getDict().items():
+            by_bucket.setdefault(bucketOf(key), {})[key] = val_tuple
+        entries = {}
+        covered = 0
+        for bucket in buckets:
+            if covered and len(entries) >= limit:
+                break
+            entries.update(by_bucket.get(bucket, {}))
+            covered += 1
+        return entries, covered
+
+    def listKeys(self, cursor: str | None, limit: int) -> tuple[dict[str, int], str | None]:
+        """
+        Same as LocalKVS.listKeys, paging through the slot table. Slots only
+        move when the table is rebuilt, so cursors carry the capacity they
+        were taken at.
+        """
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            index = 0
+            if cursor is not None:
+                capacity, index = cursor.split(":")
+                if int(capacity) != self.capacity:
+                    raise ValueError("cursor is from before the store was resized, start the listing over")
+                index = int(index)
+            page = {}
+            end = min(index + limit, self.capacity)
+            for slot in range(index, end):
+                _, offset = SLOT.unpack_from(self.map, SLOTS_START + slot * SLOT.size)
+                if offset != 0:
+                    key, payload = self._readRecord(offset)
+                    value, timestamp, _ = self._decodePayload(payload)
+                    if value is not None:
+                        page[key.decode()] = timestamp
+            return page, None if end >= self.capacity else f"{self.capacity}:{end}"
+        finally:
+            self._unlock()
+
+    def scanKeys(self, start: str, end: str | None, limit: int) \
+            -> tuple[dict[str, tuple[str, int, dict[str, int]]], str | None]:
+        """
+        Same as LocalKVS.scanKeys. The table is ordered by hash, so this sorts
+        the matching keys on every call.
+        """
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            matching = sorted((key, val_tuple) for key, val_tuple in self._items()
+                              if key >= start and (end is None or key < end))
+        finally:
+            self._unlock()
+        entries = {key: val_tuple for key, val_tuple in matching[:limit] if val_tuple[0] is not None}
+        return entries, matching[limit][0] if len(matching) > limit else None
+
+    def getConsistentValue(self, key: str, metadata: dict[str, int]) -> tuple[str, int, dict[str, int]] | None:
+        """
+        Same as LocalKVS.getConsistentValue, except that only the current
+        version is kept here, so it's that or nothing.
+        """
+        val_tuple = self.getDictValue(key)
+        if val_tuple is None or val_tuple[1] < metadata.get(key, val_tuple[1]):
+            return None
+        if all(d_ver <= metadata[d_key] for d_key, d_ver in val_tuple[2].items() if d_key in metadata):
+            return val_tuple
+        return None
+
+    # Frontiers are gossiped into the gossip process's own copy of the KVS
+    # object, which the Flask workers never see, so the stable cut stays at 0
+    # and nothing is pruned with this backend.
+
+    def updateFrontiers(self, frontiers: dict[str, int], view: list[str] | None = None) -> dict[str, int]:
+        return {}
+
+    def getStableCut(self) -> int:
+        return 0
+
+    def collectTombstones(self) -> int:
+        # With no stable cut, no tombstone is ever known to be everywhere
+        return 0
+
+    # The same goes for the origin frontiers vector clock metadata is checked
+    # against, so the endpoints don't accept vector mode metadata with this
+    # backend (see local_database.supportsVectorMode()).
+
+    def getVector(self) -> dict[str, int]:
+        clock = {}
+        for _, _, dependencies in self.getDict().values():
+            for node, timestamp in fromDependencies(dependencies).items():
+                clock[node] = max(timestamp, clock.get(node, timestamp))
+        return clock
+
+    def updateOriginFrontier(self, node: str, timestamp: int) -> None:
+        pass
+
+    def updateOwnFrontier(self, own_node: str, view: list[str]) -> None:
+        pass
+
+    def waitForVector(self, clock: dict[str, int], own_node: str, timeout: float) -> bool:
+        return all(node == own_node for node in clock)
+
+    def newTimestamp(self, observed: int = 0, count: int = 1) -> int:
+        """
+        Same as LocalKVS.newTimestamp, from the clock every process shares.
+        """
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            return self._issueTimestamps(observed, count)
+        finally:
+            self._unlock()
+
+    def _issueTimestamps(self, observed: int, count: int) -> int:
+        """
+        newTimestamp(), for a caller already holding the exclusive lock.
+        """
+        timestamp = nextTimestamp(self._header()[6], observed, self.node_id)
+        self._setClock(timestamp + (count - 1) * TIMESTAMP_STEP)
+        return timestamp
+
+    def reserveTimestamps(self, observed: int = 0, count: int = 1) -> int:
+        # Our origin frontier never moves with this backend, see getOriginFrontier()
+        return self.newTimestamp(observed, count)
+
+    def releaseTimestamps(self, timestamp: int) -> None:
+        pass
+
+    def setOwnValue(self, key: str, value: str | None, observed: int, dependencies: dict[str, int]) \
+            -> tuple[int, bool]:
+        """
+        Same as LocalKVS.setOwnValue, issuing the timestamp and writing under
+        one lock.
+        """
+        dependencies = dict(dependencies)
+        dependencies.pop(key, None)
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            timestamp = self._issueTimestamps(observed, 1)
+            return timestamp, self._setLocked(key, value, timestamp, dependencies)
+        finally:
+            self._unlock()
+
+    def setOwnVectorValue(self, key: str, value: str | None, clock: dict[str, int], own_node: str) \
+            -> tuple[int, bool]:
+        """
+        Same as LocalKVS.setOwnVectorValue, issuing the timestamp and writing
+        under one lock.
+        """
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            timestamp = self._issueTimestamps(max(clock.values(), default=0), 1)
+            dependencies = toDependencies({**clock, own_node: timestamp})
+            return timestamp, self._setLocked(key, value, timestamp, dependencies)
+        finally:
+            self._unlock()
+
+    def getOriginFrontier(self) -> int:
+        # Client writes may be in flight in any process, and nothing tracks
+        # them across processes, so we can't vouch for any timestamp. This
+        # holds back peers' frontiers, and so the stable cut, rather than risk it.
+        return 0
+
+    def getMissingDependencies(self) -> dict[str, int]:
+        """
+        Same as LocalKVS.getMissingDependencies, but there's no index shared
+        between processes to keep up to date, so this scans the store.
+        """
+        contents = self.getDict()
+        missing = {}
+        for key, (_, _, dependencies) in contents.items():
+            for d_key, d_ver in dependencies.items():
+                if isVectorKey(d_key):
+                    continue
+                if d_key not in contents or contents[d_key][1] < d_ver:
+                    missing[d_key] = max(d_ver, missing.get(d_key, d_ver))
+        return missing
+
+    def getEntryCounts(self) -> dict[str, int]:
+        contents = self.getDict()
+        tombstones = sum(1 for value, _, _ in contents.values() if value is None)
+        return {"live": len(contents) - tombstones, "tombstones": tombstones}
+
+    def removeDictValue(self, key: str, timestamp: int, dependencies: dict[str, int]) -> bool:
+        """
+        Same as setDictValue, but always sets value to None
+        """
+        return self.setDictValue(key, None, timestamp, dependencies)
+
+    def setDict(self, val: dict[str, tuple[str, int, dict[str, int]]]) -> None:
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._ensureCurrent()
+            self._rebuild(val)
+        finally:
+            self._unlock()
+
+    def getDict(self) -> dict[str, tuple[str, int, dict[str, int]]]:
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._ensureCurrent()
+            return dict(self._items())
+        finally:
+            self._unlock()
+
+
+class SharedKVSManager:
+    """
+    Stand-in for KVSManager when the shared-memory backend is selected, so
+    callers keep doing getKVSManager() -> connect() -> get().
+    """
+    # One mapping per process, no matter how many requests call connect()
+    _instances: dict[str, SharedKVS] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def connect(self) -> None:
+        with self._instances_lock:
+            if self.path not in self._instances:
+                self._instances[self.path] = SharedKVS(self.path)
+
+    def get(self) -> SharedKVS:
+        return self._instances[self.path]
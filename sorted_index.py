@@ -0,0 +1,113 @@
+# Ordered index of every key in LocalKVS, for prefix and range scans.
+#
+# Keys are kept in a list of sorted chunks, plus the last key of each chunk so
+# the right chunk can be found by bisection. Inserting shifts at most one
+# chunk of CHUNK_SIZE keys rather than the whole key space, and a chunk that
+# grows past twice that is split in two. Keys only leave the index when
+# LocalKVS garbage collects their tombstones; replacing the store wholesale
+# builds a new index.
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Iterator
+
+CHUNK_SIZE = 1000
+
+
+def prefixEnd(prefix: str) -> str | None:
+    """
+    :return: the smallest string greater than every string starting with
+             prefix, or None if there isn't one (i.e. scan to the end)
+    """
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedKeys:
+    def __init__(self):
+        self.chunks: list[list[str]] = []
+        self.maxes: list[str] = []
+        self.lock = threading.Lock()
+
+    def add(self, key: str) -> None:
+        """
+        Add a key that isn't in the index yet.
+        """
+        with self.lock:
+            if not self.chunks:
+                self.chunks.append([key])
+                self.maxes.append(key)
+                return
+            index = min(bisect_left(self.maxes, key), len(self.chunks) - 1)
+            chunk = self.chunks[index]
+            insort(chunk, key)
+            self.maxes[index] = chunk[-1]
+            if len(chunk) > 2 * CHUNK_SIZE:
+                self.chunks[index:index + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+                self.maxes[index:index + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            index = bisect_left(self.maxes, key)
+            if index == len(self.chunks):
+                return
+            chunk = self.chunks[index]
+            position = bisect_left(chunk, key)
+            if position == len(chunk) or chunk[position] != key:
+                return
+            del chunk[position]
+            if len(chunk) == 0:
+                del self.chunks[index]
+                del self.maxes[index]
+            else:
+                self.maxes[index] = chunk[-1]
+
+    def range(self, start: str, end: str | None, limit: int) -> list[str]:
+        """
+        :return: up to limit keys k with start <= k < end (no upper bound if
+                 end is None), in order
+        """
+        keys = []
+        with self.lock:
+            index = bisect_left(self.maxes, start)
+            position = bisect_left(self.chunks[index], start) if index < len(self.chunks) else 0
+            while index < len(self.chunks) and len(keys) < limit:
+                chunk = self.chunks[index]
+                stop = len(chunk) if end is None else bisect_left(chunk, end)
+                keys.extend(chunk[position:min(stop, position + limit - len(keys))])
+                if stop < len(chunk):
+                    break
+                index, position = index + 1, 0
+        return keys
+
+    def __iter__(self) -> Iterator[str]:
+        with self.lock:
+            chunks = [chunk.copy() for chunk in self.chunks]
+        for chunk in chunks:
+            yield from chunk
+
+    def __len__(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            index = bisect_left(self.maxes, key)
+            if index == len(self.chunks):
+                return False
+            chunk = self.chunks[index]
+            position = bisect_right(chunk, key)
+            return position > 0 and chunk[position - 1] == key
+
+    @classmethod
+    def fromKeys(cls, keys) -> "SortedKeys":
+        """
+        Build an index from keys in any order in one sort.
+        """
+        index = cls()
+        keys = sorted(keys)
+        index.chunks = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        index.maxes = [chunk[-1] for chunk in index.chunks]
+        return index
@@ -1,4 +1,14 @@
 # Tests that work exclusively with the flask endpoints to ensure functionality
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import time_ns
+
+from flask_app import our_address
+from modules import hash_ring, local_database
+from modules.hybrid_clock import MAX_CLOCK_DRIFT
+from modules.local_database import getKVSManager
+from modules.view_tracker import getViewManager
 
 
 def test_view_set_retrieve(flaskClient, resetViewTracker):
@@ -8,6 +18,17 @@ def test_view_set_retrieve(flaskClient, resetViewTracker):
     assert response.json == test_view
 
 
+def test_view_ready(flaskClient, resetViewTracker, resetLocalDatabase):
+    data = {"val": "1", "causal-metadata": {}}
+    # a client starting a new cluster: there's nothing to catch up on
+    flaskClient.put("/kvs/admin/view", json={"view": [our_address]})
+    assert flaskClient.put("/kvs/data/x", json=data).status_code == 201
+    flaskClient.delete("/kvs/admin/view")
+    # a member adding us to its view: gossip has to bootstrap us first
+    flaskClient.put("/kvs/admin/view", json={"view": [our_address], "bootstrap": True})
+    assert flaskClient.put("/kvs/data/x", json=data).status_code == 503
+
+
 def test_uninitialized(flaskClient, resetViewTracker):
     response = flaskClient.delete("/kvs/admin/view")
     expected_error = {"error": "uninitialized"}
@@ -34,6 +55,38 @@ def test_put_data(flaskClient, initNode, resetLocalDatabase):
     assert response.status_code == 200
 
 
+def test_bad_causal_metadata(flaskClient, initNode, resetLocalDatabase):
+    # versions far in the future would drag every node's clock along
+    for metadata in [{"zz": 10 ** 30}, {"zz": "1"}, {"zz": -1}, {"vc": {"n1": 10 ** 40}}, [1]]:
+        response = flaskClient.put("/kvs/data/x", json={"val": "1", "causal-metadata": metadata})
+        assert response.status_code == 400
+        response = flaskClient.get("/kvs/data/x", json={"causal-metadata": metadata})
+        assert response.status_code == 400
+    response = flaskClient.put("/kvs/data/x", json={"val": "1", "causal-metadata": {}, "timestamp": 10 ** 40})
+    assert response.status_code == 400
+
+    response = flaskClient.put("/kvs/data/x", json={"val": "1", "causal-metadata": {}})
+    assert response.status_code == 201
+
+
+def test_replicated_writes(flaskClient, initNode, resetLocalDatabase):
+    response = flaskClient.put("/kvs/replicate", json={"writes": {"x": ["1", 10, {"y": 5}], "y": [None, 11, {}]}})
+    assert response.status_code == 200
+    response = flaskClient.get("/kvs/data/x", json={"causal-metadata": {}})
+    assert response.json["val"] == "1"
+
+    for write in ["bad", ["1", 10], [1, 10, {}], ["1", "10", {}], ["1", 10, []], ["1", 10, {"y": "5"}]]:
+        response = flaskClient.put("/kvs/replicate", json={"writes": {"z": write}})
+        assert response.status_code == 400
+    # a malformed write doesn't cost us the rest of the batch, and a peer's
+    # clock running ahead of ours isn't malformed: gossip would accept it
+    ahead = time_ns() + 2 * MAX_CLOCK_DRIFT
+    response = flaskClient.put("/kvs/replicate", json={"writes": {"z": "bad", "w": ["1", ahead, {}]}})
+    assert response.status_code == 400 and response.json["rejected"] == ["z"]
+    response = flaskClient.get("/kvs/data/w", json={"causal-metadata": {}})
+    assert response.json["val"] == "1"
+
+
 def test_put_gossip_(flaskClient, initNode, resetLocalDatabase):
     kvs_content = {"x": (1, 10, {})}
     data = {"origin": "10.10.0.5", "kvs": kvs_content.copy()}
@@ -48,3 +101,180 @@ def test_put_gossip_(flaskClient, initNode, resetLocalDatabase):
     assert (
         response.json == expected_kvs_response
     )  # tuples are serialized and turned into json arrays
+
+
+def test_gossip_fetch(flaskClient, initNode, resetLocalDatabase):
+    data = {"origin": "10.10.0.5", "kvs": {"x": ("1", 10, {}), "y": ("2", 20, {})}}
+    flaskClient.put("/gossip", json=data)
+
+    # only keys at or past the requested version come back
+    response = flaskClient.put("/gossip/fetch", json={"keys": {"x": 5, "y": 25, "z": 1}})
+    assert response.status_code == 200
+    assert response.json == {"x": ["1", 10, {}]}
+    response = flaskClient.put("/gossip/fetch", json={"key": ["x"]})
+    assert response.status_code == 400
+
+
+def test_put_delta_gossip(flaskClient, initNode, resetLocalDatabase):
+    data = {"origin": "10.10.0.5", "kvs": {"x": ("1", 10, {})},
+            "epoch": "a", "seq": 1, "peer_epoch": None, "since": 0}
+    response = flaskClient.put("/gossip", json=data)
+    assert response.status_code == 201
+    # what we just sent isn't echoed back
+    assert response.json["kvs"] == {}
+    epoch, seq = response.json["epoch"], response.json["seq"]
+
+    flaskClient.put("/kvs/data/y", json={"val": "2", "causal-metadata": {}})
+    data = {"origin": "10.10.0.5", "kvs": {}, "epoch": "a", "seq": 1, "peer_epoch": epoch, "since": seq}
+    response = flaskClient.put("/gossip", json=data)
+    assert response.status_code == 200
+    assert list(response.json["kvs"].keys()) == ["y"]
+
+
+def test_batch_data(flaskClient, initNode, resetLocalDatabase):
+    data = {"causal-metadata": {}, "operations": [
+        {"op": "PUT", "key": "x", "val": "1"},
+        {"op": "PUT", "key": "y", "val": "2"},
+        {"op": "GET", "key": "x"},
+        {"op": "DELETE", "key": "y"},
+        {"op": "GET", "key": "y"},
+        {"op": "GET", "key": "z"},
+    ]}
+    response = flaskClient.post("/kvs/data", json=data)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json["results"]] == [201, 201, 200, 200, 404, 404]
+    assert response.json["results"][2]["val"] == "1"
+    assert set(response.json["causal-metadata"].keys()) == {"x", "y"}
+
+    response = flaskClient.post("/kvs/data", json={"causal-metadata": {}, "operations": [{"op": "PUT", "key": "x"}]})
+    assert response.status_code == 400
+
+
+def test_get_data_pages(flaskClient, initNode, resetLocalDatabase):
+    for key in ["a", "b", "c"]:
+        flaskClient.put(f"/kvs/data/{key}", json={"val": key, "causal-metadata": {}})
+    flaskClient.delete("/kvs/data/b", json={"causal-metadata": {}})
+
+    response = flaskClient.get("/kvs/data", json={"causal-metadata": {}})
+    assert response.status_code == 200
+    assert sorted(response.json["keys"]) == ["a", "c"]
+    assert set(response.json["causal-metadata"].keys()) == {"a", "c"}
+
+    keys = []
+    data = {"causal-metadata": {}, "page-size": 1}
+    while True:
+        response = flaskClient.get("/kvs/data", json=data)
+        assert response.status_code == 200
+        keys.extend(response.json["keys"])
+        if response.json["cursor"] is None:
+            break
+        data["cursor"] = response.json["cursor"]
+    assert sorted(keys) == ["a", "c"]
+
+    for cursor in [7, "nonsense", "a:b:c:d"]:
+        response = flaskClient.get("/kvs/data", json={"causal-metadata": {}, "page-size": 1, "cursor": cursor})
+        assert response.status_code == 400
+
+    response = flaskClient.get("/kvs/data", json={"causal-metadata": {}, "stream": True})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert sorted(key for line in lines[:-1] for key in line["keys"]) == ["a", "c"]
+    assert lines[-1]["count"] == 2
+
+    # a listing can't carry on past the store being replaced
+    response = flaskClient.get("/kvs/data", json={"causal-metadata": {}, "page-size": 1})
+    kvs_manager = getKVSManager()
+    kvs_manager.connect()
+    kvs_manager.get().setDict({})
+    response = flaskClient.get("/kvs/data", json={"causal-metadata": {}, "page-size": 1,
+                                                  "cursor": response.json["cursor"]})
+    assert response.status_code == 410
+
+
+def test_scan_data(flaskClient, initNode, resetLocalDatabase):
+    for key in ["user1", "user2", "view1"]:
+        flaskClient.put(f"/kvs/data/{key}", json={"val": key, "causal-metadata": {}})
+
+    response = flaskClient.get("/kvs/data/scan/prefix", json={"causal-metadata": {}, "prefix": "user", "limit": 1})
+    assert response.json["kvs"] == {"user1": "user1"}
+    response = flaskClient.get("/kvs/data/scan/prefix",
+                               json={"causal-metadata": {}, "prefix": "user", "start": response.json["next"]})
+    assert response.json["kvs"] == {"user2": "user2"} and response.json["next"] is None
+    assert "user2" in response.json["causal-metadata"]
+
+    response = flaskClient.get("/kvs/data/scan/range", json={"causal-metadata": {}, "start": "user2", "end": "z"})
+    assert list(response.json["kvs"]) == ["user2", "view1"]
+
+
+def test_vector_clock_metadata(flaskClient, initNode, resetLocalDatabase):
+    response = flaskClient.put("/kvs/data/x", json={"val": "1", "causal-metadata": {"vc": {}}})
+    assert response.status_code == 201
+    clock = response.json["causal-metadata"]["vc"]
+    assert len(clock) == 1
+
+    response = flaskClient.get("/kvs/data/x", json={"causal-metadata": {"vc": clock}})
+    assert response.json == {"val": "1", "causal-metadata": {"vc": clock}}
+    response = flaskClient.get("/kvs/data", json={"causal-metadata": {"vc": {}}})
+    assert response.json["keys"] == ["x"] and response.json["causal-metadata"] == {"vc": clock}
+
+    # old style metadata still works alongside, without picking up the clock
+    response = flaskClient.get("/kvs/data/x", json={"causal-metadata": {}})
+    assert list(response.json["causal-metadata"]) == ["x"]
+
+
+def test_vector_clock_metadata_unsupported(flaskClient, initNode, resetLocalDatabase, monkeypatch):
+    # the shared memory backend can't tell when it has caught up with a clock
+    monkeypatch.setattr(local_database, "KVS_BACKEND", "shared_memory")
+    metadata = {"causal-metadata": {"vc": {"127.0.0.1:1": 1}}}
+    for response in [flaskClient.get("/kvs/data/x", json=metadata), flaskClient.get("/kvs/data", json=metadata),
+                     flaskClient.put("/kvs/data/x", json={"val": "1", **metadata}),
+                     flaskClient.delete("/kvs/data/x", json=metadata)]:
+        assert response.status_code == 400 and "vector clock" in response.json["error"]
+
+
+class FakeReplica(ThreadingHTTPServer):
+    def __init__(self, status: int, body: dict):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.address = f"127.0.0.1:{self.server_address[1]}"
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+def test_forward_request(flaskClient, initNode, resetLocalDatabase, monkeypatch):
+    monkeypatch.setattr(hash_ring, "REPLICATION_FACTOR", 2)
+    # a replica that has just taken the key over and one that has it
+    new_owner = FakeReplica(404, {"causal-metadata": {}})
+    old_owner = FakeReplica(200, {"val": "theirs", "causal-metadata": {}})
+    view = [our_address, new_owner.address, old_owner.address]
+    key = next(key for key in (f"key{i}" for i in range(1000))
+               if hash_ring.ownersOf(key, view) == [new_owner.address, old_owner.address])
+    view_manager = getViewManager()
+    view_manager.connect()
+    view_manager.get().setView(view)
+    client = {"REMOTE_ADDR": "10.10.0.9"}
+    try:
+        response = flaskClient.get(f"/kvs/data/{key}", json={"causal-metadata": {}}, environ_base=client)
+        assert response.status_code == 200 and response.json["val"] == "theirs"
+
+        # a client can't get us to serve a key we don't store by claiming to be a peer
+        response = flaskClient.get(f"/kvs/data/{key}", json={"causal-metadata": {}, "forwarded": True},
+                                   environ_base=client)
+        assert response.status_code == 200
+        response = flaskClient.get(f"/kvs/data/{key}", json={"causal-metadata": {}, "forwarded": True},
+                                   environ_base={"REMOTE_ADDR": "127.0.0.1"})
+        assert response.status_code == 404
+    finally:
+        view_manager.get().setView([])
+        new_owner.shutdown()
+        old_owner.shutdown()
@@ -0,0 +1,226 @@
+# Tests for the gossip process. Peers are small aiohttp servers in the test
+# process backed by their own LocalKVS, so no manager processes are needed.
+import asyncio
+import socket
+
+import aiohttp
+from aiohttp import web
+
+import gossip
+from local_database import LocalKVS
+
+
+async def startPeer(routes: dict[str, callable]) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    for path, handler in routes.items():
+        app.router.add_put(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"127.0.0.1:{port}"
+
+
+def peerRoutes(peer: LocalKVS, delay: float = 0, connections: set | None = None) -> dict[str, callable]:
+    """
+    What a ready peer serves: snapshot pages for a bootstrapping node, delta
+    rounds and hash tree checks.
+    :param delay: seconds each delta round takes
+    :param connections: collects the client end of every connection used
+    """
+    async def snapshot(request):
+        body = await request.json()
+        epoch, seq = peer.getChangePosition()
+        entries, covered = peer.getBucketPage(range(body["start"], body["end"]), body["limit"])
+        next_bucket = body["start"] + covered if body["start"] + covered < body["end"] else None
+        return web.json_response({"kvs": entries, "next": next_bucket, "epoch": epoch, "seq": seq})
+
+    async def delta(request):
+        if connections is not None:
+            connections.add(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(delay)
+        body = await request.json()
+        peer.mergeEntries(body["kvs"])
+        origin_frontier = peer.getOriginFrontier()
+        epoch, seq, changes, complete = peer.getChangePage(body["since"], body["peer_epoch"], body["limit"])
+        return web.json_response({"kvs": changes, "epoch": epoch, "seq": seq, "complete": complete,
+                                  "frontiers": {}, "origin_frontier": origin_frontier})
+
+    async def merkle(request):
+        body = await request.json()
+        epoch, seq = peer.getChangePosition()
+        return web.json_response({"differing": peer.compareMerkleHashes(body["hashes"]), "epoch": epoch, "seq": seq,
+                                  "frontiers": {}, "origin_frontier": peer.getOriginFrontier()})
+
+    async def buckets(request):
+        body = await request.json()
+        entries, covered = peer.getBucketPage(body["buckets"], body["limit"])
+        peer.mergeEntries(body["kvs"])
+        return web.json_response({"kvs": entries, "covered": covered})
+
+    return {gossip.SNAPSHOT_ENDPOINT: snapshot, gossip.GOSSIP_ENDPOINT: delta, gossip.MERKLE_ENDPOINT: merkle,
+            gossip.MERKLE_BUCKETS_ENDPOINT: buckets}
+
+
+class FakeManager:
+    def __init__(self, served):
+        """
+        Stands in for a manager connection, handing out served directly.
+        """
+        self.served = served
+
+    def connect(self):
+        pass
+
+    def get(self):
+        return self.served
+
+
+class FakeViewTracker:
+    def __init__(self, view: list[str]):
+        self.view = view
+
+    def isInitialized(self) -> bool:
+        return True
+
+    def isReady(self) -> bool:
+        return True
+
+    def getView(self) -> list[str]:
+        return self.view
+
+
+def closedAddress() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{s.getsockname()[1]}"
+
+
+def test_bootstrap_copies_store(monkeypatch):
+    async def run():
+        peer = LocalKVS()
+        for i in range(500):
+            peer.setDictValue(f"key{i}", "v", i + 1, {})
+        runner, address = await startPeer(peerRoutes(peer))
+        kvs = LocalKVS()
+        try:
+            async with aiohttp.ClientSession() as session:
+                assert await gossip.bootstrap([address], kvs, session)
+        finally:
+            await runner.cleanup()
+        assert kvs.getDict() == peer.getDict()
+        # later rounds with the peer carry on from where bootstrap left off
+        assert gossip.peer_states[address].peer_epoch == peer.getChangePosition()[0]
+        # and we have every vector mode write the peer had accepted by then
+        assert 0 < gossip.peer_states[address].origin_frontier <= peer.getOriginFrontier()
+
+    monkeypatch.setattr(gossip, "GOSSIP_CHUNK_SIZE", 50)
+    asyncio.run(run())
+
+
+def test_bootstrap_waits_for_unreachable_peer(monkeypatch):
+    async def run():
+        kvs = LocalKVS()
+        address = closedAddress()
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=1)) as session:
+            assert not await gossip.bootstrap([address], kvs, session)
+            # but not forever: a peer down for long enough counts as empty
+            await asyncio.sleep(.3)
+            assert await gossip.bootstrap([address], kvs, session)
+        assert kvs.getDict() == {}
+        assert gossip.unreachable_since == {}
+
+    monkeypatch.setattr(gossip, "unreachable_since", {})
+    monkeypatch.setattr(gossip, "BOOTSTRAP_UNREACHABLE_TIMEOUT", .2)
+    asyncio.run(run())
+
+
+def test_bootstrap_new_cluster():
+    async def run():
+        entries = 0
+
+        async def notReady(request):
+            return web.json_response({"error": "not ready", "entries": entries}, status=503)
+
+        runner, address = await startPeer({gossip.SNAPSHOT_ENDPOINT: notReady})
+        try:
+            async with aiohttp.ClientSession() as session:
+                # everyone is new and empty
+                assert await gossip.bootstrap([address], LocalKVS(), session)
+                # a peer that isn't ready but has data is worth waiting for
+                entries = 10
+                assert not await gossip.bootstrap([address], LocalKVS(), session)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_engine_doesnt_wait_on_slow_peer(monkeypatch):
+    async def run():
+        slow_runner, slow = await startPeer(peerRoutes(LocalKVS(), delay=2))
+        connections = set()
+        fast_store = LocalKVS()
+        fast_runner, fast = await startPeer(peerRoutes(fast_store, connections=connections))
+        kvs = LocalKVS()
+        monkeypatch.setattr(gossip, "getViewManager", lambda: FakeManager(FakeViewTracker([slow, fast])))
+        monkeypatch.setattr(gossip, "getKVSManager", lambda: FakeManager(kvs))
+        engine = asyncio.create_task(gossip.send_gossip())
+        try:
+            for i in range(5):
+                fast_store.setDictValue(f"key{i}", "v", i + 1, {})
+                await asyncio.sleep(.2)
+            # the exchange stuck on the slow peer doesn't hold up rounds with
+            # the fast one: we catch up well before it's done
+            deadline = asyncio.get_running_loop().time() + .5
+            while kvs.getDict() != fast_store.getDict() and asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(.02)
+        finally:
+            engine.cancel()
+            await slow_runner.cleanup()
+            await fast_runner.cleanup()
+        assert kvs.getDict() == fast_store.getDict()
+        # and every round went over the same pooled connections
+        assert 0 < len(connections) <= gossip.GOSSIP_CONNECTIONS_PER_PEER
+
+    monkeypatch.setattr(gossip, "peer_states", {})
+    monkeypatch.setattr(gossip, "GOSSIP_MIN_INTERVAL", .02)
+    asyncio.run(run())
+
+
+def test_pacer_interval(monkeypatch):
+    monkeypatch.setattr(gossip, "GOSSIP_MIN_INTERVAL", .1)
+    monkeypatch.setattr(gossip, "GOSSIP_MAX_INTERVAL", .5)
+    pacer = gossip.GossipPacer()
+    assert pacer.nextInterval(("epoch", 1)) == .1
+    # nothing new here or anywhere else, back off up to the maximum
+    assert [pacer.nextInterval(("epoch", 1)) for _ in range(4)] == [.2, .4, .5, .5]
+    # a write here
+    assert pacer.nextInterval(("epoch", 2)) == .1
+    assert pacer.nextInterval(("epoch", 2)) == .2
+
+    async def exchange(found_something: bool) -> bool:
+        return found_something
+
+    async def run():
+        for found_something in [False, True]:
+            task = asyncio.create_task(exchange(found_something))
+            await task
+            pacer.exchangeDone(task)
+
+    # an exchange that found replicas disagreeing
+    asyncio.run(run())
+    assert pacer.nextInterval(("epoch", 2)) == .1
+
+
+def test_choose_peers(monkeypatch):
+    monkeypatch.setattr(gossip, "MY_ADDRESS", "n0")
+    view = [f"n{i}" for i in range(6)]
+    for _ in range(50):
+        peers = gossip.choosePeers(view, {"n1"}, 3)
+        assert len(set(peers)) == 3 and not {"n0", "n1"} & set(peers)
+    assert sorted(gossip.choosePeers(view, {"n1", "n2"}, 10)) == ["n3", "n4", "n5"]
+    assert gossip.choosePeers(["n0"], set(), 2) == []
+    # every peer gets picked eventually
+    assert set().union(*(gossip.choosePeers(view, set(), 1) for _ in range(200))) == set(view) - {"n0"}
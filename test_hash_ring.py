@@ -0,0 +1,44 @@
+# Tests for key placement in partitioned mode
+import hash_ring
+from hash_ring import HashRing, isPartitioned, ownersOf, stores
+
+VIEW = [f"10.10.0.{i}:8090" for i in range(2, 6)]
+
+
+def test_ring_owners():
+    ring = HashRing(VIEW)
+    owners = ring.owners("x", 3)
+    assert len(set(owners)) == 3 and set(owners) <= set(VIEW)
+    # there are only so many nodes to go around
+    assert sorted(ring.owners("x", 10)) == sorted(VIEW)
+    # every node builds the same ring, whatever order it has the view in
+    assert HashRing(VIEW[::-1]).owners("x", 3) == owners
+
+
+def test_ring_balance_and_movement():
+    keys = [f"key{i}" for i in range(4000)]
+    ring = HashRing(VIEW)
+    first_owners = {key: ring.owners(key, 1)[0] for key in keys}
+    for node in VIEW:
+        assert 0.15 < list(first_owners.values()).count(node) / len(keys) < 0.35
+
+    # a new node only takes keys over, it doesn't shuffle the others around
+    grown = HashRing(VIEW + ["10.10.0.6:8090"])
+    moved = [key for key in keys if grown.owners(key, 1)[0] != first_owners[key]]
+    assert all(grown.owners(key, 1)[0] == "10.10.0.6:8090" for key in moved)
+    assert len(moved) < len(keys) / 3
+
+
+def test_stores(monkeypatch):
+    monkeypatch.setattr(hash_ring, "REPLICATION_FACTOR", 0)
+    assert not isPartitioned(VIEW)
+    assert ownersOf("x", VIEW) == VIEW
+    assert all(stores(node, "x", VIEW) for node in VIEW)
+
+    monkeypatch.setattr(hash_ring, "REPLICATION_FACTOR", 2)
+    assert isPartitioned(VIEW)
+    # a view no bigger than the replication factor stores everything everywhere
+    assert not isPartitioned(VIEW[:2])
+    owners = ownersOf("x", VIEW)
+    assert len(owners) == 2
+    assert [node for node in VIEW if stores(node, "x", VIEW)] == sorted(owners, key=VIEW.index)
@@ -0,0 +1,27 @@
+# Crash recovery tests for LocalKVS persistence; no manager processes needed.
+from kvs_wal import WriteAheadLog, _listSegments, _segmentName, replay
+from local_database import LocalKVS
+
+
+def test_recover_from_wal_and_snapshot(tmp_path):
+    kvs = LocalKVS()
+    kvs.enablePersistence(str(tmp_path), "always")
+    kvs.setDictValue("x", "1", 10, {"y": 5})
+    kvs._snapshot()
+    kvs.setDictValue("y", "2", 11, {})
+    kvs.removeDictValue("x", 12, {})
+
+    recovered = LocalKVS()
+    recovered.enablePersistence(str(tmp_path), "always")
+    assert recovered.getDict() == {"x": (None, 12, {}), "y": ("2", 11, {})}
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), "always")
+    wal.waitDurable(wal.append(("x", "1", 1, {})))
+    wal.waitDurable(wal.append(("y", "2", 2, {})))
+    wal.close()
+
+    segment = tmp_path / _segmentName(_listSegments(str(tmp_path))[-1])
+    segment.write_bytes(segment.read_bytes()[:-3])
+    assert list(replay(str(tmp_path), 0)) == [("x", "1", 1, {})]
@@ -0,0 +1,374 @@
+# Tests that exercise LocalKVS directly, without going through the manager
+from threading import Thread, Timer
+from time import monotonic, time_ns
+
+import pytest
+
+from hybrid_clock import MAX_CLOCK_DRIFT, TIMESTAMP_STEP
+from local_database import CHANGE_LOG_SLACK, LocalKVS, TOMBSTONE_GRACE
+from merkle_tree import MerkleTree
+from vector_clock import toDependencies
+
+
+def test_wait_for_version_wakes_on_write():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "old", 1, {})
+    Timer(.05, kvs.setDictValue, args=("x", "new", 5, {})).start()
+    start = monotonic()
+    assert kvs.waitForVersion("x", 5, 5) == ("new", 5, {})
+    assert monotonic() - start < 1
+    assert kvs.waiters == {}
+
+
+def test_wait_for_versions_timeout():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "1", 3, {})
+    assert kvs.waitForVersions({"x": 3}, 0)
+    assert not kvs.waitForVersions({"x": 3, "y": 1}, .05)
+    assert kvs.waiters == {}
+
+
+def test_changes_since():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "1", 1, {})
+    epoch, seq, changes = kvs.getChangesSince(0, None)
+    assert changes == {"x": ("1", 1, {})}
+
+    kvs.setDictValue("y", "2", 2, {})
+    kvs.setDictValue("x", "old", 0, {})
+    assert kvs.getChangesSince(seq, epoch)[2] == {"y": ("2", 2, {})}
+
+    # a reset starts a new epoch, so anyone holding the old one gets everything
+    kvs.setDict({"z": ("3", 3, {})})
+    new_epoch, _, changes = kvs.getChangesSince(seq, epoch)
+    assert new_epoch != epoch
+    assert changes == {"z": ("3", 3, {})}
+
+
+def test_change_and_bucket_pages():
+    kvs = LocalKVS()
+    for i in range(25):
+        kvs.setDictValue(f"key{i}", "v", i, {})
+    epoch, seq, collected = None, 0, {}
+    while True:
+        epoch, seq, changes, complete = kvs.getChangePage(seq, epoch, 10)
+        assert len(changes) <= 10
+        collected.update(changes)
+        if complete:
+            break
+    assert collected == kvs.getDict()
+    assert kvs.getChangePage(seq, epoch, 10)[2:] == ({}, True)
+
+    # keys rewritten over and over only show up once, at their last change,
+    # however often the change log gets compacted in between
+    for i in range(5000):
+        kvs.setDictValue(f"key{i % 5}", "v", 100 + i, {})
+    since, collected = seq, {}
+    while True:
+        epoch, since, changes, complete = kvs.getChangePage(since, epoch, 2)
+        collected.update(changes)
+        if complete:
+            break
+    assert collected == {f"key{i}": kvs.getDict()[f"key{i}"] for i in range(5)}
+    assert len(kvs.change_seqs) <= 2 * len(kvs.change_log) + CHANGE_LOG_SLACK
+
+    buckets = sorted({kvs.merkle.bucketOf(f"key{i}") for i in range(25)})
+    collected = {}
+    while buckets:
+        entries, covered = kvs.getBucketPage(buckets, 10)
+        assert covered > 0 and (len(entries) <= 10 or covered == 1)
+        collected.update(entries)
+        buckets = buckets[covered:]
+    assert collected == kvs.getDict()
+
+
+def test_concurrent_striped_access():
+    kvs = LocalKVS(lock_stripes=4)
+    errors = []
+
+    def writer(offset: int):
+        try:
+            # every writer hits every key, each with its own timestamps
+            for timestamp in range(offset, 2000, 4):
+                kvs.setDictValue(f"key{timestamp % 50}", str(timestamp), timestamp, {})
+        except Exception as e:
+            errors.append(e)
+
+    def snapshotter():
+        try:
+            for _ in range(200):
+                assert all(val_tuple == (str(val_tuple[1]), val_tuple[1], {})
+                           for val_tuple in kvs.getDict().values())
+                list(kvs.kvs_dict)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=writer, args=(offset,)) for offset in range(4)] + [Thread(target=snapshotter)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # last writer wins however the writes interleaved
+    assert kvs.getDict() == {f"key{i}": (str(1950 + i), 1950 + i, {}) for i in range(50)}
+    # and the hash tree, kept up to date under the stripe locks, agrees with the store
+    assert kvs.merkle.hashes([1]) == MerkleTree.fromItems(kvs.getDict().items()).hashes([1])
+
+
+def test_merkle_finds_differing_bucket():
+    a, b = LocalKVS(), LocalKVS()
+    for i in range(1000):
+        a.setDictValue(f"key{i}", "v", i, {})
+        b.setDictValue(f"key{i}", "v", i, {})
+    assert b.compareMerkleHashes(a.getMerkleHashes([1])) == []
+
+    b.setDictValue("key7", "newer", 5000, {})
+    frontier = b.compareMerkleHashes(a.getMerkleHashes([1]))
+    while frontier[0] < a.merkle.leaf_offset:
+        frontier = b.compareMerkleHashes(a.getMerkleHashes(a.merkle.descendants(frontier, 1)))
+    assert list(b.getBucketEntries([frontier[0] - a.merkle.leaf_offset])) == ["key7"]
+
+    # the tree is built the same way incrementally and in bulk
+    b.setDict(b.getDict())
+    a.setDictValue("key7", "newer", 5000, {})
+    assert b.compareMerkleHashes(a.getMerkleHashes([1])) == []
+
+
+def test_set_dict_values_batch():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "newest", 10, {})
+    replaced = kvs.setDictValues({"x": ("stale", 5, {}), "y": ("1", 6, {"y": 1, "x": 10}), "z": (None, 7, None)})
+    assert replaced == {"x": True, "y": False, "z": False}
+    assert kvs.getDict() == {"x": ("newest", 10, {}), "y": ("1", 6, {"x": 10}), "z": (None, 7, {})}
+    assert kvs.getDictValues(["x", "w"]) == {"x": ("newest", 10, {}), "w": None}
+
+
+def test_merge_entries():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "ours", 10, {})
+    kvs.setDictValue("y", "ours", 1, {})
+    changed, newer = kvs.mergeEntries({"x": ("theirs", 5, {}), "y": ("theirs", 2, {}), "z": ("theirs", 3, {})})
+    assert changed
+    assert newer == {"x": ("ours", 10, {})}
+    assert kvs.getDict() == {"x": ("ours", 10, {}), "y": ("theirs", 2, {}), "z": ("theirs", 3, {})}
+    assert kvs.mergeEntries({"y": ("theirs", 2, {})}) == (False, {})
+
+
+def test_missing_dependencies_index():
+    kvs = LocalKVS()
+    kvs.setDictValue("y", "1", 5, {"x": 3, "w": 1})
+    kvs.setDictValue("z", "1", 6, {"x": 4})
+    assert kvs.getMissingDependencies() == {"x": 4, "w": 1}
+    kvs.setDictValue("x", "1", 3, {})
+    assert kvs.getMissingDependencies() == {"x": 4, "w": 1}
+    kvs.setDictValue("x", "2", 4, {})
+    # y no longer depending on w resolves it too
+    kvs.setDictValue("y", "2", 7, {"x": 4})
+    assert kvs.getMissingDependencies() == {}
+    kvs.setDict({"a": ("1", 1, {"b": 2})})
+    assert kvs.getMissingDependencies() == {"b": 2}
+
+
+def test_list_keys_pages():
+    kvs = LocalKVS(lock_stripes=4)
+    kvs.setDict({f"k{i}": (None if i % 10 == 0 else "v", i, {}) for i in range(100)})
+    listed = {}
+    page, cursor = kvs.listKeys(None, 7)
+    listed.update(page)
+    while cursor is not None:
+        # keys written mid-listing don't disturb the ones already there
+        kvs.setDictValue(f"new{len(listed)}", "v", 1000, {})
+        page, cursor = kvs.listKeys(cursor, 7)
+        assert not listed.keys() & page.keys()
+        listed.update(page)
+    assert {key for key in listed if key.startswith("k")} == {f"k{i}" for i in range(100) if i % 10 != 0}
+    assert listed["k1"] == 1
+
+    _, cursor = kvs.listKeys(None, 1)
+    kvs.setDict({})
+    with pytest.raises(ValueError):
+        kvs.listKeys(cursor, 1)
+    with pytest.raises(ValueError):
+        kvs.listKeys("nonsense", 1)
+
+
+def test_scan_keys():
+    kvs = LocalKVS()
+    kvs.setDict({"user/1": ("a", 1, {}), "user/3": ("c", 3, {})})
+    kvs.setDictValue("user/2", "b", 2, {})
+    kvs.setDictValue("user/4", None, 4, {})
+    kvs.setDictValue("view/1", "v", 5, {})
+
+    entries, next_key = kvs.scanKeys("user/", "user0", 2)
+    assert list(entries) == ["user/1", "user/2"] and next_key == "user/3"
+    entries, next_key = kvs.scanKeys(next_key, "user0", 2)
+    # deleted keys count towards the limit but aren't returned
+    assert entries == {"user/3": ("c", 3, {})} and next_key is None
+    assert list(kvs.scanKeys("user/2", None, 10)[0]) == ["user/2", "user/3", "view/1"]
+
+
+def test_version_chains():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "1", 10, {})
+    kvs.setDictValue("x", "2", 20, {"y": 5})
+    kvs.setDictValue("x", "3", 30, {"y": 9})
+    # the newest version depends on a newer y than the client has seen
+    assert kvs.getConsistentValue("x", {"y": 6}) == ("2", 20, {"y": 5})
+    assert kvs.getConsistentValue("x", {"y": 6, "x": 25}) is None
+    assert kvs.getConsistentValue("x", {}) == ("3", 30, {"y": 9})
+
+    # a listing reads the store as of when it started
+    kvs.setDictValue("y", "1", 9, {})
+    page, cursor = kvs.listKeys(None, 1)
+    kvs.setDictValue("x", None, 40, {})
+    kvs.setDictValue("z", "1", 41, {})
+    while cursor is not None:
+        more, cursor = kvs.listKeys(cursor, 1)
+        page.update(more)
+    assert page == {"x": 30, "y": 9}
+
+    kvs.collectVersions()
+    assert kvs.versions == {}
+    with pytest.raises(ValueError):
+        kvs._valueAsOf("x", 35)
+
+
+def test_stable_cut_prunes_dependencies():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "1", 10, {"a": 3, "b": 8})
+    assert kvs.updateFrontiers({"n1": 5}, ["n1", "n2"]) == {"n1": 5}
+    assert kvs.getStableCut() == 0
+    kvs.updateFrontiers({"n1": 4, "n2": 6}, ["n1", "n2"])
+    assert kvs.getStableCut() == 5
+    assert kvs.pruneDependencies() == 1
+    assert kvs.getDictValue("x") == ("1", 10, {"b": 8})
+    assert kvs.pruneDependencies() == 0
+
+
+def test_vector_clock_tracking():
+    kvs = LocalKVS()
+    kvs.setDictValue("x", "1", 10, toDependencies({"n1": 10, "n2": 4}))
+    kvs.setDictValue("y", "1", 12, toDependencies({"n2": 12}))
+    assert kvs.getVector() == {"n1": 10, "n2": 12}
+    # clock entries aren't keys we're missing
+    assert kvs.getMissingDependencies() == {}
+
+    assert kvs.waitForVector({"n1": 10}, "n1", 0)
+    assert not kvs.waitForVector({"n1": 10, "n2": 4}, "n1", 0.01)
+    Timer(.05, kvs.updateOriginFrontier, args=("n2", 5)).start()
+    assert kvs.waitForVector({"n1": 10, "n2": 4}, "n1", 1)
+
+
+def test_origin_frontier():
+    kvs = LocalKVS()
+    # a write that's still being applied holds the frontier back
+    during = []
+    apply = kvs.setDictValue
+    kvs.setDictValue = lambda key, value, timestamp, dependencies: \
+        during.append(kvs.getOriginFrontier() < timestamp) or apply(key, value, timestamp, dependencies)
+    timestamp, replaced = kvs.setOwnVectorValue("x", "1", {"n2": 4}, "n1")
+    assert during == [True] and not replaced
+    assert kvs.getDictValue("x") == ("1", timestamp, toDependencies({"n2": 4, "n1": timestamp}))
+    assert kvs.getOriginFrontier() >= timestamp
+    # so do timestamps handed out for writes still to come
+    reserved = kvs.reserveTimestamps(count=2)
+    assert kvs.getOriginFrontier() < reserved
+    kvs.releaseTimestamps(reserved)
+    assert kvs.getOriginFrontier() >= reserved
+
+
+def test_own_frontier():
+    kvs = LocalKVS()
+    view = ["n1", "n2", "n3"]
+    kvs.updateOriginFrontier("n2", 50)
+    # nothing until we've heard from every peer
+    kvs.updateOwnFrontier("n1", view)
+    assert kvs.updateFrontiers({}) == {}
+    kvs.updateOriginFrontier("n3", 40)
+    kvs.updateOwnFrontier("n1", view)
+    # the furthest behind of what our peers reported, whatever our wall clock says
+    assert kvs.updateFrontiers({}) == {"n1": 40}
+    # and never past a write we accepted that's still being applied
+    reserved = kvs.reserveTimestamps()
+    kvs.updateOriginFrontier("n2", reserved + 10)
+    kvs.updateOriginFrontier("n3", reserved + 10)
+    kvs.updateOwnFrontier("n1", view)
+    assert 40 < kvs.updateFrontiers({})["n1"] < reserved
+
+
+def test_hybrid_logical_clock():
+    kvs = LocalKVS()
+    first = kvs.newTimestamp()
+    assert kvs.newTimestamp() > first
+    # a timestamp from a node whose wall clock is ahead pulls ours along
+    ahead = first + MAX_CLOCK_DRIFT // 4
+    kvs.setDictValue("x", "theirs", ahead, {})
+    assert kvs.newTimestamp() > ahead
+    further = ahead + 10 * TIMESTAMP_STEP
+    assert 0 < kvs.newTimestamp(observed=further) - further <= TIMESTAMP_STEP
+    base = kvs.newTimestamp(count=3)
+    assert kvs.newTimestamp() == base + 3 * TIMESTAMP_STEP
+    # but only so far, however far ahead a client or peer claims to be
+    kvs.setDictValue("y", "bogus", 10 ** 30, {})
+    assert kvs.newTimestamp(observed=10 ** 40) <= time_ns() + MAX_CLOCK_DRIFT + TIMESTAMP_STEP
+
+
+def test_equal_timestamps():
+    a, b = LocalKVS(node_id=1), LocalKVS(node_id=2)
+    # two nodes following the same client timestamp don't collide
+    observed = time_ns() + MAX_CLOCK_DRIFT // 4
+    assert a.newTimestamp(observed) != b.newTimestamp(observed)
+    # and if two writes do share a timestamp, every replica keeps the same one
+    # whichever arrives first, however it arrives
+    a.setDictValue("x", "1", 5, {})
+    a.mergeEntries({"x": ("2", 5, {})})
+    b.setDictValues({"x": ("2", 5, {})})
+    b.setDictValue("x", "1", 5, {})
+    assert a.getDictValue("x") == b.getDictValue("x")
+    assert a.getMerkleHashes([1]) == b.getMerkleHashes([1])
+    # while replicas still disagree on one, their trees say so
+    a.setDictValue("y", "1", 6, {})
+    b.setDictValue("y", "2", 6, {})
+    assert a.getMerkleHashes([1]) != b.getMerkleHashes([1])
+
+
+def test_collect_tombstones():
+    kvs = LocalKVS()
+    old = time_ns() - 2 * TOMBSTONE_GRACE
+    kvs.setDictValue("gone", None, old, {})
+    kvs.setDictValue("kept", "1", old, {"gone": old})
+    kvs.setDictValue("recent", None, time_ns(), {})
+    assert kvs.getEntryCounts() == {"live": 1, "tombstones": 2}
+    # nothing goes until every replica has the delete
+    assert kvs.collectTombstones() == 0
+    kvs.updateFrontiers({"n1": old}, ["n1"])
+    assert kvs.collectTombstones() == 1
+    assert kvs.getDictValue("gone") is None
+    assert kvs.getEntryCounts() == {"live": 1, "tombstones": 1}
+    assert list(kvs.listKeys(None, 10)[0]) == ["kept"]
+    # a replica that hasn't collected it yet can't bring it back
+    kvs.setDictValue("gone", None, old, {})
+    assert kvs.getDictValue("gone") is None
+    # nor is it missing for writes that depended on it
+    kvs.setDictValue("later", "2", time_ns(), {"gone": old})
+    assert kvs.getMissingDependencies() == {}
+
+
+def test_tombstones_wait_for_every_peer():
+    kvs = LocalKVS()
+    view = ["n1", "n2", "n3"]
+    # however long ago our wall clock says the delete was
+    deleted = time_ns() - 2 * TOMBSTONE_GRACE
+    kvs.setDictValue("gone", None, deleted, {})
+    kvs.updateFrontiers({"n2": deleted, "n3": deleted})
+    kvs.updateOriginFrontier("n2", deleted)
+    # but n3 hasn't vouched for the delete's timestamp yet
+    kvs.updateOriginFrontier("n3", deleted - 1)
+    kvs.updateOwnFrontier("n1", view)
+    assert kvs.collectTombstones() == 0
+    kvs.updateOriginFrontier("n3", deleted)
+    kvs.updateOwnFrontier("n1", view)
+    assert kvs.collectTombstones() == 1
+    # a store that was wiped vouches for nothing
+    kvs.setDict({"gone": (None, deleted, {})})
+    assert kvs.collectTombstones() == 0
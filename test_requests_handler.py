@@ -1,2 +1,157 @@
-# def test_execute_requests_fork():
-#     assert False
+# Tests for the request helpers, against a small HTTP server in the test
+# process that records what it is sent
+import asyncio
+import json
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
+
+import requests_handler
+from requests_handler import KVSRequest, ReplicationSender, asyncExecuteRequests, asyncIterResponses
+
+ENDPOINT = "/kvs/replicate"
+
+
+class RecordingPeer(ThreadingHTTPServer):
+    def __init__(self, status: int = 200, body: dict | None = None, delay: float = 0):
+        """
+        :param body: JSON to respond with; None sends an empty, non-JSON response
+        :param delay: seconds to wait before responding
+        """
+        self.status = status
+        self.received: list[dict] = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(handler):
+                self.received.append(json.loads(handler.rfile.read(int(handler.headers["Content-Length"]))))
+                sleep(delay)
+                payload = b"" if body is None else json.dumps(body).encode()
+                handler.send_response(self.status)
+                if body is not None:
+                    handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(payload)))
+                handler.end_headers()
+                handler.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.address = f"127.0.0.1:{self.server_address[1]}"
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+def waitFor(condition, timeout: float = 5) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(.01)
+    return True
+
+
+def test_writes_batched_per_peer(monkeypatch):
+    monkeypatch.setattr(requests_handler, "REPLICATION_BATCH_WINDOW", .2)
+    peer = RecordingPeer()
+    sender = ReplicationSender()
+    sender.enqueueWrites([peer.address], ENDPOINT, {"x": ("1", 1, {}), "y": ("1", 2, {})})
+    # several writes to a key collapse to the newest, whatever order they come in
+    sender.enqueueWrites([peer.address], ENDPOINT, {"x": ("3", 3, {})})
+    sender.enqueueWrites([peer.address], ENDPOINT, {"x": ("2", 2, {})})
+    assert waitFor(lambda: len(peer.received) == 1)
+    assert waitFor(lambda: sender.pending == 0)
+    assert peer.received == [{"writes": {"x": ["3", 3, {}], "y": ["1", 2, {}]}}]
+    peer.shutdown()
+
+
+def test_full_batch_flushed_early(monkeypatch):
+    monkeypatch.setattr(requests_handler, "REPLICATION_BATCH_WINDOW", 60)
+    monkeypatch.setattr(requests_handler, "REPLICATION_BATCH_SIZE", 3)
+    peer = RecordingPeer()
+    sender = ReplicationSender()
+    sender.enqueueWrites([peer.address], ENDPOINT, {"a": ("1", 1, {}), "b": ("1", 1, {})})
+    sleep(.1)
+    assert peer.received == []
+    sender.enqueueWrites([peer.address], ENDPOINT, {"c": ("1", 1, {})})
+    assert waitFor(lambda: len(peer.received) == 1)
+    assert set(peer.received[0]["writes"]) == {"a", "b", "c"}
+    assert waitFor(lambda: sender.pending == 0)
+    peer.shutdown()
+
+
+def test_execute_requests_skips_bad_responses():
+    good, not_json = RecordingPeer(body={"ok": True}), RecordingPeer(status=502)
+    requests = [KVSRequest(peer.address, ENDPOINT, "PUT", {}) for peer in [not_json, good]]
+    assert asyncio.run(asyncExecuteRequests(requests, timeout=5, process_requests=True)) == [(200, {"ok": True})]
+    good.shutdown()
+    not_json.shutdown()
+
+
+def test_iter_responses_first_answer():
+    fast, slow = RecordingPeer(body={"from": "fast"}), RecordingPeer(body={"from": "slow"}, delay=2)
+
+    async def firstAnswer():
+        requests = [KVSRequest(peer.address, ENDPOINT, "PUT", {}) for peer in [slow, fast]]
+        async for status, body in asyncIterResponses(requests, timeout=5):
+            return body
+
+    start = monotonic()
+    assert asyncio.run(firstAnswer()) == {"from": "fast"}
+    # the slow peer isn't waited on
+    assert monotonic() - start < 1
+    fast.shutdown()
+    slow.shutdown()
+
+
+def test_retry_then_give_up(monkeypatch):
+    monkeypatch.setattr(requests_handler, "REPLICATION_BACKOFF", .01)
+    failing, healthy = RecordingPeer(status=503), RecordingPeer()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        unreachable = f"127.0.0.1:{s.getsockname()[1]}"
+    sender = ReplicationSender(retries=3, timeout=1)
+    sender.enqueue([KVSRequest(node, ENDPOINT, "PUT", {"n": 1}) for node in [failing.address, unreachable,
+                                                                           healthy.address]])
+    # the others don't hold up the healthy peer
+    assert waitFor(lambda: len(healthy.received) == 1)
+    assert waitFor(lambda: sender.pending == 0)
+    assert len(failing.received) == 3
+    failing.shutdown()
+    healthy.shutdown()
+
+
+def test_rejected_not_retried(capsys):
+    rejecting = RecordingPeer(status=400)
+    sender = ReplicationSender(retries=3)
+    sender.enqueue([KVSRequest(rejecting.address, ENDPOINT, "PUT", {"n": 1})])
+    assert waitFor(lambda: sender.pending == 0)
+    # asking again won't change its mind, but it's not silently dropped
+    assert len(rejecting.received) == 1
+    assert "rejected" in capsys.readouterr().out
+    rejecting.shutdown()
+
+
+def test_queue_limit():
+    slow = RecordingPeer(delay=.5)
+    sender = ReplicationSender(max_queued=2)
+    sender.enqueue([KVSRequest(slow.address, ENDPOINT, "PUT", {"n": n}) for n in range(5)])
+    assert sender.pending == 2
+    assert waitFor(lambda: sender.pending == 0)
+    assert sorted(body["n"] for body in slow.received) == [0, 1]
+    # there's room again once they're through
+    sender.enqueue([KVSRequest(slow.address, ENDPOINT, "PUT", {"n": 5})])
+    assert waitFor(lambda: len(slow.received) == 3)
+    slow.shutdown()
+
+
+def test_batches_in_order(monkeypatch):
+    monkeypatch.setattr(requests_handler, "REPLICATION_BATCH_WINDOW", .01)
+    peer = RecordingPeer()
+    sender = ReplicationSender()
+    for timestamp in range(1, 6):
+        sender.enqueueWrites([peer.address], ENDPOINT, {"x": (str(timestamp), timestamp, {})})
+        assert waitFor(lambda: len(peer.received) == timestamp)
+    # each write went out after the one before it, never folded into an older batch
+    assert [body["writes"]["x"][1] for body in peer.received] == [1, 2, 3, 4, 5]
+    peer.shutdown()
@@ -0,0 +1,35 @@
+# Tests for the log-structured LocalKVS engine; no manager processes needed.
+import pickle
+
+from local_database import LocalKVS
+from segment_store import SegmentStore
+
+
+def test_engine_behind_local_kvs(tmp_path):
+    kvs = LocalKVS()
+    kvs.useEngine(SegmentStore(str(tmp_path), segment_size=4096))
+    for i in range(200):
+        kvs.setDictValue(f"key{i % 20}", "v" * 50, i, {"other": i})
+    assert kvs.getDictValue("key19") == ("v" * 50, 199, {"other": 199})
+    assert kvs.setDictValue("key19", "old", 1, {}) is True
+    assert kvs.getDictValue("key19")[1] == 199
+
+    # restarting rebuilds the key directory from the segments
+    reopened = SegmentStore(str(tmp_path), segment_size=4096)
+    assert dict(reopened.copy().items()) == dict(kvs.getDict().items())
+
+
+def test_snapshot_survives_compaction(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_size=4096)
+    for i in range(300):
+        store[f"key{i % 10}"] = ("v" * 50, i, {})
+    snapshot = store.copy()
+    assert store.compact() > 0
+    assert len(store.segments) < 10
+    assert snapshot["key9"] == ("v" * 50, 299, {})
+    assert store["key9"] == ("v" * 50, 299, {})
+    # snapshots handed to other processes are materialized into plain dicts
+    assert pickle.loads(pickle.dumps(snapshot)) == dict(store.items())
+
+    store.clear()
+    assert len(store) == 0 and "key9" not in store
@@ -0,0 +1,124 @@
+# Tests for the shared-memory LocalKVS backend. These don't need the manager
+# processes running, each test gets its own table under tmp_path.
+from multiprocessing import Process
+
+from merkle_tree import MERKLE_DEPTH, MerkleTree
+from shared_kvs import SharedKVS, SharedKVSManager
+
+
+def test_set_get(tmp_path):
+    kvs = SharedKVS(str(tmp_path / "kvs"))
+    assert kvs.getDictValue("x") is None
+    assert kvs.setDictValue("x", "foo", 10, {"x": 3, "y": 5}) is False
+    assert kvs.getDictValue("x") == ("foo", 10, {"y": 5})
+
+    # older writes lose, newer writes win
+    assert kvs.setDictValue("x", "bar", 5, {}) is True
+    assert kvs.getDictValue("x") == ("foo", 10, {"y": 5})
+    assert kvs.setDictValue("x", "bar", 11, {}) is True
+    assert kvs.getDictValue("x") == ("bar", 11, {})
+
+    assert kvs.removeDictValue("x", 12, {}) is True
+    assert kvs.getDictValue("x") == (None, 12, {})
+
+
+def test_grow_and_reset(tmp_path):
+    kvs = SharedKVS(str(tmp_path / "kvs"))
+    for i in range(20000):
+        kvs.setDictValue(f"key{i}", "v" * 100, i, {})
+    assert len(kvs.getDict()) == 20000
+    assert kvs.getDictValue("key19999") == ("v" * 100, 19999, {})
+
+    kvs.setDict({"a": ("b", 1, {})})
+    assert kvs.getDict() == {"a": ("b", 1, {})}
+
+
+def _writer(path: str):
+    kvs = SharedKVS(path)
+    for i in range(15000):
+        kvs.setDictValue(f"child{i}", "v", i, {})
+
+
+def test_visible_across_processes(tmp_path):
+    path = str(tmp_path / "kvs")
+    manager = SharedKVSManager(path)
+    manager.connect()
+    # the child forces at least one rebuild, which we must notice and remap
+    p = Process(target=_writer, args=(path,))
+    p.start()
+    p.join()
+    assert manager.get().getDictValue("child14999") == ("v", 14999, {})
+    assert len(manager.get().getDict()) == 15000
+    # so are its changes to the hash tree
+    assert manager.get().getMerkleHashes([1]) == MerkleTree.fromItems(manager.get().getDict().items()).hashes([1])
+
+
+def test_shared_clock(tmp_path):
+    path = str(tmp_path / "kvs")
+    first, second = SharedKVS(path), SharedKVS(path)
+    # every process issues timestamps from the same clock
+    timestamp = first.newTimestamp()
+    assert second.newTimestamp() > timestamp
+    # which stays ahead of every write applied, by whichever process
+    ahead = timestamp + 10 ** 9
+    first.mergeEntries({"x": ("1", ahead, {})})
+    assert second.newTimestamp() > ahead
+    first.setDictValues({"y": ("1", ahead + 10 ** 9, {})})
+    # even once the table has been rebuilt
+    first.setDict({})
+    assert second.newTimestamp() > ahead + 10 ** 9
+
+
+def test_change_log(tmp_path):
+    kvs = SharedKVS(str(tmp_path / "kvs"))
+    for key in ["a", "b", "c"]:
+        kvs.setDictValue(key, "1", 1, {})
+    kvs.setDictValue("a", "2", 2, {})
+    epoch, seq = kvs.getChangePosition()
+    # a key rewritten since shows up once, at its newest place in the log
+    assert kvs.getChangesSince(0, None) == (epoch, seq, {"b": ("1", 1, {}), "c": ("1", 1, {}), "a": ("2", 2, {})})
+
+    first_epoch, first_seq, changes, complete = kvs.getChangePage(0, None, 2)
+    assert (first_epoch, list(changes), complete) == (epoch, ["b", "c"], False)
+    assert kvs.getChangePage(first_seq, epoch, 2) == (epoch, seq, {"a": ("2", 2, {})}, True)
+    assert kvs.getChangePage(seq, epoch, 2) == (epoch, seq, {}, True)
+
+    # a rebuilt store is a new log, everything in it counts as changed
+    kvs.setDict({"x": ("1", 1, {})})
+    new_epoch, new_seq = kvs.getChangePosition()
+    assert new_epoch != epoch
+    assert kvs.getChangePage(seq, epoch, None) == (new_epoch, new_seq, {"x": ("1", 1, {})}, True)
+
+
+def test_merkle_hashes(tmp_path):
+    kvs = SharedKVS(str(tmp_path / "kvs"))
+    for i in range(20000):
+        kvs.setDictValue(f"key{i}", "v", i + 1, {})
+    kvs.setDictValue("key0", "w", 10 ** 6, {})
+    kvs.removeDictValue("key1", 10 ** 6, {})
+    # kept up to date write by write, and across the rebuilds on the way
+    tree = MerkleTree.fromItems(kvs.getDict().items())
+    nodes = [1, 2, 3] + MerkleTree.descendants([1], MERKLE_DEPTH)[:100]
+    assert kvs.getMerkleHashes(nodes) == tree.hashes(nodes)
+    assert kvs.compareMerkleHashes(tree.hashes(nodes)) == []
+
+    other = MerkleTree.fromItems(kvs.getDict().items())
+    other.update("key2", ("v", 3, {}), ("w", 10 ** 6, {}))
+    bucket = other.bucketOf("key2")
+    leaf = (1 << MERKLE_DEPTH) + bucket
+    assert kvs.compareMerkleHashes(other.hashes([1, leaf, leaf ^ 1])) == [1, leaf]
+    entries, covered = kvs.getBucketPage([bucket], 1)
+    assert covered == 1 and entries["key2"] == ("v", 3, {})
+    assert entries == kvs.getBucketEntries([bucket])
+
+
+def test_frontiers(tmp_path):
+    kvs = SharedKVS(str(tmp_path / "kvs"))
+    kvs.setDictValue("x", "1", 1, {})
+    kvs.removeDictValue("x", 2, {})
+    # no gossiped frontiers are kept here, so nothing is ever known to be
+    # everywhere and tombstones stay put
+    assert kvs.updateFrontiers({"n1": 10, "n2": 10}, ["n1", "n2"]) == {}
+    assert kvs.getStableCut() == 0
+    assert kvs.collectTombstones() == 0
+    assert kvs.getEntryCounts() == {"live": 0, "tombstones": 1}
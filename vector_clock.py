@@ -0,0 +1,47 @@
+# Vector clock causal metadata, as an alternative to the per-key metadata
+# clients send by default.
+#
+# In vector mode a client's causal metadata is {"vc": {node: timestamp}}:
+# for each node, the newest timestamp of a write accepted there that the
+# client depends on. Its size grows with the number of replicas rather than
+# with the number of keys the client has touched.
+#
+# Values written in vector mode keep the writer's clock in their ordinary
+# dependency dict, one entry per node under a reserved key prefix that no
+# client key may start with. Storage, the WAL, replication and gossip carry
+# them like any other dependency; everything that treats dependencies as
+# keys skips them.
+
+VECTOR_PREFIX = "\x00vc:"
+
+
+def isVectorMetadata(metadata) -> bool:
+    """
+    :return: whether causal metadata from a client is in vector mode
+    """
+    return isinstance(metadata, dict) and len(metadata) == 1 and isinstance(metadata.get("vc"), dict)
+
+
+def isVectorKey(key: str) -> bool:
+    return key.startswith(VECTOR_PREFIX)
+
+
+def toDependencies(clock: dict[str, int]) -> dict[str, int]:
+    return {VECTOR_PREFIX + node: timestamp for node, timestamp in clock.items()}
+
+
+def fromDependencies(dependencies: dict[str, int]) -> dict[str, int]:
+    """
+    :return: the vector clock kept in a value's dependencies, if any
+    """
+    return {d_key[len(VECTOR_PREFIX):]: d_ver for d_key, d_ver in dependencies.items() if isVectorKey(d_key)}
+
+
+def merge(clock: dict[str, int], other: dict[str, int]) -> dict[str, int]:
+    """
+    Raise clock to other, entry by entry, in place.
+    :return: clock
+    """
+    for node, timestamp in other.items():
+        clock[node] = max(timestamp, clock.get(node, timestamp))
+    return clock
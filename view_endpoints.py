@@ -3,7 +3,7 @@ from flask import request
 from flask_app import app, our_address
 from modules.view_tracker import getViewManager
 from modules.local_database import getKVSManager
-from supporting_libs.requests_handler import KVSRequest, executeRequestsFork
+from supporting_libs.requests_handler import KVSRequest, getReplicationSender
 
 
 @app.route("/kvs/admin/view", methods=["GET"])
@@ -28,6 +28,12 @@ def putView():
     old_view = view_manager.get().getView()
     new_view = request.get_json().get("view")
     view_manager.get().setView(new_view)
+    # A client only initializes a node that is starting a new cluster with no
+    # prior data, and every node it tells starts out empty too, so there's
+    # nothing to catch up on. Only a node added to a view whose members may
+    # hold data (the sender says so) waits for gossip to bootstrap it.
+    if not old_view and not request.get_json().get("bootstrap", False):
+        view_manager.get().setReady(True)
 
     # Look through the new_view and find if the sender of the view change
     # was another node in the view. If so, we won't bother broadcasting
@@ -40,9 +46,10 @@ def putView():
     requests = []
     requests.extend([KVSRequest(removed_node, "/kvs/admin/view", "DELETE", {}) for removed_node in removed_nodes])
     # Don't bother generating a request to send to ourselves nor node who sent it to us if exists.
-    requests.extend([KVSRequest(added_node, "/kvs/admin/view", "PUT", {"view": new_view})
+    requests.extend([KVSRequest(added_node, "/kvs/admin/view", "PUT",
+                                {"view": new_view, "bootstrap": bool(old_view)})
                      for added_node in added_nodes if not added_node == our_address])
-    executeRequestsFork(requests)
+    getReplicationSender().enqueue(requests)
     return "", 200
 
 
@@ -18,6 +18,9 @@ class View:
         self.lock = Lock()
         self.initialized = False
         self.init_lock = Lock()
+        # Whether we have caught up with the rest of the view since we were
+        # initialized, and so can serve clients
+        self.ready = False
 
     def setView(self, new_view: list[str]) -> None:
         with self.lock:
@@ -34,6 +37,21 @@ class View:
     def setInitialized(self, val: bool) -> None:
         with self.init_lock:
             self.initialized = val
+            if not val:
+                # Whatever we get initialized with next, we start from scratch
+                self.ready = False
+
+    def isReady(self) -> bool:
+        with self.init_lock:
+            return self.initialized and self.ready
+
+    def setReady(self, val: bool) -> None:
+        """
+        Only takes effect while initialized, so a bootstrap that finishes
+        after we were uninitialized doesn't count for the next view.
+        """
+        with self.init_lock:
+            self.ready = val and self.initialized
 
 
 view = View()